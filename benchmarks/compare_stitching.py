@@ -0,0 +1,90 @@
+import os
+import sys
+import json
+import shutil
+import logging
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import extract_ukbb
+from volumes import find_volumes, load_volume
+
+
+CONTRASTS = ['wat', 'inp', 'opp', 'fat']
+
+
+def compare_volumes(reference, volume, atol_affine=1e-3):
+    # shape, affine and voxels of the volume stitched with NumPy against the one of the stitching tool
+    a = np.asanyarray(reference.dataobj)
+    b = np.asanyarray(volume.dataobj)
+    result = {
+        'shape': [list(a.shape), list(b.shape)],
+        'affine_equal': bool(np.allclose(reference.affine, volume.affine, atol=atol_affine)),
+        'max_affine_difference': float(np.abs(reference.affine - volume.affine).max()),
+    }
+    if a.shape == b.shape:
+        difference = np.abs(a.astype(np.float64) - b.astype(np.float64))
+        result.update({
+            'voxels_equal': bool(difference.max() == 0),
+            'max_difference': float(difference.max()),
+            'mean_difference': float(difference.mean()),
+            'fraction_different': float(np.count_nonzero(difference) / difference.size),
+        })
+    else:
+        result['voxels_equal'] = False
+    return result
+
+
+def compare_subject(zip_file, work_folder, tool, max_difference=0.0):
+    subject_id = extract_ukbb.get_subject_id(zip_file)
+    folders = {}
+    for stitching in ['tool', 'numpy']:
+        folders[stitching] = os.path.join(work_folder, stitching, subject_id, '')
+        status = extract_ukbb.stitch(zip_file, folders[stitching], subject_id, tool if stitching == 'tool' else None, intermediate_format='nii.gz')
+        if status == 'failed':
+            raise RuntimeError('Stitching with {0} failed for {1}'.format(stitching, zip_file))
+
+    reference = find_volumes(folders['tool'], CONTRASTS)
+    stitched = find_volumes(folders['numpy'], CONTRASTS)
+    results = {}
+    for contrast in CONTRASTS:
+        results[contrast] = compare_volumes(load_volume(reference[contrast]), load_volume(stitched[contrast]))
+        results[contrast]['passed'] = results[contrast]['affine_equal'] and results[contrast].get('max_difference', np.inf) <= max_difference
+    return {'subject': subject_id, 'contrasts': results, 'passed': all(r['passed'] for r in results.values())}
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--zip_files', nargs='+', required=True, help='UKBB zip files of sample subjects, which are stitched with the stitching tool and with NumPy.')
+    parser.add_argument('--tool', required=False, default=None, help='Path of the stitching tool. Default is the tool of extract_ukbb.py, which is downloaded if it does not exist.')
+    parser.add_argument('--max_difference', type=float, required=False, default=0.0, help='Largest voxel difference that is accepted. Default is identical voxels.')
+    parser.add_argument('--work_folder', required=False, default=None, help='Folder for the stitched volumes. Default is a temporary folder that is deleted at the end.')
+    parser.add_argument('--output', required=False, default=None, help='JSON file for the results. The results are always printed to stdout.')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s: %(message)s', level=logging.WARNING, handlers=[logging.StreamHandler(sys.stderr)])
+
+    tool = os.path.abspath(args.tool) if args.tool is not None else extract_ukbb.get_stitching_tool()
+    work_folder = args.work_folder or tempfile.mkdtemp(prefix='compare_stitching_')
+    try:
+        results = [compare_subject(os.path.abspath(f), work_folder, tool, args.max_difference) for f in args.zip_files]
+    finally:
+        if args.work_folder is None:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+    report = {'tool': tool, 'max_difference': args.max_difference, 'results': results, 'passed': all(r['passed'] for r in results)}
+    if args.output is not None:
+        with open(args.output, 'w') as handle:
+            json.dump(report, handle, indent=2)
+    print(json.dumps(report, indent=2))
+    # a failed comparison fails the run, e.g. in a CI job before the default is changed to numpy
+    sys.exit(0 if report['passed'] else 1)
+
+
+if __name__ == '__main__':
+    main()
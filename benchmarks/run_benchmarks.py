@@ -0,0 +1,146 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+
+import numpy as np
+import nibabel as nib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synthetic
+import extract_ukbb
+import extract_gnc
+import convert2nnunet
+import convert2original
+from conversion_map import load_conversion_map
+from inference import get_cases, predict_folder
+from volumes import INTERMEDIATE_FORMATS
+
+
+def get_environment():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'nibabel': nib.__version__,
+    }
+
+
+def time_stage(results, num_subjects, stage, function, *args, **kwargs):
+    start = time.perf_counter()
+    output = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    results.append({
+        'num_subjects': num_subjects,
+        'stage': stage,
+        'seconds': seconds,
+        'seconds_per_subject': seconds / max(num_subjects, 1),
+        'subjects_per_second': num_subjects / seconds if seconds > 0 else None,
+    })
+    logging.warning('[{0} subjects] {1}: {2:.2f}s'.format(num_subjects, stage, seconds))
+    return output
+
+
+def stitch_all(zip_files, nifti_folder, in_memory, intermediate_format, gzip_level, low_memory=False):
+    for zip_file in zip_files:
+        subject_id = extract_ukbb.get_subject_id(zip_file)
+        extract_ukbb.stitch(zip_file, os.path.join(nifti_folder, subject_id, ''), subject_id, in_memory=in_memory,
+                            intermediate_format=intermediate_format, gzip_level=gzip_level, low_memory=low_memory)
+
+
+def rename_all(subject_dirs, nifti_folder):
+    for subject_dir in subject_dirs:
+        new_subject_dir = os.path.join(nifti_folder, os.path.basename(os.path.dirname(subject_dir)), '')
+        os.makedirs(new_subject_dir, exist_ok=True)
+        extract_gnc.rename_files(subject_dir, new_subject_dir)
+
+
+def write_empty_predictions(nnunet_folder, prediction_folder):
+    # used instead of the stand-in network if torch is not installed, so that format_back can still be measured
+    os.makedirs(prediction_folder, exist_ok=True)
+    for case, input_files in get_cases(nnunet_folder).items():
+        img = nib.load(input_files[0])
+        nib.save(nib.Nifti1Image(np.zeros(img.shape, dtype=np.uint8), img.affine), os.path.join(prediction_folder, case + '.nii.gz'))
+
+
+def run_cohort(work_folder, num_subjects, num_channels, station_shape, crop, intermediate_format, gzip_level, results):
+    zip_files = synthetic.make_ukbb_cohort(os.path.join(work_folder, 'zips'), num_subjects, station_shape)
+    gnc_dirs = synthetic.make_gnc_cohort(os.path.join(work_folder, 'gnc'), num_subjects)
+
+    nifti_folder = os.path.join(work_folder, 'nifti')
+    time_stage(results, num_subjects, 'stitch', stitch_all, zip_files, nifti_folder, False, intermediate_format, gzip_level)
+    time_stage(results, num_subjects, 'stitch_in_memory', stitch_all, zip_files, os.path.join(work_folder, 'nifti_in_memory'), True, intermediate_format, gzip_level)
+    time_stage(results, num_subjects, 'stitch_low_memory', stitch_all, zip_files, os.path.join(work_folder, 'nifti_low_memory'), True, intermediate_format, gzip_level, True)
+    time_stage(results, num_subjects, 'rename_files', rename_all, gnc_dirs, os.path.join(work_folder, 'gnc_nifti'))
+
+    nnunet_folder = os.path.join(work_folder, 'nnunet')
+    json_file = convert2nnunet.get_dataset_json('ukbb', num_channels)
+    time_stage(results, num_subjects, 'format_data', convert2nnunet.format_data, nifti_folder, nnunet_folder, json_file, -1, 0, crop=crop, gzip_level=gzip_level)
+
+    prediction_folder = os.path.join(work_folder, 'predictions')
+    try:
+        from inference import TorchPredictor, get_stand_in_network
+        predictor = TorchPredictor(get_stand_in_network(num_channels), device='cpu')
+    except ImportError as e:
+        logging.warning('Skipping predict, the stand-in network needs torch: {0}'.format(e))
+        results.append({'num_subjects': num_subjects, 'stage': 'predict', 'skipped': repr(e)})
+        write_empty_predictions(nnunet_folder, prediction_folder)
+    else:
+        time_stage(results, num_subjects, 'predict', predict_folder, predictor, nnunet_folder, prediction_folder)
+
+    time_stage(results, num_subjects, 'format_back', convert2original.format_back, load_conversion_map(nnunet_folder), prediction_folder,
+               os.path.join(work_folder, 'outputs'))
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_subjects', type=int, nargs='+', required=False, default=[2, 4], help='Cohort sizes to be measured, each with newly generated synthetic data.')
+    parser.add_argument('--num_channels', type=int, required=False, default=4, choices=[1, 4], help='Number of channels of the nnUNet data. Either 1 or 4.')
+    parser.add_argument('--station_shape', type=int, nargs=3, required=False, default=[64, 48, 16], help='Voxels of each synthetic station (x, y, z). \
+                                                                                                         Six stations with four slices overlap are stitched.')
+    parser.add_argument('--crop', action='store_true', help='Crop the volumes to the abdomen in format_data and paste back in format_back.')
+    parser.add_argument('--intermediate_format', required=False, default='nii.gz', choices=INTERMEDIATE_FORMATS, help='Format of the stitched volumes.')
+    parser.add_argument('--gzip_level', type=int, required=False, default=None, choices=range(10), help='Compression level of the nii.gz files. Default is the level of nibabel.')
+    parser.add_argument('--work_folder', required=False, default=None, help='Folder for the synthetic data. Default is a temporary folder that is deleted at the end.')
+    parser.add_argument('--output', required=False, default=None, help='JSON file for the results. The results are always printed to stdout.')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s: %(message)s', level=logging.WARNING, handlers=[logging.StreamHandler(sys.stderr)])
+
+    work_folder = os.path.abspath(args.work_folder) if args.work_folder is not None else tempfile.mkdtemp(prefix='benchmarks_')
+    results = []
+    try:
+        for num_subjects in args.num_subjects:
+            cohort_folder = os.path.join(work_folder, 'cohort_{0}'.format(num_subjects))
+            if os.path.exists(cohort_folder):
+                shutil.rmtree(cohort_folder)
+            os.makedirs(cohort_folder)
+            run_cohort(cohort_folder, num_subjects, args.num_channels, tuple(args.station_shape), args.crop, args.intermediate_format, args.gzip_level, results)
+    finally:
+        if args.work_folder is None:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': get_environment(),
+        'config': {'num_channels': args.num_channels, 'station_shape': args.station_shape, 'crop': args.crop,
+                   'intermediate_format': args.intermediate_format, 'gzip_level': args.gzip_level},
+        'results': results,
+    }
+    if args.output is not None:
+        with open(args.output, 'w') as handle:
+            json.dump(report, handle, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
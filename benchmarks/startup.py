@@ -0,0 +1,79 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from cli import COMMANDS
+
+
+# libraries that take long to import, a command should only import them when it has something to do
+HEAVY_MODULES = ['nibabel', 'scipy', 'pydicom', 'dicom2nifti', 'torch', 'nnunet']
+
+
+def time_command(command, repeats):
+    # wall time of a new interpreter for the command, the first run is not counted since it fills the file cache
+    times = []
+    for i in range(repeats + 1):
+        start = time.perf_counter()
+        process = subprocess.run(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        seconds = time.perf_counter() - start
+        if process.returncode != 0:
+            return {'error': process.stderr.decode('utf-8', 'replace').strip().splitlines()[-1:]}
+        if i > 0:
+            times.append(seconds)
+    times.sort()
+    return {'min': times[0], 'median': times[len(times) // 2], 'max': times[-1]}
+
+
+def get_imported_modules(module):
+    # heavy libraries that are imported with the module of a command
+    code = 'import sys, {0}; print(" ".join(m for m in {1} if m in sys.modules))'.format(module, HEAVY_MODULES)
+    process = subprocess.run([sys.executable, '-c', code], cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return process.stdout.decode('utf-8').split() if process.returncode == 0 else None
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--commands', nargs='+', required=False, default=list(COMMANDS), choices=list(COMMANDS), help='Commands of cli.py to be measured.')
+    parser.add_argument('--repeats', type=int, required=False, default=5, help='Number of runs of each command.')
+    parser.add_argument('--output', required=False, default=None, help='JSON file for the results. The results are always printed to stdout.')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s: %(message)s', level=logging.WARNING, handlers=[logging.StreamHandler(sys.stderr)])
+
+    results = []
+    # the interpreter alone is the lower bound of every command
+    baseline = time_command([sys.executable, '-c', 'pass'], args.repeats)
+    results.append({'command': 'python', 'help': baseline})
+    for command in args.commands:
+        module = COMMANDS[command][0]
+        result = {
+            'command': command,
+            'help': time_command([sys.executable, 'cli.py', command, '--help'], args.repeats),
+            'script_help': time_command([sys.executable, module + '.py', '--help'], args.repeats),
+            'imports': get_imported_modules(module),
+        }
+        results.append(result)
+        logging.warning('{0}: {1}'.format(command, result['help']))
+
+    report = {
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count()},
+        'repeats': args.repeats,
+        'results': results,
+    }
+    if args.output is not None:
+        with open(args.output, 'w') as handle:
+            json.dump(report, handle, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+import io
+import os
+import zipfile
+
+import numpy as np
+import nibabel as nib
+import pydicom
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+
+MR_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.4'
+
+# contrasts of a UKBB station in the order of their series numbers, see stitch_in_process of extract_ukbb.py
+UKBB_CONTRASTS = ['in', 'opp', 'F', 'W']
+
+
+def make_phantom(shape, spacing, seed=0):
+    # whole-body water and fat images: an elliptic body with a subcutaneous fat layer and dark lungs in the upper part
+    rng = np.random.RandomState(seed)
+    x = (np.arange(shape[0]) - shape[0] / 2.0) * spacing[0]
+    y = (np.arange(shape[1]) - shape[1] / 2.0) * spacing[1]
+    xx, yy = np.meshgrid(x, y, indexing='ij')
+    a, b = 0.4 * shape[0] * spacing[0], 0.35 * shape[1] * spacing[1]
+    r = (xx / a) ** 2 + (yy / b) ** 2
+    body = r < 1
+    inner = r < 0.7
+    lungs = ((((xx + 0.35 * a) / (0.25 * a)) ** 2 + (yy / (0.5 * b)) ** 2) < 1) | ((((xx - 0.35 * a) / (0.25 * a)) ** 2 + (yy / (0.5 * b)) ** 2) < 1)
+
+    water = np.zeros(shape, dtype=np.float32)
+    fat = np.zeros(shape, dtype=np.float32)
+    water[inner] = 300
+    fat[body & ~inner] = 400
+    lung_slices = slice(int(0.15 * shape[2]), int(0.35 * shape[2]))
+    water[:, :, lung_slices][lungs] = 0
+    water += rng.normal(0, 5, shape).astype(np.float32) * body[..., None]
+    fat += rng.normal(0, 5, shape).astype(np.float32) * body[..., None]
+    return np.clip(water, 0, None), np.clip(fat, 0, None)
+
+
+def get_contrasts(water, fat):
+    return {'in': water + fat, 'opp': np.abs(water - fat), 'F': fat, 'W': water}
+
+
+def make_dicom(pixels, position, spacing, series_uid, series_number, description, instance_number, study_uid, frame_uid, patient_id):
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = MR_IMAGE_STORAGE
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = FileDataset(None, Dataset(), file_meta=file_meta, preamble=b'\0' * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.SOPClassUID = MR_IMAGE_STORAGE
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.Modality = 'MR'
+    ds.Manufacturer = 'SIEMENS'
+    ds.ImageType = ['ORIGINAL', 'PRIMARY', 'M', 'ND']
+    ds.PatientID = patient_id
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = series_uid
+    ds.FrameOfReferenceUID = frame_uid
+    ds.SeriesNumber = series_number
+    ds.SeriesDescription = description
+    ds.InstanceNumber = instance_number
+    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    ds.ImagePositionPatient = [float(p) for p in position]
+    ds.PixelSpacing = [float(spacing[1]), float(spacing[0])]
+    ds.SliceThickness = float(spacing[2])
+    ds.Rows, ds.Columns = pixels.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.PixelData = pixels.astype(np.uint16).tobytes()
+    return ds
+
+
+def write_ukbb_zip(zip_path, station_shape=(64, 48, 16), spacing=(4.0, 4.0, 6.0), num_stations=6, overlap=4, seed=0):
+    # six stations x four contrasts as in the *_20201_*.zip files, the stations go from head to feet and overlap by a few slices
+    step = station_shape[2] - overlap
+    body_shape = (station_shape[0], station_shape[1], step * (num_stations - 1) + station_shape[2])
+    water, fat = make_phantom(body_shape, spacing, seed)
+    contrasts = get_contrasts(water, fat)
+
+    patient_id = os.path.basename(zip_path).split('_')[0]
+    study_uid, frame_uid = generate_uid(), generate_uid()
+    origin = [-station_shape[0] * spacing[0] / 2.0, -station_shape[1] * spacing[1] / 2.0]
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        for s in range(num_stations):
+            for c, contrast in enumerate(UKBB_CONTRASTS):
+                series_uid = generate_uid()
+                series_number = s * len(UKBB_CONTRASTS) + c + 1
+                for k in range(station_shape[2]):
+                    z = s * step + k
+                    # the top of the body has the highest z in patient coordinates
+                    position = origin + [-z * spacing[2]]
+                    ds = make_dicom(contrasts[contrast][:, :, z].T, position, spacing, series_uid, series_number, 'Dixon_BH_17s_' + contrast,
+                                    k + 1, study_uid, frame_uid, patient_id)
+                    buffer = io.BytesIO()
+                    pydicom.dcmwrite(buffer, ds, write_like_original=False)
+                    zip_ref.writestr('{0}/{1}.dcm'.format(series_uid, k + 1), buffer.getvalue())
+    return zip_path
+
+
+def make_ukbb_cohort(folder, num_subjects, station_shape=(64, 48, 16), spacing=(4.0, 4.0, 6.0)):
+    # file names follow {eid}_20201_2_0.zip, so get_subject_id of extract_ukbb.py gives {eid}_2
+    os.makedirs(folder, exist_ok=True)
+    return [write_ukbb_zip(os.path.join(folder, '{0}_20201_2_0.zip'.format(1000000 + i)), station_shape, spacing, seed=i) for i in range(num_subjects)]
+
+
+def make_gnc_cohort(folder, num_subjects, shape=(64, 48, 96), spacing=(4.0, 4.0, 6.0)):
+    # one folder per subject with one stitched nii.gz per contrast, as expected by rename_files of extract_gnc.py
+    subject_dirs = []
+    affine = np.diag([-spacing[0], -spacing[1], spacing[2], 1.0])
+    for i in range(num_subjects):
+        subject_dir = os.path.join(folder, 'gnc{0:06d}'.format(i), '')
+        os.makedirs(subject_dir, exist_ok=True)
+        water, fat = make_phantom(shape, spacing, seed=i)
+        contrasts = get_contrasts(water, fat)
+        for name, contrast in zip(['in', 'opp', 'fat', 'wat'], UKBB_CONTRASTS):
+            nib.save(nib.Nifti1Image(contrasts[contrast].astype(np.int16), affine), os.path.join(subject_dir, name + '.nii.gz'))
+        subject_dirs.append(subject_dir)
+    return subject_dirs
@@ -0,0 +1,92 @@
+import os
+import shutil
+import pickle
+import socket
+import hashlib
+
+import numpy as np
+
+
+def hash_files(input_files, chunk_size=1 << 20):
+    # the content of the files in their order, so renamed or re-converted but unchanged cases are still found
+    digest = hashlib.sha256()
+    for input_file in input_files:
+        with open(input_file, 'rb') as handle:
+            for chunk in iter(lambda: handle.read(chunk_size), b''):
+                digest.update(chunk)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class CaseCache(object):
+    # preprocessed cases as memory-mappable npy files, keyed by the input files and the preprocessing plan.
+    # the least recently used cases are removed when the cache is larger than max_size_gb, several processes
+    # can use the same folder because the cases are written to a temporary folder and renamed
+
+    def __init__(self, folder, max_size_gb=None):
+        self.folder = os.path.abspath(folder)
+        self.max_size = int(max_size_gb * 1e9) if max_size_gb is not None else None
+        os.makedirs(self.folder, exist_ok=True)
+
+    def get_key(self, input_files, plan_id):
+        return hashlib.sha256('{0}:{1}'.format(plan_id, hash_files(input_files)).encode('utf-8')).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.folder, key)
+
+    def get(self, key):
+        # returns (data, properties) with memory mapped data, or None if the case is not cached
+        path = self.get_path(key)
+        try:
+            with open(os.path.join(path, 'properties.pkl'), 'rb') as handle:
+                properties = pickle.load(handle)
+            data = np.load(os.path.join(path, 'data.npy'), mmap_mode='r')
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        # the modification time of the folder is the last use of the case
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return data, properties
+
+    def put(self, key, data, properties):
+        path = self.get_path(key)
+        tmp_path = os.path.join(self.folder, '.{0}.{1}.{2}.tmp'.format(key, socket.gethostname(), os.getpid()))
+        os.makedirs(tmp_path, exist_ok=True)
+        np.save(os.path.join(tmp_path, 'data.npy'), data)
+        with open(os.path.join(tmp_path, 'properties.pkl'), 'wb') as handle:
+            pickle.dump(properties, handle)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another process has cached the same case in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self.evict(keep=key)
+
+    def get_entries(self):
+        # [(last use, size, path)] of the cached cases, oldest first
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                entries.append((entry.stat().st_mtime, size, entry.path))
+            except OSError:
+                continue
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        if self.max_size is None:
+            return
+        entries = self.get_entries()
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            if os.path.basename(path) == keep:
+                continue
+            # memory mapped data of a removed case stays readable for the processes that use it
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
@@ -0,0 +1,43 @@
+import sys
+import os
+import argparse
+import importlib
+
+
+# subcommand: (module, description). the module of a subcommand is only imported when it is run, and the modules
+# import nibabel, scipy, dicom2nifti and nnUNet (torch) only in the code that needs them, so --help and runs that
+# have nothing to do start within a fraction of a second
+COMMANDS = {
+    'extract-ukbb': ('extract_ukbb', 'Step 1: stitches the stations of the UKBB zip files (extract_ukbb.py)'),
+    'extract-gnc': ('extract_gnc', 'Step 1: renames the volumes of the GNC subject folders (extract_gnc.py)'),
+    'convert': ('convert2nnunet', 'Step 2: formats the subjects for nnUNet (convert2nnunet.py)'),
+    'predict': ('predict', 'Step 3: predicts the nnUNet cases (predict.py)'),
+    'convert-back': ('convert2original', 'Step 4: formats the predictions back to the subjects (convert2original.py)'),
+    'pipeline': ('pipeline', 'All steps at once (pipeline.py)'),
+    'volumetrics': ('volumetrics', 'Summary of the organ volumetrics table (volumetrics.py)'),
+    'label-archive': ('label_archive', 'Exports label maps of the label archive (label_archive.py)'),
+    'metrics': ('metrics', 'Summary of the metrics file (metrics.py)'),
+}
+
+
+def run(command, args):
+    # the script sees its own arguments, e.g. in its --help
+    module = importlib.import_module(COMMANDS[command][0])
+    sys.argv = ['{0} {1}'.format(os.path.basename(sys.argv[0]), command)] + list(args)
+    module.main()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Abdominal organ segmentation of UKBB and GNC, see python cli.py <command> --help',
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog='commands:\n' + '\n'.join('  {0:<15} {1}'.format(command, description) for command, (_, description) in COMMANDS.items()))
+    parser.add_argument('command', choices=list(COMMANDS), metavar='command', help='One of the commands below.')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='Arguments of the script of the command.')
+    args = parser.parse_args()
+
+    run(args.command, args.args)
+
+
+if __name__ == '__main__':
+    main()
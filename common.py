@@ -0,0 +1,27 @@
+import os
+
+from volumes import find_volumes
+
+
+# volumes of a subject that extract_ukbb.py and extract_gnc.py write and convert2nnunet.py reads
+STITCHED_VOLUMES = ['wat', 'inp', 'opp', 'fat']
+
+
+def get_log_file(script_file, dir_path=None, basename=None):
+    # script_file is the __file__ of the script, the log is next to it if no dir_path is given
+    file_name, file_extension = os.path.splitext(script_file)
+    if dir_path is None and basename is None:
+        log_file_path = file_name + '_log.txt'
+    elif dir_path is not None and basename is None:
+        log_file_path = os.path.join(dir_path, os.path.basename(file_name) + '_log.txt')
+    elif dir_path is None and basename is not None:
+        log_file_path = os.path.join(os.path.dirname(file_name), basename)
+    else:
+        log_file_path = os.path.join(dir_path, basename)
+    return log_file_path
+
+
+def is_stitching_correct(subject_dir):
+    # a missing subject_dir has none of the volumes
+    volumes = find_volumes(subject_dir, STITCHED_VOLUMES)
+    return all(path is not None for path in volumes.values())
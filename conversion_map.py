@@ -0,0 +1,135 @@
+import sqlite3
+import pickle
+import json
+import os
+import argparse
+
+
+class ConversionMap(object):
+    # indexed and appendable version of conversion.pkl, entries can be looked up by nnunet_subject and orig_subject
+
+    def __init__(self, db_path):
+        self.db_path = os.path.abspath(db_path)
+        self.conn = sqlite3.connect(self.db_path, timeout=60)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS conversion (
+                                 nnunet_subject TEXT PRIMARY KEY,
+                                 nnunet_subject_no INTEGER NOT NULL,
+                                 orig_subject TEXT NOT NULL,
+                                 entry TEXT NOT NULL)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_orig_subject ON conversion (orig_subject)')
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM conversion').fetchone()[0]
+
+    def __iter__(self):
+        for row in self.conn.execute('SELECT entry FROM conversion ORDER BY nnunet_subject_no'):
+            yield json.loads(row[0])
+
+    def get_rows(self):
+        # {nnunet_subject: entry as stored}
+        return dict(self.conn.execute('SELECT nnunet_subject, entry FROM conversion'))
+
+    def append(self, entries):
+        self.conn.executemany('INSERT OR REPLACE INTO conversion (nnunet_subject, nnunet_subject_no, orig_subject, entry) VALUES (?, ?, ?, ?)',
+                              [(e['nnunet_subject'], e['nnunet_subject_no'], e['orig_subject'], json.dumps(e)) for e in entries])
+        self.conn.commit()
+
+    def get_by_nnunet_subject(self, nnunet_subject):
+        row = self.conn.execute('SELECT entry FROM conversion WHERE nnunet_subject = ?', (nnunet_subject,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def get_by_orig_subject(self, orig_subject):
+        return [json.loads(row[0]) for row in self.conn.execute('SELECT entry FROM conversion WHERE orig_subject = ? ORDER BY nnunet_subject_no', (orig_subject,))]
+
+    def get_orig_subjects(self):
+        return set(row[0] for row in self.conn.execute('SELECT orig_subject FROM conversion'))
+
+    def get_max_subject_no(self):
+        return self.conn.execute('SELECT MAX(nnunet_subject_no) FROM conversion').fetchone()[0] or 0
+
+
+def get_conversion_paths(folder):
+    return os.path.join(folder, 'conversion.db'), os.path.join(folder, 'conversion.pkl')
+
+
+def load_conversion_map(folder):
+    # conversion.db is preferred, conversion.pkl of earlier runs is still readable
+    db_path, pickle_path = get_conversion_paths(folder)
+    if os.path.isfile(db_path):
+        conversion_map = ConversionMap(db_path)
+        entries = list(conversion_map)
+        conversion_map.close()
+        return entries
+    with open(pickle_path, 'rb') as handle:
+        return pickle.load(handle)
+
+
+def iter_conversion_map(folder):
+    # entries of conversion.db are streamed instead of loading the whole map into memory
+    db_path, pickle_path = get_conversion_paths(folder)
+    if os.path.isfile(db_path):
+        conversion_map = ConversionMap(db_path)
+        try:
+            for entry in conversion_map:
+                yield entry
+        finally:
+            conversion_map.close()
+    else:
+        with open(pickle_path, 'rb') as handle:
+            for entry in pickle.load(handle):
+                yield entry
+
+
+def open_conversion_map(folder):
+    # returns the indexed map, which is created from conversion.pkl if only the pickle exists
+    db_path, pickle_path = get_conversion_paths(folder)
+    if not os.path.isfile(db_path) and os.path.isfile(pickle_path):
+        with open(pickle_path, 'rb') as handle:
+            entries = pickle.load(handle)
+        conversion_map = ConversionMap(db_path)
+        conversion_map.append(entries)
+        return conversion_map
+    return ConversionMap(db_path)
+
+
+def update_conversion_map(src_folder, dst_folder):
+    # only the entries that are new or changed in src_folder are written to dst_folder, e.g. from the nnunet_folder to the
+    # prediction_folder, instead of copying the whole map. returns the number of written entries
+    src = open_conversion_map(src_folder)
+    dst = open_conversion_map(dst_folder)
+    try:
+        existing = dst.get_rows()
+        changed = [json.loads(entry) for nnunet_subject, entry in src.get_rows().items() if existing.get(nnunet_subject) != entry]
+        dst.append(changed)
+    finally:
+        src.close()
+        dst.close()
+    return len(changed)
+
+
+def export_pickle(folder, pickle_path=None):
+    # one-off export of conversion.db as the conversion.pkl of earlier versions, e.g. for tools that still read the pickle
+    pickle_path = pickle_path or get_conversion_paths(folder)[1]
+    tmp_path = '{0}.{1}.tmp'.format(pickle_path, os.getpid())
+    with open(tmp_path, 'wb') as handle:
+        pickle.dump(load_conversion_map(folder), handle, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, pickle_path)
+    return pickle_path
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--folder', required=True, help='Folder with conversion.db, e.g. the nnunet_folder of convert2nnunet.py or the prediction_folder of predict.py')
+    parser.add_argument('--pickle_file', required=False, default=None, help='Exported conversion.pkl. Default is conversion.pkl in folder.')
+    args = parser.parse_args()
+
+    print('Exported {0} entries to {1}'.format(len(load_conversion_map(args.folder)), export_pickle(args.folder, args.pickle_file)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,6 @@
 import sys
 import argparse
 import shutil
-import pickle
-import glob
 import copy
 import json
 import math
@@ -12,6 +10,15 @@ import logging
 
 from collections import OrderedDict
 
+from manifest import Manifest
+from indexer import DirectoryIndex
+from linking import link_file, LINK_MODES
+from conversion_map import open_conversion_map
+from cropping import find_abdominal_box, crop_image, get_crop_record
+import metrics
+from common import get_log_file, is_stitching_correct
+from volumes import find_volumes, save_volume, load_volume
+
 
 def save_json(json_file, save_path):
 
@@ -19,31 +26,95 @@ def save_json(json_file, save_path):
         json.dump(json_file, handle)
 
 
-def save_pickle(pickle_file, save_path):
+def load_json(json_path):
 
-    with open(save_path, 'wb') as handle:
-        pickle.dump(pickle_file, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    with open(json_path, 'r') as handle:
+        json_file = json.load(handle, object_pairs_hook=OrderedDict)
+    return json_file
 
 
-def is_stitching_correct(subject_dir):
-    sub_exists = os.path.isdir(subject_dir)
-    wat_exists = os.path.isfile(os.path.join(subject_dir, 'wat.nii.gz'))
-    inp_exists = os.path.isfile(os.path.join(subject_dir, 'inp.nii.gz'))
-    opp_exists = os.path.isfile(os.path.join(subject_dir, 'opp.nii.gz'))
-    fat_exists = os.path.isfile(os.path.join(subject_dir, 'fat.nii.gz'))
-    
-    return sub_exists and wat_exists and inp_exists and opp_exists and fat_exists
+def load_existing_dataset(nnunet_folder, json_file):
+
+    json_path = os.path.join(nnunet_folder, 'dataset.json')
+    if not os.path.isfile(json_path):
+        return []
+
+    existing_json = load_json(json_path)
+    if existing_json['name'] != json_file['name'] or dict(existing_json['modality']) != dict(json_file['modality']):
+        raise ValueError('\"{0}\" contains a different dataset ({1}) than the requested one ({2}).'.format(nnunet_folder, existing_json['name'], json_file['name']))
+
+    return existing_json['test']
+
+
+def get_case_id(name, subject_no, num_of_digits):
+
+    return name + '_' + str(subject_no).zfill(num_of_digits)
+
+
+def format_subject(sub_path, nnunet_folder, img_basenames, case_id, subject_no, link_mode='copy', crop=False, crop_margin=20.0, gzip_level=None):
+
+    # nnunet_subject in the event lets metrics.py relate the events of the predictions to the subject
+    with metrics.measure(os.path.basename(os.path.dirname(sub_path)), 'convert', nnunet_subject=case_id, crop=crop):
+        return format_subject_files(sub_path, nnunet_folder, img_basenames, case_id, subject_no, link_mode, crop, crop_margin, gzip_level)
+
+
+def format_subject_files(sub_path, nnunet_folder, img_basenames, case_id, subject_no, link_mode, crop, crop_margin, gzip_level):
+
+    subject_props = {
+        'orig_subject': os.path.basename(os.path.dirname(sub_path)),
+        'orig_subject_path': os.path.abspath(sub_path),
+        'nnunet_subject_no': subject_no,
+        'nnunet_subject': case_id,
+        'img_paths': [],
+    }
+
+    volumes = find_volumes(sub_path, img_basenames + ['inp'])
+    if crop:
+        # the box is found on the in-phase image, where the lungs are dark and fat and water are bright
+        ref_img = load_volume(volumes['inp'])
+        box = find_abdominal_box(ref_img, crop_margin)
+        subject_props['crop'] = get_crop_record(ref_img, box)
+
+    for j in range(len(img_basenames)):
+
+        f_path = volumes[img_basenames[j]]
+        # nnUNet only reads nii.gz, nii and npy volumes are compressed here with gzip_level
+        new_path = os.path.join(nnunet_folder, case_id + '_' + str(j).zfill(4) + '.nii.gz')
+        if crop:
+            save_volume(crop_image(load_volume(f_path), box), new_path, gzip_level)
+            used_link_mode = 'crop'
+        elif not f_path.endswith('.nii.gz') or gzip_level is not None:
+            save_volume(load_volume(f_path), new_path, gzip_level)
+            used_link_mode = 'gzip'
+        else:
+            used_link_mode = link_file(f_path, new_path, link_mode)
+        subject_props['img_paths'].append({'orig': os.path.abspath(f_path), 'nnunet': os.path.abspath(new_path), 'link_mode': used_link_mode})
+
+    return subject_props
 
 
-def format_data(nifti_folder, nnunet_folder, json_file, num_subjects, start_idx):
+def get_img_basenames(json_file):
 
     img_basenames = []
     for i in range(len(json_file['modality'])):
         img_basenames.append(copy.deepcopy(json_file['modality'][copy.deepcopy(str(i))]))
+    return img_basenames
+
+
+def format_data(nifti_folder, nnunet_folder, json_file, num_subjects, start_idx, manifest=None, link_mode='copy', incremental=False, crop=False, crop_margin=20.0, gzip_level=None,
+                index_folder=None):
+
+    img_basenames = get_img_basenames(json_file)
 
     logging.info('Modalities to be formatted: {0}\n'.format(img_basenames))
 
-    subjects = sorted(glob.glob(os.path.join(nifti_folder, '*', '')))
+    if manifest is None:
+        index = DirectoryIndex(nifti_folder, index_folder)
+        subjects = index.dirs()
+        index.save()
+    else:
+        # extracted subjects are taken from the manifest instead of crawling nifti_folder
+        subjects = sorted(os.path.join(nifti_folder, sub, '') for sub in manifest.get_subjects('extract', folder=nifti_folder))
     if start_idx < 0:
         start_idx = 0
     if num_subjects > 0 and start_idx + num_subjects <= len(subjects):
@@ -52,94 +123,127 @@ def format_data(nifti_folder, nnunet_folder, json_file, num_subjects, start_idx)
         subjects = subjects[start_idx:]
         
     
-    if os.path.exists(nnunet_folder):
-        if input('\"{0}\" exists and will be deleted. Are you sure that this is the intended nnunet_folder [y/n]? '.format(nnunet_folder)).lower() != 'y':
-            raise SystemExit(0)
-        else:
-            shutil.rmtree(nnunet_folder)
+    if incremental:
+        # existing case ids are kept and only new subjects are appended, no need to ask before deleting
+        img_list = load_existing_dataset(nnunet_folder, json_file)
+    else:
+        if os.path.exists(nnunet_folder):
+            if input('\"{0}\" exists and will be deleted. Are you sure that this is the intended nnunet_folder [y/n]? '.format(nnunet_folder)).lower() != 'y':
+                raise SystemExit(0)
+            else:
+                shutil.rmtree(nnunet_folder)
+        img_list = []
     os.makedirs(nnunet_folder, exist_ok=True)
+    indexed_conversion_map = open_conversion_map(nnunet_folder)
 
     conversion_map = []
-    img_list = []
-
     skipped_subjects = []
     
     cnt = 0
-    num_of_digits = int(math.log10(len(subjects))) + 1
+    num_of_digits = int(math.log10(max(len(subjects), 1))) + 1
+    if len(indexed_conversion_map) > 0:
+        existing_subjects = indexed_conversion_map.get_orig_subjects()
+        logging.info('Number of subjects that already exist in nnunet_folder: {0}\n'.format(len(existing_subjects)))
+        subjects = [sub_path for sub_path in subjects if os.path.basename(os.path.dirname(sub_path)) not in existing_subjects]
+        # new case ids continue the existing numbering with the same number of digits
+        cnt = indexed_conversion_map.get_max_subject_no()
+        num_of_digits = len(next(iter(indexed_conversion_map))['nnunet_subject']) - len(json_file['name']) - 1
+    num_existing = len(img_list)
+
     for sub_path in subjects:
         
+        # the volumes are checked with a manifest too, they may have been deleted since they were recorded
         if is_stitching_correct(sub_path):
         
             logging.info('Formatting [cnt: {0}]: {1}'.format(cnt + 1, sub_path))
-            id_added = False
             subject_no = cnt + 1
-            case_id = json_file['name'] + '_' + str(subject_no).zfill(num_of_digits)
-            subject_props = {
-                'orig_subject': os.path.basename(os.path.dirname(sub_path)),
-                'orig_subject_path': os.path.abspath(sub_path),
-                'nnunet_subject_no': subject_no,
-                'nnunet_subject': case_id,
-                'img_paths': [],
-            }
-
-            files = glob.glob(os.path.join(sub_path, '*.nii.gz'))
-            for j in range(len(img_basenames)):
-            
-                f_path = os.path.join(sub_path, img_basenames[j] + '.nii.gz')
-                if not id_added:
-                    img_list.append(os.path.abspath(os.path.join(nnunet_folder, case_id + '.nii.gz')))
-                    id_added = True
-    
-                new_path = os.path.join(nnunet_folder, case_id + '_' + str(j).zfill(4) + '.nii.gz')
-                subject_props['img_paths'].append({'orig': os.path.abspath(f_path), 'nnunet': os.path.abspath(new_path)})
-                shutil.copy2(f_path, new_path)
+            case_id = get_case_id(json_file['name'], subject_no, num_of_digits)
+            subject_props = format_subject(sub_path, nnunet_folder, img_basenames, case_id, subject_no, link_mode, crop, crop_margin, gzip_level)
+            if crop:
+                logging.info('Cropped to {0} of {1}'.format(subject_props['crop']['box'], subject_props['crop']['shape']))
+            img_list.append(os.path.abspath(os.path.join(nnunet_folder, case_id + '.nii.gz')))
 
             conversion_map.append(subject_props)
             cnt += 1
+            if manifest is not None:
+                manifest.update(subject_props['orig_subject'], 'convert', 'done', outputs=[p['nnunet'] for p in subject_props['img_paths']], info={'nnunet_subject': case_id}, commit=False, folder=nnunet_folder)
         else:
             logging.info('Skipping: {0}'.format(sub_path))
             logging.info('Please check the subject directory and all modalities (wat, opp, fat, inp) exist...\n')
             skipped_subjects.append(os.path.basename(os.path.dirname(sub_path)))
+            if manifest is not None:
+                manifest.update(skipped_subjects[-1], 'convert', 'failed', error='Missing modalities', commit=False, folder=nnunet_folder)
 
+    if manifest is not None:
+        manifest.commit()
     
     json_file['numTraining'] = 0
     json_file['training'] = []
     json_file['numTest'] = len(img_list)
     json_file['test'] = img_list
 
+    # only the new entries are written, conversion.pkl can be exported once with conversion_map.py
+    indexed_conversion_map.append(conversion_map)
     save_json(json_file, os.path.join(nnunet_folder, 'dataset.json'))
-    save_pickle(conversion_map, os.path.join(nnunet_folder, 'conversion.pkl'))
+    indexed_conversion_map.close()
     
     logging.info('dataset.json: {0}'.format(os.path.join(nnunet_folder, 'dataset.json')))
-    logging.info('conversion.pkl: {0}\n'.format(os.path.join(nnunet_folder, 'conversion.pkl')))
+    logging.info('conversion.db: {0}\n'.format(os.path.join(nnunet_folder, 'conversion.db')))
+    if os.path.isfile(os.path.join(nnunet_folder, 'conversion.pkl')):
+        logging.info('conversion.pkl of an earlier version is not updated, it can be exported again with conversion_map.py\n')
     
     logging.info('All subjects that are skipped during the formatting: {0}\n'.format(skipped_subjects))
-    logging.info('Number of formatted subjects: {0}'.format(len(img_list)))
+    logging.info('Number of formatted subjects: {0}'.format(len(img_list) - num_existing))
     logging.info('Total number of subjects: {0}'.format(len(subjects)))
+    logging.info('Total number of subjects in nnunet_folder: {0}'.format(len(img_list)))
+
+
+def get_dataset_json(dataset_name, num_channels):
 
+    json_file = OrderedDict()
+    json_file['name'] = '{0}_{1}ch'.format(dataset_name, num_channels)
 
-def get_log_file(dir_path=None, basename=None):
-    file_name, file_extension  = os.path.splitext(__file__)
-    if dir_path is None and basename is None:
-       log_file_path = file_name + '_log.txt'
-    elif dir_path is not None and basename is None:
-       log_file_path = os.path.join(dir_path, os.path.basename(file_name) + '_log.txt')
-    elif dir_path is None and basename is not None:
-       log_file_path = os.path.join(os.path.dirname(file_name), basename)
+    if dataset_name == 'gnc':
+        json_file['description'] = 'Whole-Body Abdominal Segmentation of German National Cohort Dataset'
+        json_file['tensorImageSize'] = '4D'
+        if num_channels == 1:
+            json_file['modality'] = {'0': 'wat'}
+        else:
+            json_file['modality'] = {'0': 'wat', '1': 'fat', '2': 'inp', '3': 'opp'}
+        json_file['labels'] = {'0': 'background', '1': 'liv', '2': 'spl', '3': 'rkd', '4': 'lkd', '5': 'pnc'}
     else:
-       log_file_path = os.path.join(dir_path, basename)
-    return log_file_path
+        json_file['description'] = 'Whole-Body Abdominal Segmentation of UK Biobank Dataset'
+        json_file['tensorImageSize'] = '4D'
+        if num_channels == 1:
+            json_file['modality'] = {'0': 'wat'}
+        else:
+            json_file['modality'] = {'0': 'wat', '1': 'opp', '2': 'fat', '3': 'inp'}
+        json_file['labels'] = {'0': 'background', '1': 'liv', '2': 'spl', '3': 'lkd', '4': 'rkd', '5': 'pnc'}
+
+    return json_file
 
 
 def main():
     
     parser = argparse.ArgumentParser()
-    parser.add_argument('--nifti_folder', required=True, help='Folder that contains subjects with stitched volumes as nii.gz files')
+    parser.add_argument('--nifti_folder', required=True, help='Folder that contains subjects with stitched volumes as nii.gz, nii or npy files')
     parser.add_argument('--nnunet_folder', required=True, help='Folder that contains subjects formatted for nnUNet')
     parser.add_argument('--dataset_name', required=True, choices=['ukbb', 'gnc'], help='Dataset name is either ukbb or gnc')    
     parser.add_argument('--num_channels', type=int, required=True, choices=[1, 4], help='Number of channels to be used. Either 1 or 4.')
     parser.add_argument('--num_subjects', type=int, required=False, default=-1, help='Subjects are firstly ordered. Then, they are selected from index [start_idx] to index [start_idx + num_subjects]. If zero or less, all subjects from index [start_idx] to the end.')
     parser.add_argument('--start_idx', type=int, required=False, default=0, help='Subjects are firstly ordered. Then, they are selected from index [start_idx] to index [start_idx + num_subjects].')
+    parser.add_argument('--manifest', required=False, default=None, help='SQLite file that records the state of each subject. If given, the extracted subjects are taken from the manifest instead of nifti_folder, their volumes are still checked.')
+    parser.add_argument('--index_folder', required=False, default=None, help='Folder for snapshots of the directory listings. A folder is only listed again if its modification time has changed, e.g. when subjects are added. \
+                                                                                                Default is one listing per run without snapshots.')
+    parser.add_argument('--incremental', action='store_true', help='Keep the existing subjects and case ids of nnunet_folder and only append new subjects. nnunet_folder is not deleted and no confirmation is asked.')
+    parser.add_argument('--link_mode', required=False, default='copy', choices=LINK_MODES, help='How files are staged into nnunet_folder. Falls back to copy if linking is not possible, e.g. across filesystems.')
+    parser.add_argument('--crop', action='store_true', help='Crop the volumes to the abdomen (found below the lungs) before the prediction. The crop box is stored in the conversion map \
+                                                             and convert2original.py pastes the predictions back to the whole-body volumes.')
+    parser.add_argument('--crop_margin', type=float, required=False, default=20.0, help='Safety margin of the crop box in mm.')
+    parser.add_argument('--gzip_level', type=int, required=False, default=None, choices=range(10), help='Compression level of the nii.gz files for nnUNet, which only reads nii.gz. \
+                                                                                                    0 (no compression) is the fastest to write and to read. Default is the level of nibabel (1). \
+                                                                                                    nii.gz volumes of nifti_folder are only recompressed if given, otherwise they are linked or copied (see link_mode).')
+    parser.add_argument('--metrics_file', required=False, default=None, help='JSONL file to which the timing and resources of each subject are appended, see metrics.py.')
     args = parser.parse_args()
     
     nifti_folder = os.path.abspath(args.nifti_folder)
@@ -148,8 +252,16 @@ def main():
     num_channels = args.num_channels
     num_subjects = args.num_subjects
     start_idx = args.start_idx
+    manifest = Manifest(args.manifest) if args.manifest is not None else None
+    link_mode = args.link_mode
+    incremental = args.incremental
+    crop = args.crop
+    crop_margin = args.crop_margin
+    metrics.configure(args.metrics_file)
+    gzip_level = args.gzip_level
     
-    log_file_path = get_log_file(basename=os.path.basename(nnunet_folder) + '_log.txt')
+    # the temporary log is unique per process, so that concurrent runs do not write into the same file
+    log_file_path = get_log_file(__file__, basename='{0}_{1}_log.txt'.format(os.path.basename(nnunet_folder), os.getpid()))
     logging.basicConfig(
         format='%(asctime)s: %(message)s',  
         level=logging.NOTSET, 
@@ -164,33 +276,23 @@ def main():
     logging.info('dataset_name: {0}'.format(dataset_name))
     logging.info('num_channels: {0}'.format(num_channels))
     logging.info('num_subjects: {0}'.format(num_subjects))
-    logging.info('start_idx: {0}\n'.format(start_idx))
+    logging.info('start_idx: {0}'.format(start_idx))
+    logging.info('index_folder: {0}'.format(args.index_folder))
+    logging.info('manifest: {0}'.format(args.manifest))
+    logging.info('link_mode: {0}'.format(link_mode))
+    logging.info('incremental: {0}'.format(incremental))
+    logging.info('crop: {0}'.format(crop))
+    logging.info('crop_margin: {0}'.format(crop_margin))
+    logging.info('gzip_level: {0}'.format(gzip_level))
+    logging.info('metrics_file: {0}\n'.format(args.metrics_file))
     
-    json_file = OrderedDict()
-    json_file['name'] = '{0}_{1}ch'.format(dataset_name, num_channels)
-
-    if dataset_name == 'gnc':
-        json_file['description'] = 'Whole-Body Abdominal Segmentation of German National Cohort Dataset'
-        json_file['tensorImageSize'] = '4D'
-        if num_channels == 1:
-            json_file['modality'] = {'0': 'wat'}
-        else:
-            json_file['modality'] = {'0': 'wat', '1': 'fat', '2': 'inp', '3': 'opp'}
-        json_file['labels'] = {'0': 'background', '1': 'liv', '2': 'spl', '3': 'rkd', '4': 'lkd', '5': 'pnc'}
-    else:
-        json_file['description'] = 'Whole-Body Abdominal Segmentation of UK Biobank Dataset'
-        json_file['tensorImageSize'] = '4D'
-        if num_channels == 1:
-            json_file['modality'] = {'0': 'wat'}
-        else:
-            json_file['modality'] = {'0': 'wat', '1': 'opp', '2': 'fat', '3': 'inp'}
-        json_file['labels'] = {'0': 'background', '1': 'liv', '2': 'spl', '3': 'lkd', '4': 'rkd', '5': 'pnc'}
+    json_file = get_dataset_json(dataset_name, num_channels)
 
-    format_data(nifti_folder, nnunet_folder, json_file, num_subjects, start_idx)
+    format_data(nifti_folder, nnunet_folder, json_file, num_subjects, start_idx, manifest, link_mode, incremental, crop, crop_margin, gzip_level, args.index_folder)
 
     logging.info('Finished formatting for nnUNet...')
     
-    shutil.copy2(log_file_path, get_log_file(dir_path=nnunet_folder, basename=os.path.basename(nnunet_folder) + '_log.txt'))
+    shutil.copy2(log_file_path, get_log_file(__file__, dir_path=nnunet_folder, basename=os.path.basename(nnunet_folder) + '_log.txt'))
     os.remove(log_file_path)
 
 if __name__ == '__main__':
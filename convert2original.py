@@ -2,58 +2,193 @@ import sys
 import argparse
 import logging
 import shutil 
-import pickle
-import glob 
 import os
 
+from concurrent.futures import ProcessPoolExecutor
 
-def load_pickle(pickle_path):
-    with open(pickle_path, 'rb') as f:
-        pkl_file = pickle.load(f)
-    return pkl_file
+from manifest import Manifest
+from linking import link_file, LINK_MODES
+from conversion_map import iter_conversion_map
+from cropping import paste_labels
+from postprocessing import keep_largest_components
+from label_archive import LabelArchive, encode_subject
+from volumes import is_uint8_labels, load_volume, load_labels, save_labels
+from volumetrics import VolumetricsTable, get_label_names, get_organs, get_subject_volumetrics
+from common import get_log_file
+import metrics
 
 
-def format_back(conversion_map, prediction_folder, output_folder):
+OUTPUT_FORMATS = ['nifti', 'archive', 'both']
 
-    pred_paths = glob.glob(os.path.join(prediction_folder, '*.nii.gz'))
-    pred_paths.sort()
 
-    conversion_cnt = 0
+def get_prediction_names(prediction_folder):
+    # a single scan of the prediction folder, membership tests are then O(1)
+    return set(entry.name for entry in os.scandir(prediction_folder) if entry.name.endswith('.nii.gz') and entry.is_file())
+
+
+def get_archive_path(output_folder):
+    return os.path.join(output_folder, 'labels.db')
+
+
+def is_converted(subject, output_folder, output_format, archive=None):
+    # the outputs of the output format exist, e.g. of an interrupted run. archive is the open label archive of the archive and both formats
+    if output_format != 'archive' and not os.path.isfile(os.path.join(output_folder, subject, 'prd.nii.gz')):
+        return False
+    return archive is None or subject in archive
+
+
+def format_back_subject(entry, prediction_folder, output_folder, link_mode='copy', reset_peak=False, postprocess=False, label_names=None, volumetrics=False,
+                        output_format='nifti'):
+    # returns the path of the label map (None if only archived), the voxels removed by the postprocessing ({organ: voxels} or None),
+    # the volumetrics of the subject (see volumetrics.py, None if volumetrics is False) and the record of the label archive
+    # (see label_archive.py, None if the output format is nifti)
+
+    new_subject_path = os.path.join(output_folder, entry['orig_subject'], '')
+    nnunet_pred_path = os.path.join(prediction_folder, entry['nnunet_subject'] + '.nii.gz')
+    new_pred_path = os.path.join(new_subject_path, 'prd.nii.gz') if output_format != 'archive' else None
+    label_names = label_names or {}
+    crop = entry.get('crop')
+
+    labels, removed, record = None, None, None
+    with metrics.measure(entry['orig_subject'], 'convert_back', reset_peak=reset_peak) as measurement:
+        pred = load_volume(nnunet_pred_path)
+        # the label map is only read if it is changed or archived, otherwise the prediction is linked
+        if postprocess or output_format != 'nifti' or crop is not None or not is_uint8_labels(pred):
+            labels = load_labels(pred)
+        if postprocess:
+            # the largest component of every organ is kept, the cleaned label map is written instead of the copy
+            if not labels.flags.writeable:
+                labels = labels.copy()
+            removed = {label_names.get(label, str(label)): n for label, n in keep_largest_components(labels).items()}
+            measurement.info['removed_voxels'] = removed
+
+        if new_pred_path is not None:
+            os.makedirs(new_subject_path, exist_ok=True)
+            if labels is None:
+                link_file(nnunet_pred_path, new_pred_path, link_mode)
+            elif crop is not None:
+                # the prediction of the cropped volumes is padded back to the whole-body volume
+                paste_labels(labels, pred.header, new_pred_path, crop)
+            else:
+                # also predictions of other dtypes than uint8
+                save_labels(labels, pred.header, new_pred_path)
+        if output_format != 'nifti':
+            record = encode_subject(entry['orig_subject'], labels, pred.header, label_names, crop)
+    if reset_peak:
+        logging.info('Peak memory of subject id [{0}]: {1:.0f} MB'.format(entry['orig_subject'], measurement.peak_rss_mb))
+    if removed is not None:
+        logging.info('Removed voxels of subject id [{0}]: {1}'.format(entry['orig_subject'], removed))
+
+    row = None
+    if volumetrics:
+        with metrics.measure(entry['orig_subject'], 'volumetrics'):
+            row = get_subject_volumetrics(entry, prediction_folder, label_names, labels, removed)
+    return new_pred_path, removed, row, record
+
+
+def map_subjects(tasks, workers, prediction_folder, output_folder, link_mode, postprocess, label_names, output_format):
+    # yields (entry, error, new_pred_path, removed, volumetrics, record) in the order of the tasks [(entry, volumetrics)], in worker processes if workers > 1.
+    # a subject that fails has its error (None otherwise) and no outputs, the other subjects are still converted
+    # a worker converts one subject at a time, so the peak memory of the process is the peak of the subject
+    args = (prediction_folder, output_folder, link_mode, True, postprocess, label_names)
+    if workers <= 1:
+        for entry, volumetrics in tasks:
+            try:
+                yield (entry, None) + format_back_subject(entry, *args, volumetrics=volumetrics, output_format=output_format)
+            except Exception as e:
+                logging.exception('Converting back failed for subject id [{0}]'.format(entry['orig_subject']))
+                yield entry, repr(e), None, None, None, None
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=metrics.configure, initargs=(metrics.metrics_file,)) as executor:
+        futures = [(entry, executor.submit(format_back_subject, entry, *args, volumetrics=volumetrics, output_format=output_format)) for entry, volumetrics in tasks]
+        for entry, future in futures:
+            try:
+                result = future.result()
+            except Exception as e:
+                logging.exception('Converting back failed for subject id [{0}]'.format(entry['orig_subject']))
+                yield entry, repr(e), None, None, None, None
+                continue
+            yield (entry, None) + result
+
+
+def format_back(conversion_map, prediction_folder, output_folder, manifest=None, link_mode='copy', workers=1, volumetrics_file=None, postprocess=False,
+                output_format='nifti', archive_file=None):
+
+    pred_names, predicted = None, None
+    if manifest is None:
+        pred_names = get_prediction_names(prediction_folder)
+    else:
+        # predictions recorded by predict.py for this prediction_folder are used instead of crawling it, if their files are unchanged
+        predicted = manifest.get_subjects('predict', folder=prediction_folder)
+
+    table, label_names = None, None
+    if volumetrics_file is not None or postprocess or output_format != 'nifti':
+        # the label values of the organs differ between the datasets, they are taken from the dataset.json of the predictions
+        label_names = get_label_names(prediction_folder)
+    if volumetrics_file is not None:
+        table = VolumetricsTable(volumetrics_file, get_organs(label_names))
+    # the records are encoded in the workers and written by this process only
+    archive = LabelArchive(archive_file or get_archive_path(output_folder)) if output_format != 'nifti' else None
+
+    tasks = []
     subjects_with_no_predictions = []
+    subjects_archived = []
     for entry in conversion_map:
         
         orig_subject = entry['orig_subject']
-        new_subject_path = os.path.join(output_folder, orig_subject, '')
-        
         nnunet_subject = entry['nnunet_subject']
-        nnunet_pred_path = os.path.join(prediction_folder, nnunet_subject + '.nii.gz')
-        
-        new_pred_path = os.path.join(new_subject_path, 'prd.nii.gz')
 
-        if nnunet_pred_path in pred_paths:
-            logging.info('Found prediction [cnt: {0}] for subject id [{1}] and nnunet id [{2}]: {3}'.format(conversion_cnt + 1, orig_subject, nnunet_subject, new_pred_path))
-            os.makedirs(new_subject_path, exist_ok=True)
-            shutil.copy2(nnunet_pred_path, new_pred_path)
-            conversion_cnt += 1
+        if predicted is not None:
+            # the prediction must be of the same case, a case id can be given to another subject by a new conversion
+            has_prediction = predicted.get(orig_subject, {}).get('info', {}).get('nnunet_subject') == nnunet_subject
+        else:
+            has_prediction = nnunet_subject + '.nii.gz' in pred_names
+
+        if has_prediction and archive is not None and (table is None or orig_subject in table) and is_converted(orig_subject, output_folder, output_format, archive):
+            # subjects of an interrupted run that are already archived are not converted again
+            subjects_archived.append(orig_subject)
+        elif has_prediction:
+            # subjects that are already in the table are not computed again
+            tasks.append((entry, table is not None and orig_subject not in table))
         else:
             logging.info('NOT Found prediction for subject id [{0}] and nnunet id [{1}]...\n'.format(orig_subject, nnunet_subject))
             subjects_with_no_predictions.append(orig_subject)
+            if manifest is not None:
+                manifest.update(orig_subject, 'convert_back', 'failed', error='No prediction', commit=False, folder=output_folder)
+
+    conversion_cnt = 0
+    subjects_failed = []
+    for entry, error, new_pred_path, removed, row, record in map_subjects(tasks, workers, prediction_folder, output_folder, link_mode, postprocess, label_names, output_format):
+        orig_subject = entry['orig_subject']
+        if error is not None:
+            subjects_failed.append(orig_subject)
+            if manifest is not None:
+                manifest.update(orig_subject, 'convert_back', 'failed', error=error, folder=output_folder)
+            continue
+        if record is not None:
+            # committed per subject, so an error or a killed process keeps the label maps of the subjects before, as the volumetrics rows
+            archive.put(record)
+        logging.info('Found prediction [cnt: {0}] for subject id [{1}] and nnunet id [{2}]: {3}'.format(conversion_cnt + 1, orig_subject, entry['nnunet_subject'],
+                                                                                                        new_pred_path or archive.path))
+        conversion_cnt += 1
+        if manifest is not None:
+            info = {'removed_voxels': removed} if removed is not None else {}
+            if archive is not None:
+                info['archive'] = archive.path
+            manifest.update(orig_subject, 'convert_back', 'done', outputs=[new_pred_path] if new_pred_path is not None else [], info=info, folder=output_folder)
+        if row is not None:
+            table.append(row)
+
+    if archive is not None:
+        archive.close()
+    if manifest is not None:
+        manifest.commit()
     
     logging.info('Number of converted predictions: {0}\n'.format(conversion_cnt))
     logging.info('Subjects with no prediction: {0}\n'.format(subjects_with_no_predictions))
-
-
-def get_log_file(dir_path=None, basename=None):
-    file_name, file_extension  = os.path.splitext(__file__)
-    if dir_path is None and basename is None:
-        log_file_path = file_name + '_log.txt'
-    elif dir_path is not None and basename is None:
-        log_file_path = os.path.join(dir_path, os.path.basename(file_name) + '_log.txt')
-    elif dir_path is None and basename is not None:
-        log_file_path = os.path.join(os.path.dirname(file_name), basename)
-    else:
-        log_file_path = os.path.join(dir_path, basename)
-    return log_file_path
+    logging.info('Subjects that failed: {0}\n'.format(subjects_failed))
+    if archive is not None:
+        logging.info('Number of subjects that are already archived: {0}\n'.format(len(subjects_archived)))
 
 
 def main():
@@ -61,12 +196,28 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--prediction_folder', required=True, help='Folder that contains nnunet predictions')
     parser.add_argument('--output_folder', required=True, help='Folder that contains predictions with the original naming')
+    parser.add_argument('--manifest', required=False, default=None, help='SQLite file that records the state of each subject. If given, the predictions are taken from the manifest instead of prediction_folder, if their recorded files are unchanged.')
+    parser.add_argument('--link_mode', required=False, default='copy', choices=LINK_MODES, help='How predictions are placed into output_folder. Falls back to copy if linking is not possible, e.g. across filesystems.')
+    parser.add_argument('--workers', type=int, required=False, default=1, help='Number of subjects that are converted in parallel worker processes.')
+    parser.add_argument('--postprocess', action='store_true', help='Keep only the largest connected component of each organ. The removed voxels of each organ are logged and recorded in the manifest, \
+                                                                     the metrics file and the volumetrics file.')
+    parser.add_argument('--output_format', required=False, default='nifti', choices=OUTPUT_FORMATS, help='nifti writes prd.nii.gz per subject. archive stores the label maps only in archive_file, \
+                                                                                                       one bbox-cropped mask per organ, which can be read per organ and subject and exported back to NIfTI (see label_archive.py). both writes both.')
+    parser.add_argument('--archive_file', required=False, default=None, help='Label archive of the archive and both output formats. Default is labels.db in output_folder.')
+    parser.add_argument('--volumetrics_file', required=False, default=None, help='CSV file to which the voxel count, volume in ml, centroid and bounding box of each organ are appended per subject. \
+                                                                                   Subjects that are already in the file are not computed again. See volumetrics.py for a summary and the export to npz.')
+    parser.add_argument('--metrics_file', required=False, default=None, help='JSONL file to which the timing and resources of each subject are appended, see metrics.py.')
     args = parser.parse_args()
     
     prediction_folder = os.path.abspath(args.prediction_folder)
     output_folder = os.path.abspath(args.output_folder)
+    manifest = Manifest(args.manifest) if args.manifest is not None else None
+    link_mode = args.link_mode
+    workers = max(args.workers, 1)
+    metrics.configure(args.metrics_file)
     
-    log_file_path = get_log_file(basename=os.path.basename(output_folder) + '_log.txt')
+    # the temporary log is unique per process, so that concurrent runs do not write into the same file
+    log_file_path = get_log_file(__file__, basename='{0}_{1}_log.txt'.format(os.path.basename(output_folder), os.getpid()))
     logging.basicConfig(
         format='%(asctime)s: %(message)s',  
         level=logging.NOTSET, 
@@ -77,17 +228,26 @@ def main():
     
     logging.info('Started convert2original...')
     logging.info('prediction_folder: {0}'.format(prediction_folder))
-    logging.info('output_folder: {0}\n'.format(output_folder))
+    logging.info('output_folder: {0}'.format(output_folder))
+    logging.info('manifest: {0}'.format(args.manifest))
+    logging.info('link_mode: {0}'.format(link_mode))
+    logging.info('workers: {0}'.format(workers))
+    logging.info('postprocess: {0}'.format(args.postprocess))
+    logging.info('output_format: {0}'.format(args.output_format))
+    logging.info('archive_file: {0}'.format(args.archive_file))
+    logging.info('volumetrics_file: {0}'.format(args.volumetrics_file))
+    logging.info('metrics_file: {0}\n'.format(args.metrics_file))
     
     os.makedirs(output_folder, exist_ok=True)
-    conversion_map = load_pickle(os.path.join(prediction_folder, 'conversion.pkl'))
+    conversion_map = iter_conversion_map(prediction_folder)
     
-    logging.info('conversion.pkl: {0}\n'.format(os.path.join(prediction_folder, 'conversion.pkl')))
+    logging.info('conversion map: {0}\n'.format(prediction_folder))
 
-    format_back(conversion_map, prediction_folder, output_folder)
+    format_back(conversion_map, prediction_folder, output_folder, manifest, link_mode, workers, args.volumetrics_file, args.postprocess,
+                args.output_format, args.archive_file)
 
     logging.info('Finished convert2original...')
-    shutil.copy2(log_file_path, get_log_file(dir_path=output_folder, basename=os.path.basename(output_folder) + '_log.txt'))
+    shutil.copy2(log_file_path, get_log_file(__file__, dir_path=output_folder, basename=os.path.basename(output_folder) + '_log.txt'))
     os.remove(log_file_path)
 
 
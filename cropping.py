@@ -0,0 +1,92 @@
+import numpy as np
+
+from volumes import save_labels
+
+
+# extent of the abdominal organs (liv, spl, lkd, rkd, pnc) in mm above and below the lower end of the lungs.
+# the liver dome lies above the lower end of the lungs and the lower poles of the kidneys lie about 20 cm below
+ABDOMEN_EXTENT = (150.0, 250.0)
+
+
+def get_longitudinal_axis(affine):
+    # voxel axis that is closest to the superior direction of the RAS+ world coordinates
+    return int(np.argmax(np.abs(np.asarray(affine)[2, :3])))
+
+
+def get_body_mask(data):
+    # the background of the MR images is dark, the threshold is a fraction of a robust maximum
+    threshold = 0.1 * np.percentile(data[::2, ::2, ::2], 99)
+    return data > threshold
+
+
+def get_lung_profile(body, axis):
+    # area of the dark regions inside the body of each slice, the lungs are by far the largest of them
+    from scipy import ndimage
+
+    profile = np.zeros(body.shape[axis], dtype=np.int64)
+    for k in range(body.shape[axis]):
+        body_slice = np.take(body, k, axis=axis)
+        profile[k] = np.count_nonzero(ndimage.binary_fill_holes(body_slice) & ~body_slice)
+    return profile
+
+
+def find_lung_end(profile, superior_sign, min_fraction=0.2):
+    # returns the slice index of the inferior end of the lungs, or None if no lungs are found
+    if profile.max() == 0:
+        return None
+    peak = int(np.argmax(profile))
+    lungs = profile >= min_fraction * profile[peak]
+    k = peak
+    step = -superior_sign
+    while 0 <= k + step < len(profile) and lungs[k + step]:
+        k += step
+    return k
+
+
+def find_abdominal_box(img, margin=20.0, extent=ABDOMEN_EXTENT):
+    # bounding box [[start, stop], ...] in voxels of the abdominal organs with a safety margin in mm.
+    # the box is the whole body in-plane and, if the lungs are found, the abdomen along the longitudinal axis
+    data = np.asanyarray(img.dataobj)
+    affine = img.affine
+    spacing = np.sqrt((affine[:3, :3] ** 2).sum(axis=0))
+    axis = get_longitudinal_axis(affine)
+    superior_sign = 1 if affine[2, axis] > 0 else -1
+
+    body = get_body_mask(data)
+    box = [[0, n] for n in data.shape[:3]]
+
+    lung_end = find_lung_end(get_lung_profile(body, axis), superior_sign)
+    if lung_end is not None:
+        above = int(np.ceil((extent[0] + margin) / spacing[axis]))
+        below = int(np.ceil((extent[1] + margin) / spacing[axis]))
+        if superior_sign > 0:
+            start, stop = lung_end - below, lung_end + above + 1
+        else:
+            start, stop = lung_end - above, lung_end + below + 1
+        box[axis] = [max(start, 0), min(stop, data.shape[axis])]
+
+    region = tuple(slice(b[0], b[1]) for b in box)
+    indices = np.nonzero(body[region])
+    if len(indices[0]) > 0:
+        for i in range(3):
+            if i == axis:
+                continue
+            pad = int(np.ceil(margin / spacing[i]))
+            box[i] = [max(int(indices[i].min()) + box[i][0] - pad, 0), min(int(indices[i].max()) + box[i][0] + pad + 1, data.shape[i])]
+    return box
+
+
+def crop_image(img, box):
+    return img.slicer[tuple(slice(b[0], b[1]) for b in box)]
+
+
+def get_crop_record(img, box):
+    # stored in the conversion map, so that the prediction can be pasted back without the original image
+    return {'box': [list(b) for b in box], 'shape': [int(n) for n in img.shape[:3]], 'affine': np.asarray(img.affine).tolist()}
+
+
+def paste_labels(labels, header, output_path, crop):
+    # places the label map of the cropped image into an empty uint8 label map of the whole-body grid
+    full = np.zeros(crop['shape'], dtype=np.uint8)
+    full[tuple(slice(b[0], b[1]) for b in crop['box'])] = labels
+    save_labels(full, header, output_path, np.array(crop['affine']))
@@ -0,0 +1,135 @@
+import zipfile
+import logging
+
+import numpy as np
+
+
+# contrasts of a station in the order of stitch_in_process of extract_ukbb.py (inp, opp, fat, wat)
+CONTRASTS = ['in', 'opp', 'F', 'W']
+NUM_STATIONS = 6
+
+# Dixon image types of the scanner, used if the series description has no contrast suffix
+IMAGE_TYPE_CONTRASTS = {'IN_PHASE': 'in', 'OUT_PHASE': 'opp', 'FAT': 'F', 'WATER': 'W'}
+
+# slice positions of the series of one station are the same up to this tolerance in mm
+POSITION_TOLERANCE = 1.0
+
+
+def read_header(zip_ref, name):
+    # reads the header of a member without the pixel data, the member is only decompressed up to the pixel data
+    import pydicom
+    import dicom2nifti.settings
+
+    with zip_ref.open(name) as handle:
+        return pydicom.dcmread(handle, stop_before_pixels=True, force=dicom2nifti.settings.pydicom_read_force)
+
+
+def get_contrast(dicom_headers):
+    # UKBB series descriptions end with the contrast, e.g. Dixon_BH_17s_opp. None for localizers and other series
+    description = str(dicom_headers.get('SeriesDescription', ''))
+    suffix = description.rsplit('_', 1)[-1] if '_' in description else None
+    if suffix in CONTRASTS:
+        return suffix
+    for image_type in dicom_headers.get('ImageType', []):
+        if str(image_type).upper() in IMAGE_TYPE_CONTRASTS:
+            return IMAGE_TYPE_CONTRASTS[str(image_type).upper()]
+    return None
+
+
+def get_slice_position(dicom_headers):
+    # position along the slice normal
+    orientation = np.array(dicom_headers.ImageOrientationPatient, dtype=float)
+    return float(np.dot(np.cross(orientation[:3], orientation[3:]), np.array(dicom_headers.ImagePositionPatient, dtype=float)))
+
+
+def is_imaging_dicom(dicom_headers):
+    # the checks of dicom2nifti.convert_directory for single-frame images, the slices need a position and an orientation
+    try:
+        return ('SeriesInstanceUID' in dicom_headers and 'InstanceNumber' in dicom_headers and
+                len(dicom_headers.get('ImageOrientationPatient') or []) >= 6 and len(dicom_headers.get('ImagePositionPatient') or []) >= 3)
+    except (KeyError, AttributeError):
+        return False
+
+
+def read_series(zip_ref):
+    # {series uid: {'number', 'contrast', 'headers', 'members', 'positions'}} of the imaging series of the zip file
+    import pydicom
+
+    series = {}
+    for name in zip_ref.namelist():
+        if name.endswith('/'):
+            continue
+        try:
+            dicom_headers = read_header(zip_ref, name)
+        except pydicom.errors.InvalidDicomError:
+            continue
+        if not is_imaging_dicom(dicom_headers):
+            continue
+        entry = series.setdefault(dicom_headers.SeriesInstanceUID, {
+            'number': int(dicom_headers.get('SeriesNumber', 0) or 0),
+            'contrast': get_contrast(dicom_headers),
+            'header': dicom_headers,
+            'members': [],
+            'positions': [],
+        })
+        entry['members'].append(name)
+        entry['positions'].append(get_slice_position(dicom_headers))
+    return series
+
+
+def get_station_extent(entry):
+    positions = entry['positions']
+    return min(positions), max(positions), len(positions)
+
+
+def group_stations(series):
+    # the series of one station cover the same slices. returns {uid: station number}, neighbours in the sorted extents
+    # are in the same station if they differ by at most POSITION_TOLERANCE, also if they are on either side of a rounding boundary
+    stations = {}
+    station, previous = -1, None
+    for uid in sorted(series, key=lambda uid: get_station_extent(series[uid])):
+        extent = get_station_extent(series[uid])
+        if previous is None or extent[2] != previous[2] or abs(extent[0] - previous[0]) > POSITION_TOLERANCE or abs(extent[1] - previous[1]) > POSITION_TOLERANCE:
+            station += 1
+        stations[uid] = station
+        previous = extent
+    return stations
+
+
+def select_series(series, num_stations=NUM_STATIONS):
+    # returns the series of the stations in acquisition order, each with the contrasts in the order of CONTRASTS.
+    # raises ValueError if the stations are not complete, before any pixel data is read
+    for uid, entry in series.items():
+        if entry['contrast'] is None:
+            logging.warning('Skipping series {0} ({1}) without a Dixon contrast'.format(entry['number'], entry['header'].get('SeriesDescription', '')))
+    series = {uid: entry for uid, entry in series.items() if entry['contrast'] is not None}
+
+    stations = {}
+    for uid, station_no in group_stations(series).items():
+        entry = series[uid]
+        station = stations.setdefault(station_no, {})
+        previous = station.get(entry['contrast'])
+        # a repeated series replaces the earlier one
+        if previous is None or entry['number'] > previous['number']:
+            if previous is not None:
+                logging.warning('Skipping series {0}, it is repeated by series {1}'.format(previous['number'], entry['number']))
+            station[entry['contrast']] = entry
+        else:
+            logging.warning('Skipping series {0}, it is repeated by series {1}'.format(entry['number'], previous['number']))
+
+    complete = []
+    for key, station in stations.items():
+        if all(contrast in station for contrast in CONTRASTS):
+            complete.append(station)
+        else:
+            logging.warning('Skipping incomplete station with the contrasts {0}'.format(sorted(station)))
+    if len(complete) != num_stations:
+        raise ValueError('Found {0} complete stations instead of {1}'.format(len(complete), num_stations))
+
+    complete.sort(key=lambda station: min(entry['number'] for entry in station.values()))
+    return [station[contrast] for station in complete for contrast in CONTRASTS]
+
+
+def classify_zip(zip_file, num_stations=NUM_STATIONS):
+    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+        return select_series(read_series(zip_ref), num_stations)
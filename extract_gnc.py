@@ -2,20 +2,17 @@ import sys
 import argparse
 import logging
 import shutil
-import glob
 import os
 
-def is_stitching_correct(subject_dir):
-    sub_exists = os.path.isdir(subject_dir)
-    wat_exists = os.path.isfile(os.path.join(subject_dir, 'wat.nii.gz'))
-    inp_exists = os.path.isfile(os.path.join(subject_dir, 'inp.nii.gz'))
-    opp_exists = os.path.isfile(os.path.join(subject_dir, 'opp.nii.gz'))
-    fat_exists = os.path.isfile(os.path.join(subject_dir, 'fat.nii.gz'))
-    
-    return sub_exists and wat_exists and inp_exists and opp_exists and fat_exists
+from manifest import Manifest
+from indexer import DirectoryIndex
+from linking import link_file, LINK_MODES
+import metrics
+from common import get_log_file, is_stitching_correct
+from volumes import INTERMEDIATE_FORMATS, get_volume_path, find_volumes, save_volume, load_volume
 
 
-def rename_files(subject_dir, new_subject_dir):
+def rename_files(subject_dir, new_subject_dir, link_mode='copy', intermediate_format='nii.gz', gzip_level=None):
     def find_instances(files, key):
         key_instances = []
         for f in files:
@@ -24,12 +21,16 @@ def rename_files(subject_dir, new_subject_dir):
                 key_instances.append(f)
         return key_instances
     
-    files = glob.glob(os.path.join(subject_dir, '*.nii.gz'))
+    files = [entry.path for entry in os.scandir(subject_dir) if entry.name.endswith('.nii.gz') and entry.is_file()]
     for key in ['wat', 'opp', 'in', 'fat']:
         key_instances = find_instances(files, key)
         key = key + 'p' if key == 'in' else key
         if len(key_instances) == 1:
-            shutil.copy2(key_instances[0], os.path.join(new_subject_dir, key + '.nii.gz'))
+            if intermediate_format == 'nii.gz' and gzip_level is None:
+                link_file(key_instances[0], os.path.join(new_subject_dir, key + '.nii.gz'), link_mode)
+            else:
+                # decompressed (or recompressed) once here instead of in every later step
+                save_volume(load_volume(key_instances[0]), get_volume_path(new_subject_dir, key, intermediate_format), gzip_level)
         elif len(key_instances) == 0:
             logging.error('Error: No files for {0} at the directory {1}'.format(key, subject_dir))
             return False
@@ -40,26 +41,36 @@ def rename_files(subject_dir, new_subject_dir):
     return True
 
 
-def get_log_file(dir_path=None, basename=None):
-    file_name, file_extension  = os.path.splitext(__file__)
-    if dir_path is None and basename is None:
-        log_file_path = file_name + '_log.txt'
-    elif dir_path is not None and basename is None:
-        log_file_path = os.path.join(dir_path, os.path.basename(file_name) + '_log.txt')
-    elif dir_path is None and basename is not None:
-        log_file_path = os.path.join(os.path.dirname(file_name), basename)
-    else:
-        log_file_path = os.path.join(dir_path, basename)
-    return log_file_path
+def format_subject(sub_dir, nifti_folder, link_mode='copy', intermediate_format='nii.gz', gzip_level=None):
+    # assumed the directory name describes the subject ID
+    sub_id = os.path.basename(os.path.dirname(sub_dir))
+    logging.warning('Currently formatting subject id [{0}]: {1}'.format(sub_id, sub_dir))
+    new_sub_dir = os.path.join(nifti_folder, sub_id, '')
+    with metrics.measure(sub_id, 'extract') as measurement:
+        os.makedirs(new_sub_dir, exist_ok=True)
+        is_rename_success = rename_files(sub_dir, new_sub_dir, link_mode, intermediate_format, gzip_level)
+        is_stitch_success = is_stitching_correct(new_sub_dir)
+        if not (is_rename_success and is_stitch_success):
+            shutil.rmtree(new_sub_dir)
+            measurement.outcome = 'failed'
+    return sub_id, is_rename_success and is_stitch_success
 
 
 def main():
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--zip_folder', required=True, help='Folder that contains downloaded zip files for each subject')
-    parser.add_argument('--nifti_folder', required=True, help='Folder that contains subjects with stitched volumes as .nii.gz files')
+    parser.add_argument('--nifti_folder', required=True, help='Folder that contains subjects with stitched volumes as .nii.gz, .nii or .npy files')
     parser.add_argument('--num_subjects', type=int, required=False, default=-1, help='Subjects are firstly ordered. Then, they are selected from index [start_idx] to index [start_idx + num_subjects]. If zero or less, all subjects from index [start_idx] to the end.')
     parser.add_argument('--start_idx', type=int, required=False, default=0, help='Subjects are firstly ordered. Then, they are selected from index [start_idx] to index [start_idx + num_subjects].')
+    parser.add_argument('--manifest', required=False, default=None, help='SQLite file that records the state of each subject. Subjects that are already formatted according to the manifest are skipped, if their recorded files are unchanged.')
+    parser.add_argument('--index_folder', required=False, default=None, help='Folder for snapshots of the directory listings. A folder is only listed again if its modification time has changed, e.g. when subjects are added. \
+                                                                                                Default is one listing per run without snapshots.')
+    parser.add_argument('--link_mode', required=False, default='copy', choices=LINK_MODES, help='How files are placed into nifti_folder. Falls back to copy if linking is not possible, e.g. across filesystems.')
+    parser.add_argument('--intermediate_format', required=False, default='nii.gz', choices=INTERMEDIATE_FORMATS, help='Format of the volumes in nifti_folder. nii.gz files are linked or copied (see link_mode), \
+                                                                                                                   nii and npy are decompressed once and are read with memory mapping by convert2nnunet.py.')
+    parser.add_argument('--gzip_level', type=int, required=False, default=None, choices=range(10), help='Compression level of nii.gz, 0 (no compression) to 9. If given, nii.gz files are recompressed instead of linked.')
+    parser.add_argument('--metrics_file', required=False, default=None, help='JSONL file to which the timing and resources of each subject are appended, see metrics.py.')
     
     args = parser.parse_args()
 
@@ -67,8 +78,14 @@ def main():
     nifti_folder = os.path.abspath(args.nifti_folder)
     num_subjects = args.num_subjects
     start_idx = args.start_idx
+    manifest = Manifest(args.manifest) if args.manifest is not None else None
+    link_mode = args.link_mode
+    metrics.configure(args.metrics_file)
+    intermediate_format = args.intermediate_format
+    gzip_level = args.gzip_level
     
-    log_file_path = get_log_file(basename=os.path.basename(nifti_folder) + '_log.txt')
+    # the temporary log is unique per process, so that concurrent runs do not write into the same file
+    log_file_path = get_log_file(__file__, basename='{0}_{1}_log.txt'.format(os.path.basename(nifti_folder), os.getpid()))
     logging.basicConfig(
         format='%(asctime)s: %(message)s',  
         level=logging.WARNING, 
@@ -81,9 +98,17 @@ def main():
     logging.warning('zip_folder: {0}'.format(zip_folder))
     logging.warning('nifti_folder: {0}'.format(nifti_folder))
     logging.warning('num_subjects: {0}'.format(num_subjects))
-    logging.warning('start_idx: {0}\n'.format(start_idx))
+    logging.warning('start_idx: {0}'.format(start_idx))
+    logging.warning('manifest: {0}'.format(args.manifest))
+    logging.warning('index_folder: {0}'.format(args.index_folder))
+    logging.warning('link_mode: {0}'.format(link_mode))
+    logging.warning('intermediate_format: {0}'.format(intermediate_format))
+    logging.warning('gzip_level: {0}'.format(gzip_level))
+    logging.warning('metrics_file: {0}\n'.format(args.metrics_file))
     
-    subject_dirs = sorted(glob.glob(os.path.join(zip_folder, '*/')))
+    index = DirectoryIndex(zip_folder, args.index_folder)
+    subject_dirs = index.dirs()
+    index.save()
     if start_idx < 0:
         start_idx = 0
     if num_subjects > 0 and start_idx + num_subjects <= len(subject_dirs):
@@ -91,23 +116,25 @@ def main():
     else:
         subject_dirs = subject_dirs[start_idx:]
 
+    if manifest is not None:
+        extracted = manifest.get_subjects('extract', folder=nifti_folder)
+        logging.warning('Already formatted subjects in the manifest: {0}'.format(len([d for d in subject_dirs if os.path.basename(os.path.dirname(d)) in extracted])))
+        subject_dirs = [d for d in subject_dirs if os.path.basename(os.path.dirname(d)) not in extracted]
+
     logging.warning('Number of subjects will be converted: {0}\n'.format(len(subject_dirs)))
 
     os.makedirs(nifti_folder, exist_ok=True)
 
     for sub_dir in subject_dirs:
-        # assumed the directory name describes the subject ID
-        sub_id = os.path.basename(os.path.dirname(sub_dir))
-        logging.warning('Currently formatting subject id [{0}]: {1}'.format(sub_id, sub_dir))
+        sub_id, is_success = format_subject(sub_dir, nifti_folder, link_mode, intermediate_format, gzip_level)
         new_sub_dir = os.path.join(nifti_folder, sub_id, '')
-        os.makedirs(new_sub_dir, exist_ok=True)
-        is_rename_success = rename_files(sub_dir, new_sub_dir)
-        is_stitch_success = is_stitching_correct(new_sub_dir)
-        if not (is_rename_success and is_stitch_success):
-            shutil.rmtree(new_sub_dir)
+        if manifest is not None:
+            volumes = find_volumes(new_sub_dir, ['wat', 'opp', 'fat', 'inp'])
+            outputs = [volumes[m] or os.path.join(new_sub_dir, m + '.nii.gz') for m in ['wat', 'opp', 'fat', 'inp']]
+            manifest.update(sub_id, 'extract', 'done' if is_success else 'failed', outputs=outputs, info={'source': sub_dir}, folder=nifti_folder)
         
     logging.warning('Finished extract_gnc...')
-    shutil.copy2(log_file_path, get_log_file(dir_path=nifti_folder, basename=os.path.basename(nifti_folder) + '_log.txt'))
+    shutil.copy2(log_file_path, get_log_file(__file__, dir_path=nifti_folder, basename=os.path.basename(nifti_folder) + '_log.txt'))
     os.remove(log_file_path)
 
 if __name__ == '__main__':
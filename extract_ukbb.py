@@ -1,43 +1,30 @@
 import sys
 import argparse
-import dicom2nifti
 import subprocess
 import zipfile
 import logging
+import io
+import re
+import unicodedata
 import shutil
 import glob
-import re
+import tempfile
 import os
 import urllib.request
 
+import metrics
+from common import get_log_file, is_stitching_correct
+from dicom_series import classify_zip, NUM_STATIONS, CONTRASTS
+from volumes import INTERMEDIATE_FORMATS, get_volume_path, find_volumes, save_volume, load_volume
 
-def tryint(s):
-    try:
-        return int(s)
-    except:
-        return s
-
-
-def alphanum_key(s):
-    return [tryint(c) for c in re.split('([0-9]+)', s) ]
-
-
-def sort_nicely(l):
-    l.sort(key=alphanum_key)
-
+from manifest import Manifest
+from indexer import DirectoryIndex
 
-def is_stitching_correct(subject_dir):
-    sub_exists = os.path.isdir(subject_dir)
-    wat_exists = os.path.isfile(os.path.join(subject_dir, 'wat.nii.gz'))
-    inp_exists = os.path.isfile(os.path.join(subject_dir, 'inp.nii.gz'))
-    opp_exists = os.path.isfile(os.path.join(subject_dir, 'opp.nii.gz'))
-    fat_exists = os.path.isfile(os.path.join(subject_dir, 'fat.nii.gz'))
-    
-    return sub_exists and wat_exists and inp_exists and opp_exists and fat_exists
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
 def rename_and_filter_files(subject_dir):
-    files = glob.glob(os.path.join(subject_dir, '*.nii.gz'))
+    files = [entry.path for entry in os.scandir(subject_dir) if entry.name.endswith('.nii.gz') and entry.is_file()]
     for f in files:
         f_base = os.path.basename(f)
         if f_base == 'T1_water.nii.gz':
@@ -53,8 +40,130 @@ def rename_and_filter_files(subject_dir):
         shutil.rmtree(subject_dir)
 
 
-def stitch(zip_file, subject_dir, subject_id, tool):
+def clean_filename(name):
+    # ascii file name without accents, spaces and special characters, as the file names of dicom2nifti.convert_directory
+    name = unicodedata.normalize('NFKD', name.replace(' ', '_')).encode('ascii', 'ignore').decode('ascii')
+    name = re.sub(r'[^\w\s-]', '', name.strip().lower())
+    return re.sub(r'[-\s]+', '-', name)
+
+
+def get_series_basename(dicom_headers, compression=True):
+    # same naming as dicom2nifti.convert_directory
+    base_filename = ''
+    if 'SeriesNumber' in dicom_headers:
+        base_filename = clean_filename('%s' % dicom_headers.SeriesNumber)
+        if 'SeriesDescription' in dicom_headers:
+            base_filename = clean_filename('%s_%s' % (base_filename, dicom_headers.SeriesDescription))
+        elif 'SequenceName' in dicom_headers:
+            base_filename = clean_filename('%s_%s' % (base_filename, dicom_headers.SequenceName))
+        elif 'ProtocolName' in dicom_headers:
+            base_filename = clean_filename('%s_%s' % (base_filename, dicom_headers.ProtocolName))
+    else:
+        base_filename = clean_filename(dicom_headers.SeriesInstanceUID)
+    return base_filename + ('.nii.gz' if compression else '.nii')
+
+
+def reorient_to_las(nii_image):
+    # same orientation as the reorientation of dicom2nifti, which can only write the result to a file
+    import nibabel as nib
+
+    ornt = nib.orientations.ornt_transform(nib.orientations.io_orientation(nii_image.affine), nib.orientations.axcodes2ornt('LAS'))
+    nii_image = nii_image.as_reoriented(ornt)
+    nii_image.header.set_slope_inter(1, 0)
+    nii_image.header.set_xyzt_units(2)
+    return nii_image
+
+
+def load_series_from_zip(zip_file, selected):
+    # reads the DICOMs of the selected series (see dicom_series.py) directly from the zip into memory, nothing is extracted to disk
+    import pydicom
+    import dicom2nifti.convert_dicom
+    import dicom2nifti.settings
+
+    nii_images = []
+    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+        for entry in selected:
+            series_name = get_series_basename(entry['header'])
+            # the datasets of a series are released as soon as it is converted to keep the peak memory low
+            dicoms = [pydicom.dcmread(io.BytesIO(zip_ref.read(name)), force=dicom2nifti.settings.pydicom_read_force) for name in entry['members']]
+            try:
+                nii_image = dicom2nifti.convert_dicom.dicom_array_to_nifti(dicoms, None, reorient_nifti=False)['NII']
+                nii_images.append((series_name, reorient_to_las(nii_image)))
+            except Exception:
+                # the subject is then rejected for its missing station, the cause is only in the traceback
+                logging.warning('Unable to convert series {0} of {1}'.format(series_name, zip_file), exc_info=True)
+    return nii_images
+
+
+def iter_contrasts(nii_images):
+    # the six stations of each contrast of the 24 series in station order (see dicom_series.py)
+    for k in range(len(CONTRASTS)):
+        yield nii_images[k::len(CONTRASTS)]
+
+
+def iter_contrasts_from_zip(zip_file, selected, subject_id=None):
+    # the series of one contrast are decoded at a time, so only six of the 24 series are in memory
+    for k in range(len(CONTRASTS)):
+        with metrics.measure(subject_id, 'read_dicom', contrast=CONTRASTS[k]):
+            nii_images = [nii_image for _, nii_image in load_series_from_zip(zip_file, selected[k::len(CONTRASTS)])]
+        yield nii_images
+        del nii_images
+
+
+def convert_series(dicom_dir, selected, subject_dir, compression):
+    # the same conversion as dicom2nifti.convert_directory, but only of the selected series and in their order
+    import pydicom
+    import dicom2nifti.convert_dicom
+    import dicom2nifti.settings
+
+    nii_files = []
+    for entry in selected:
+        nii_file = get_series_basename(entry['header'], compression)
+        dicoms = [pydicom.dcmread(os.path.join(dicom_dir, name), defer_size='1 KB', force=dicom2nifti.settings.pydicom_read_force) for name in entry['members']]
+        try:
+            dicom2nifti.convert_dicom.dicom_array_to_nifti(dicoms, os.path.join(subject_dir, nii_file), True)
+            nii_files.append(nii_file)
+        except Exception:
+            logging.warning('Unable to convert series {0} of {1}'.format(nii_file, dicom_dir), exc_info=True)
+    return nii_files
+
+
+def stitch_with_tool(subject_dir, nii_files, tool, margin):
     out_fnames = ['T1_in.nii.gz', 'T1_opp.nii.gz', 'T1_fat.nii.gz', 'T1_water.nii.gz',]
+    for k in range(4):
+        output_image = os.path.join(subject_dir, out_fnames[k])
+        input_images = os.path.join(subject_dir, nii_files[k])
+        for f in range(1, 6):
+            input_images += ' ' + os.path.join(subject_dir, nii_files[k+f*4])
+
+        command = ' '.join((tool, '-a -m', str(margin), '-i', input_images, '-o', output_image))
+        process = subprocess.Popen(command.split(), stdout=subprocess.PIPE)
+        output, error = process.communicate()
+        logging.warning('Output [{0}]: {1}'.format(out_fnames[k], str(output)))
+        logging.error('Error [{0}]: {1}'.format(out_fnames[k], str(error)))
+
+
+def stitch_in_process(subject_dir, contrasts, margin, subject_id=None, intermediate_format='nii.gz', gzip_level=None):
+    import stitcher
+
+    out_fnames = ['inp', 'opp', 'fat', 'wat',]
+    # all contrasts are acquired with the same station geometry, so it is computed once and reused
+    geometry = None
+    for k, station_images in enumerate(contrasts):
+        if len(station_images) != NUM_STATIONS:
+            logging.warning('Insufficient stations for subject id [{0}]...\n'.format(subject_id))
+            return
+        with metrics.measure(subject_id, 'stitch', contrast=out_fnames[k]):
+            stitched, geometry = stitcher.stitch_images(station_images, geometry=geometry, margin=margin)
+        # writing is measured separately, since gzip is a large part of it
+        with metrics.measure(subject_id, 'write', contrast=out_fnames[k]):
+            save_volume(stitched, get_volume_path(subject_dir, out_fnames[k], intermediate_format), gzip_level)
+        logging.warning('Stitched [{0}]: {1} {2}'.format(out_fnames[k], stitched.shape, stitched.get_data_dtype()))
+        # the contrast is released before the next one is read
+        del station_images, stitched
+
+
+def stitch(zip_file, subject_dir, subject_id, tool=None, scratch_dir=None, in_memory=False, intermediate_format='nii.gz', gzip_level=None, low_memory=False):
     margin = 3
     
     if not is_stitching_correct(subject_dir):
@@ -63,34 +172,67 @@ def stitch(zip_file, subject_dir, subject_id, tool):
         
         if os.path.exists(subject_dir):
             shutil.rmtree(subject_dir)
+
+        # only the headers are read to find the 24 series of the stations, a subject without them is rejected before any pixel data is decoded
+        try:
+            with metrics.measure(subject_id, 'classify'):
+                selected = classify_zip(zip_file)
+        except ValueError as e:
+            logging.warning('Rejected subject id [{0}]: {1}\n'.format(subject_id, e))
+            return 'failed'
         os.makedirs(subject_dir, exist_ok=True)
        
-        dicom_dir = os.path.join(subject_dir, 'dcm')
-        os.makedirs(dicom_dir, exist_ok=True)
-
-        zip_ref = zipfile.ZipFile(zip_file, 'r')
-        zip_ref.extractall(dicom_dir)
-        zip_ref.close()
-
-        dicom2nifti.convert_directory(dicom_dir, subject_dir)
-        shutil.rmtree(dicom_dir)
-
-        nii_files = [name for name in os.listdir(subject_dir) 
-                if os.path.isfile(os.path.join(subject_dir, name))]
-        sort_nicely(nii_files)
-
-        if len(nii_files) >= 24:
-            for k in range(4):
-                output_image = os.path.join(subject_dir, out_fnames[k])
-                input_images = os.path.join(subject_dir, nii_files[k])
-                for f in range(1, 6):
-                    input_images += ' ' + os.path.join(subject_dir, nii_files[k+f*4])
-
-                command = ' '.join((tool, '-a -m', str(margin), '-i', input_images, '-o', output_image))
-                process = subprocess.Popen(command.split(), stdout=subprocess.PIPE)
-                output, error = process.communicate()
-                logging.warning('Output [{0}]: {1}'.format(out_fnames[k], str(output)))
-                logging.error('Error [{0}]: {1}'.format(out_fnames[k], str(error)))     
+        nii_files = []
+        contrasts = None
+        if in_memory and low_memory and tool is None:
+            # the series are decoded while the contrasts are stitched
+            contrasts = iter_contrasts_from_zip(zip_file, selected, subject_id)
+        elif in_memory:
+            nii_names, nii_images = [], []
+            with metrics.measure(subject_id, 'read_dicom'):
+                for nii_name, nii_image in load_series_from_zip(zip_file, selected):
+                    nii_names.append(nii_name)
+                    nii_images.append(nii_image)
+            if tool is not None:
+                # the external stitching tool can only read files
+                for nii_name, nii_image in zip(nii_names, nii_images):
+                    nii_image.header.set_slope_inter(1, 0)
+                    nii_image.header.set_xyzt_units(2)
+                    nii_image.to_filename(os.path.join(subject_dir, nii_name))
+                nii_files = nii_names
+        else:
+            # DICOMs are extracted to scratch_dir if given (e.g. a node-local disk), otherwise next to the outputs
+            if scratch_dir is None:
+                dicom_dir = os.path.join(subject_dir, 'dcm')
+            else:
+                dicom_dir = os.path.join(scratch_dir, subject_id, 'dcm')
+            if os.path.exists(dicom_dir):
+                shutil.rmtree(dicom_dir)
+            os.makedirs(dicom_dir, exist_ok=True)
+
+            with metrics.measure(subject_id, 'unzip'):
+                with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+                    for entry in selected:
+                        for name in entry['members']:
+                            zip_ref.extract(name, dicom_dir)
+
+            with metrics.measure(subject_id, 'dicom2nifti'):
+                # the station files are deleted after stitching, they are only compressed for the nii.gz format
+                nii_files = convert_series(dicom_dir, selected, subject_dir, compression=intermediate_format == 'nii.gz' or tool is not None)
+            shutil.rmtree(dicom_dir)
+            if scratch_dir is not None:
+                shutil.rmtree(os.path.join(scratch_dir, subject_id), ignore_errors=True)
+
+            nii_images = [load_volume(os.path.join(subject_dir, name)) for name in nii_files]
+
+        if contrasts is not None:
+            stitch_in_process(subject_dir, contrasts, margin, subject_id, intermediate_format, gzip_level)
+        elif len(nii_images) == NUM_STATIONS * len(CONTRASTS):
+            if tool is None:
+                stitch_in_process(subject_dir, iter_contrasts(nii_images), margin, subject_id, intermediate_format, gzip_level)
+            else:
+                with metrics.measure(subject_id, 'stitch', tool=tool):
+                    stitch_with_tool(subject_dir, nii_files, tool, margin)
         else:
             logging.warning('Insufficient stations for subject id [{0}]...\n'.format(subject_id))
 
@@ -99,30 +241,114 @@ def stitch(zip_file, subject_dir, subject_id, tool):
             
         rename_and_filter_files(subject_dir)
         
+        return 'converted' if is_stitching_correct(subject_dir) else 'failed'
     else:
         logging.warning('Already converted subject id [{0}]...\n'.format(subject_id))
+        return 'skipped'
 
 
-def get_log_file(dir_path=None, basename=None):
-    file_name, file_extension  = os.path.splitext(__file__)
-    if dir_path is None and basename is None:
-        log_file_path = file_name + '_log.txt'
-    elif dir_path is not None and basename is None:
-        log_file_path = os.path.join(dir_path, os.path.basename(file_name) + '_log.txt')
-    elif dir_path is None and basename is not None:
-        log_file_path = os.path.join(os.path.dirname(file_name), basename)
-    else:
-        log_file_path = os.path.join(dir_path, basename)
-    return log_file_path
+def get_subject_id(zip_file):
+    # assumed the first part of the file name describes the subject ID
+    return os.path.basename(zip_file).split('_')[0] + '_' + os.path.basename(zip_file).split('_')[2]
+
+
+def record_subject(manifest, nifti_folder, subject_id, status, error=None):
+    if manifest is None:
+        return
+    subject_dir = os.path.join(nifti_folder, subject_id, '')
+    volumes = find_volumes(subject_dir, ['wat', 'opp', 'fat', 'inp'])
+    outputs = [volumes[m] or os.path.join(subject_dir, m + '.nii.gz') for m in ['wat', 'opp', 'fat', 'inp']]
+    manifest.update(subject_id, 'extract', 'failed' if status == 'failed' else 'done', outputs=outputs, error=error, folder=nifti_folder)
+
+
+def init_worker(log_folder, metrics_file=None):
+    # every worker process writes to its own log file, they are merged into the main log at the end
+    metrics.configure(metrics_file)
+    logging.basicConfig(
+        format='%(asctime)s: %(message)s',
+        level=logging.WARNING,
+        handlers=[logging.FileHandler(filename=os.path.join(log_folder, 'worker_{0}_log.txt'.format(os.getpid())), mode='w', encoding='utf-8')],
+        force=True)
+
+
+def stitch_worker(zip_file, nifti_folder, tool, scratch_folder, in_memory, intermediate_format='nii.gz', gzip_level=None, low_memory=False):
+    subject_id = get_subject_id(zip_file)
+    subject_dir = os.path.join(nifti_folder, subject_id, '')
+    scratch_dir = os.path.join(scratch_folder, 'worker_{0}'.format(os.getpid()))
+    try:
+        # a worker converts one subject at a time, so the peak memory of the process is the peak of the subject
+        with metrics.measure(subject_id, 'extract', reset_peak=True) as measurement:
+            measurement.outcome = stitch(zip_file, subject_dir, subject_id, tool, scratch_dir=scratch_dir, in_memory=in_memory,
+                                         intermediate_format=intermediate_format, gzip_level=gzip_level, low_memory=low_memory)
+        logging.warning('Peak memory of subject id [{0}]: {1:.0f} MB'.format(subject_id, measurement.peak_rss_mb))
+        return subject_id, measurement.outcome, None
+    except Exception as e:
+        logging.exception('Failed subject id [{0}]'.format(subject_id))
+        shutil.rmtree(subject_dir, ignore_errors=True)
+        shutil.rmtree(os.path.join(scratch_dir, subject_id), ignore_errors=True)
+        return subject_id, 'failed', repr(e)
+
+
+def stitch_parallel(zip_files, nifti_folder, tool, workers, scratch_folder, in_memory, manifest=None, metrics_file=None, intermediate_format='nii.gz', gzip_level=None,
+                    low_memory=False):
+    # the run only works in its own folder, the scratch_folder may be shared with other runs or contain other files
+    os.makedirs(scratch_folder, exist_ok=True)
+    run_folder = tempfile.mkdtemp(prefix='run_', dir=scratch_folder)
+    log_folder = os.path.join(run_folder, 'logs')
+    os.makedirs(log_folder, exist_ok=True)
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(log_folder, metrics_file)) as executor:
+        futures = {executor.submit(stitch_worker, f, nifti_folder, tool, run_folder, in_memory, intermediate_format, gzip_level, low_memory): f for f in zip_files}
+        for future in as_completed(futures):
+            try:
+                subject_id, status, error = future.result()
+            except Exception as e:
+                subject_id, status, error = get_subject_id(futures[future]), 'failed', repr(e)
+            results.append((subject_id, status, error))
+            record_subject(manifest, nifti_folder, subject_id, status, error)
+            logging.warning('[{0}/{1}] subject id [{2}]: {3}'.format(len(results), len(zip_files), subject_id, status))
+
+    for log_file in sorted(glob.glob(os.path.join(log_folder, 'worker_*_log.txt'))):
+        with open(log_file, 'r', encoding='utf-8') as handle:
+            logging.warning('Log of {0}:\n{1}'.format(os.path.basename(log_file), handle.read()))
+    shutil.rmtree(run_folder, ignore_errors=True)
+
+    return results
+
+
+def get_stitching_tool():
+    # the external stitching tool is downloaded next to the script on first use
+    tool = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stitching')
+    if not os.path.isfile(tool):
+        logging.warning('Downloading stitching tool...\n')
+        urllib.request.urlretrieve('https://gitlab.com/turkaykart/ukbb-gnc-abdominal-segmentation/-/raw/main/stitching?inline=false', tool)
+        os.chmod(tool, 0o755)
+    return tool
 
 
 def main():
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--zip_folder', required=True, help='Folder that contains downloaded zip files for each subject')
-    parser.add_argument('--nifti_folder', required=True, help='Folder that contains subjects with stitched volumes as .nii.gz files')
+    parser.add_argument('--nifti_folder', required=True, help='Folder that contains subjects with stitched volumes as .nii.gz, .nii or .npy files')
     parser.add_argument('--num_subjects', type=int, required=False, default=-1, help='Subjects are firstly ordered. Then, they are selected from index [start_idx] to index [start_idx + num_subjects]. If zero or less, all subjects from index [start_idx] to the end.')
     parser.add_argument('--start_idx', type=int, required=False, default=0, help='Subjects are firstly ordered. Then, they are selected from index [start_idx] to index [start_idx + num_subjects].')
+    parser.add_argument('--workers', type=int, required=False, default=1, help='Number of subjects that are converted in parallel worker processes.')
+    parser.add_argument('--stitching', required=False, default='tool', choices=['tool', 'numpy'], help='Stitch the stations with the external stitching tool (default) or in-process with NumPy. \
+                                                                                                 benchmarks/compare_stitching.py compares both on a sample subject.')
+    parser.add_argument('--in_memory', action='store_true', help='Read DICOMs directly from the zip files into memory instead of extracting them to disk.')
+    parser.add_argument('--low_memory', action='store_true', help='With --in_memory and --stitching numpy, decode and stitch the series of one contrast at a time instead of all 24 series at once. \
+                                                                   Lowers the peak memory of a subject at the cost of reading the zip file once per contrast.')
+    parser.add_argument('--manifest', required=False, default=None, help='SQLite file that records the state of each subject. Subjects that are already converted according to the manifest are skipped, if their recorded files are unchanged.')
+    parser.add_argument('--index_folder', required=False, default=None, help='Folder for snapshots of the directory listings. A folder is only listed again if its modification time has changed, e.g. when subjects are added. \
+                                                                                                Default is one listing per run without snapshots.')
+    parser.add_argument('--intermediate_format', required=False, default='nii', choices=INTERMEDIATE_FORMATS, help='Format of the stitched volumes in nifti_folder. \
+                                                                                                                nii and npy are not compressed and are read with memory mapping by convert2nnunet.py. \
+                                                                                                                The stitching tool always writes nii.gz.')
+    parser.add_argument('--gzip_level', type=int, required=False, default=None, choices=range(10), help='Compression level of nii.gz, 0 (no compression) to 9. Default is the level of nibabel.')
+    parser.add_argument('--metrics_file', required=False, default=None, help='JSONL file to which the timing and resources of each subject and step are appended, see metrics.py.')
+    parser.add_argument('--scratch_folder', required=False, default=None, help='Folder for temporary files of the workers (e.g. a node-local disk). Default is a hidden folder in nifti_folder.')
     
     args = parser.parse_args()
 
@@ -130,8 +356,18 @@ def main():
     nifti_folder = os.path.abspath(args.nifti_folder)
     num_subjects = args.num_subjects
     start_idx = args.start_idx
+    workers = max(args.workers, 1)
+    in_memory = args.in_memory
+    low_memory = args.low_memory
+    metrics.configure(args.metrics_file)
+    intermediate_format = args.intermediate_format
+    gzip_level = args.gzip_level
+    stitching = args.stitching
+    manifest = Manifest(args.manifest) if args.manifest is not None else None
+    scratch_folder = os.path.abspath(args.scratch_folder) if args.scratch_folder is not None else os.path.join(nifti_folder, '.scratch')
     
-    log_file_path = get_log_file(basename=os.path.basename(nifti_folder) + '_log.txt')
+    # the temporary log is unique per process, so that concurrent runs do not write into the same file
+    log_file_path = get_log_file(__file__, basename='{0}_{1}_log.txt'.format(os.path.basename(nifti_folder), os.getpid()))
     logging.basicConfig(
         format='%(asctime)s: %(message)s',  
         level=logging.WARNING, 
@@ -144,10 +380,20 @@ def main():
     logging.warning('zip_folder: {0}'.format(zip_folder))
     logging.warning('nifti_folder: {0}'.format(nifti_folder))
     logging.warning('num_subjects: {0}'.format(num_subjects))
-    logging.warning('start_idx: {0}\n'.format(start_idx))
+    logging.warning('start_idx: {0}'.format(start_idx))
+    logging.warning('workers: {0}'.format(workers))
+    logging.warning('in_memory: {0}'.format(in_memory))
+    logging.warning('low_memory: {0}'.format(low_memory))
+    logging.warning('stitching: {0}'.format(stitching))
+    logging.warning('intermediate_format: {0}'.format(intermediate_format))
+    logging.warning('gzip_level: {0}'.format(gzip_level))
+    logging.warning('manifest: {0}'.format(args.manifest))
+    logging.warning('index_folder: {0}'.format(args.index_folder))
+    logging.warning('metrics_file: {0}\n'.format(args.metrics_file))
     
-    zip_files = glob.glob(os.path.join(zip_folder, '*_20201_*.zip'))
-    zip_files.sort()
+    index = DirectoryIndex(zip_folder, args.index_folder)
+    zip_files = index.files('*_20201_*.zip')
+    index.save()
     if start_idx < 0:
         start_idx = 0
     if num_subjects > 0 and start_idx + num_subjects <= len(zip_files):
@@ -155,27 +401,43 @@ def main():
     else:
         zip_files = zip_files[start_idx:]
 
+    if manifest is not None:
+        extracted = manifest.get_subjects('extract', folder=nifti_folder)
+        logging.warning('Already converted subjects in the manifest: {0}'.format(len([f for f in zip_files if get_subject_id(f) in extracted])))
+        zip_files = [f for f in zip_files if get_subject_id(f) not in extracted]
+
     logging.warning('Number of subjects will be converted: {0}\n'.format(len(zip_files)))
 
-    tool = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stitching')
-    if not os.path.isfile(tool):
-        logging.warning('Downloading stitching tool...\n')
-        urllib.request.urlretrieve('https://gitlab.com/turkaykart/ukbb-gnc-abdominal-segmentation/-/raw/main/stitching?inline=false', 'stitching')
-        os.chmod('stitching', 0o755)
-        
-    logging.warning('Stitching tool: {0}\n'.format(tool))
+    tool = None
+    if stitching == 'tool':
+        tool = get_stitching_tool()
+        logging.warning('Stitching tool: {0}\n'.format(tool))
+        if low_memory:
+            logging.warning('low_memory is only used with --stitching numpy\n')
 
 
     os.makedirs(nifti_folder, exist_ok=True)
 
-    for f in zip_files:
-        # assumed the first part of the file name describes the subject ID
-        subject_id = os.path.basename(f).split('_')[0] + '_' + os.path.basename(f).split('_')[2]
-        subject_dir = os.path.join(nifti_folder, subject_id, '')
-        stitch(f, subject_dir, subject_id, tool)
+    if workers > 1:
+        results = stitch_parallel(zip_files, nifti_folder, tool, workers, scratch_folder, in_memory, manifest, args.metrics_file, intermediate_format, gzip_level, low_memory)
+    else:
+        results = []
+        for f in zip_files:
+            subject_id = get_subject_id(f)
+            subject_dir = os.path.join(nifti_folder, subject_id, '')
+            with metrics.measure(subject_id, 'extract', reset_peak=True) as measurement:
+                measurement.outcome = stitch(f, subject_dir, subject_id, tool, in_memory=in_memory, intermediate_format=intermediate_format, gzip_level=gzip_level,
+                                             low_memory=low_memory)
+            logging.warning('Peak memory of subject id [{0}]: {1:.0f} MB'.format(subject_id, measurement.peak_rss_mb))
+            results.append((subject_id, measurement.outcome, None))
+            record_subject(manifest, nifti_folder, subject_id, results[-1][1])
+
+    for status in ['converted', 'skipped', 'failed']:
+        logging.warning('Number of {0} subjects: {1}'.format(status, len([r for r in results if r[1] == status])))
+    logging.warning('Failed subjects: {0}\n'.format(sorted((r[0], r[2]) for r in results if r[1] == 'failed')))
 
     logging.warning('Finished extract_ukbb...')
-    shutil.copy2(log_file_path, get_log_file(dir_path=nifti_folder, basename=os.path.basename(nifti_folder) + '_log.txt'))
+    shutil.copy2(log_file_path, get_log_file(__file__, dir_path=nifti_folder, basename=os.path.basename(nifti_folder) + '_log.txt'))
     os.remove(log_file_path)
 
 if __name__ == '__main__':
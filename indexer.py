@@ -0,0 +1,97 @@
+import os
+import json
+import time
+import socket
+import fnmatch
+import hashlib
+
+
+# a directory that was modified this close to its scan may change again within the resolution of its mtime,
+# so it is not stored in the snapshot and is scanned again next time
+MTIME_MARGIN_NS = 2 * 10 ** 9
+
+
+def scan_directory(path):
+    # {name: [is_dir, size, mtime_ns]} of all entries with a single scandir pass
+    entries = {}
+    for entry in os.scandir(path):
+        try:
+            st = entry.stat()
+        except OSError:
+            # the entry was removed during the scan
+            continue
+        entries[entry.name] = [entry.is_dir(), st.st_size, st.st_mtime_ns]
+    return entries
+
+
+def matches(name, pattern):
+    # as glob, hidden entries only match patterns that start with a dot
+    return fnmatch.fnmatchcase(name, pattern) and (not name.startswith('.') or pattern.startswith('.'))
+
+
+class DirectoryIndex(object):
+    # entries of a cohort folder and of its subject folders, each directory is scanned once.
+    # with an index_folder, the scans are kept in a snapshot and only directories with a changed mtime are scanned again
+
+    def __init__(self, folder, index_folder=None):
+        self.folder = os.path.abspath(folder)
+        self.snapshot_path = None
+        if index_folder is not None:
+            os.makedirs(index_folder, exist_ok=True)
+            self.snapshot_path = os.path.join(os.path.abspath(index_folder), hashlib.sha1(self.folder.encode('utf-8')).hexdigest()[:16] + '.json')
+        self.snapshot = self.load_snapshot()
+        self.scans = {}
+        self.changed = False
+
+    def load_snapshot(self):
+        if self.snapshot_path is None or not os.path.isfile(self.snapshot_path):
+            return {}
+        try:
+            with open(self.snapshot_path, 'r') as handle:
+                snapshot = json.load(handle)
+        except (OSError, ValueError):
+            return {}
+        return snapshot['dirs'] if snapshot.get('folder') == self.folder else {}
+
+    def save(self):
+        if self.snapshot_path is None or not self.changed:
+            return
+        now = time.time_ns()
+        dirs = dict(self.snapshot)
+        for rel_path, scan in self.scans.items():
+            if scan['mtime_ns'] < now - MTIME_MARGIN_NS:
+                dirs[rel_path] = scan
+            else:
+                dirs.pop(rel_path, None)
+        tmp_path = '{0}.{1}.{2}.tmp'.format(self.snapshot_path, socket.gethostname(), os.getpid())
+        with open(tmp_path, 'w') as handle:
+            json.dump({'folder': self.folder, 'dirs': dirs}, handle)
+        os.replace(tmp_path, self.snapshot_path)
+        self.changed = False
+
+    def entries(self, rel_path=''):
+        # {name: [is_dir, size, mtime_ns]} of the folder or of one of its subfolders, {} if it does not exist
+        if rel_path in self.scans:
+            return self.scans[rel_path]['entries']
+        path = os.path.join(self.folder, rel_path)
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return {}
+        cached = self.snapshot.get(rel_path)
+        if cached is not None and cached['mtime_ns'] == mtime_ns:
+            scan = cached
+        else:
+            scan = {'mtime_ns': mtime_ns, 'entries': scan_directory(path)}
+            self.changed = True
+        self.scans[rel_path] = scan
+        return scan['entries']
+
+    def files(self, pattern='*', rel_path=''):
+        # sorted paths of the matching files, as sorted(glob.glob(...))
+        folder = os.path.join(self.folder, rel_path)
+        return sorted(os.path.join(folder, name) for name, (is_dir, _, _) in self.entries(rel_path).items() if not is_dir and matches(name, pattern))
+
+    def dirs(self, pattern='*'):
+        # sorted paths of the matching subfolders with a trailing separator, as sorted(glob.glob(os.path.join(folder, '*/')))
+        return sorted(os.path.join(self.folder, name, '') for name, (is_dir, _, _) in self.entries().items() if is_dir and matches(name, pattern))
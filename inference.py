@@ -0,0 +1,502 @@
+import multiprocessing
+import sys
+import collections
+import itertools
+import hashlib
+import logging
+import json
+import time
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import metrics
+from case_cache import CaseCache
+
+
+# speed profiles of the sliding-window inference, accurate is the default of nnUNet
+PROFILES = {
+    'fast': {'do_tta': False, 'step_size': 1.0, 'use_gaussian': False},
+    'balanced': {'do_tta': False, 'step_size': 0.5, 'use_gaussian': True},
+    'accurate': {'do_tta': True, 'step_size': 0.5, 'use_gaussian': True},
+}
+
+# precisions of the network in the batched inference, bf16 and int8 need an artifact exported by quantization.py
+PRECISIONS = ['fp32', 'bf16', 'int8']
+
+
+def get_cases(input_folder):
+    # groups the CASENAME_XXXX.nii.gz files of an nnUNet folder by case with a single directory scan
+    cases = {}
+    for entry in os.scandir(input_folder):
+        name = entry.name
+        if name.endswith('.nii.gz') and len(name) > 12 and name[-12] == '_' and name[-11:-7].isdigit():
+            cases.setdefault(name[:-12], []).append(entry.path)
+    return {case: sorted(files) for case, files in sorted(cases.items())}
+
+
+def get_preprocessor_args(trainer):
+    # everything the nnUNet preprocessing of a case needs without the network, so that it can be sent to worker processes
+    preprocessor_args = {
+        'preprocessor_name': trainer.plans.get('preprocessor_name') or ('GenericPreprocessor' if trainer.threeD else 'PreprocessorFor2D'),
+        'normalization_schemes': trainer.normalization_schemes,
+        'use_mask_for_norm': trainer.use_mask_for_norm,
+        'transpose_forward': trainer.transpose_forward,
+        'intensity_properties': trainer.intensity_properties,
+        'target_spacing': np.asarray(trainer.plans['plans_per_stage'][trainer.stage]['current_spacing']).tolist(),
+    }
+    # the plan id changes with everything that changes the preprocessed data, e.g. another model version
+    preprocessor_args['plan_id'] = hashlib.sha256(json.dumps(preprocessor_args, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    return preprocessor_args
+
+
+def preprocess_files(preprocessor_args, input_files):
+    # the same as preprocess_patient of the nnUNet trainer
+    import nnunet
+    from nnunet.training.model_restore import recursive_find_python_class
+
+    preprocessor_class = recursive_find_python_class([os.path.join(nnunet.__path__[0], 'preprocessing')], preprocessor_args['preprocessor_name'],
+                                                     current_module='nnunet.preprocessing')
+    preprocessor = preprocessor_class(preprocessor_args['normalization_schemes'], preprocessor_args['use_mask_for_norm'],
+                                      preprocessor_args['transpose_forward'], preprocessor_args['intensity_properties'])
+    d, _, properties = preprocessor.preprocess_test_case(input_files, np.array(preprocessor_args['target_spacing']))
+    return d, properties
+
+
+def preprocess_case(preprocessor_args, input_files, case=None, cache_folder=None, cache_size_gb=None):
+    # returns (d, properties, cache key), a cached case is memory mapped. The key is None without a cache
+    with metrics.measure(case, 'preprocess') as measurement:
+        if cache_folder is None:
+            d, properties = preprocess_files(preprocessor_args, input_files)
+            return d, properties, None
+
+        cache = CaseCache(cache_folder, cache_size_gb)
+        key = cache.get_key(input_files, preprocessor_args['plan_id'])
+        cached = cache.get(key)
+        if cached is not None:
+            measurement.outcome = 'cached'
+            return cached + (key,)
+        d, properties = preprocess_files(preprocessor_args, input_files)
+        cache.put(key, d, properties)
+        return d, properties, key
+
+
+def prefetch_case(preprocessor_args, input_files, case, cache_folder, cache_size_gb):
+    # runs in the prefetch workers, with a cache only the key is sent back and the predictor memory maps the cached case
+    d, properties, key = preprocess_case(preprocessor_args, input_files, case, cache_folder, cache_size_gb)
+    if key is not None:
+        return None, None, key
+    return d, properties, key
+
+
+class NnunetPredictor(object):
+    # restores the nnUNet trainer and its weights once, then predicts any number of cases in-process
+
+    def __init__(self, model_folder, folds='all', checkpoint_name='model_final_checkpoint', do_tta=True, step_size=0.5,
+                 use_gaussian=True, mixed_precision=True, all_in_gpu=False, device='cuda', cache_folder=None, cache_size_gb=None, num_prefetch=0):
+        from nnunet.training.model_restore import load_model_and_checkpoint_files
+        from nnunet.postprocessing.connected_components import load_postprocessing
+
+        if device == 'cpu':
+            # half precision autocast is only available on GPUs
+            mixed_precision = False
+            all_in_gpu = False
+            import torch
+            if torch.cuda.is_available():
+                logging.warning('torch sees a GPU although device is cpu, run configure_environment before torch is imported')
+
+        self.model_folder = model_folder
+        self.device = device
+        self.do_tta = do_tta
+        self.step_size = step_size
+        self.use_gaussian = use_gaussian
+        self.mixed_precision = mixed_precision
+        self.all_in_gpu = all_in_gpu
+        self.cache_folder = os.path.abspath(cache_folder) if cache_folder is not None else None
+        self.cache_size_gb = cache_size_gb
+        self.num_prefetch = max(num_prefetch, 0)
+
+        self.trainer, self.params = load_model_and_checkpoint_files(model_folder, folds, mixed_precision=mixed_precision, checkpoint_name=checkpoint_name)
+        if device == 'cpu':
+            self.trainer.network.cpu()
+        if len(self.params) == 1:
+            self.trainer.load_checkpoint_ram(self.params[0], False)
+
+        export_params = self.trainer.plans.get('segmentation_export_params', {})
+        self.force_separate_z = export_params.get('force_separate_z')
+        self.interpolation_order = export_params.get('interpolation_order', 1)
+        self.interpolation_order_z = export_params.get('interpolation_order_z', 0)
+        self.region_class_order = getattr(self.trainer, 'regions_class_order', None)
+
+        postprocessing_file = os.path.join(model_folder, 'postprocessing.json')
+        self.postprocessing = load_postprocessing(postprocessing_file) if os.path.isfile(postprocessing_file) else None
+        self.preprocessor_args = get_preprocessor_args(self.trainer)
+
+    def preprocess(self, input_files, case=None):
+        d, properties, _ = preprocess_case(self.preprocessor_args, input_files, case, self.cache_folder, self.cache_size_gb)
+        return d, properties
+
+    def preprocess_cases(self, cases):
+        # cases are (input_files, output_file, case), yields (input_files, output_file, case, d, properties) in the same order.
+        # the next num_prefetch cases are preprocessed in worker processes while the yielded case is predicted
+        if self.num_prefetch == 0:
+            for input_files, output_file, case in cases:
+                d, properties = self.preprocess(input_files, case)
+                yield input_files, output_file, case, d, properties
+            return
+
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(self.num_prefetch, mp_context=context, initializer=metrics.configure, initargs=(metrics.metrics_file,)) as executor:
+            pending = collections.deque()
+            for input_files, output_file, case in cases:
+                pending.append((input_files, output_file, case, executor.submit(
+                    prefetch_case, self.preprocessor_args, input_files, case, self.cache_folder, self.cache_size_gb)))
+                if len(pending) > self.num_prefetch:
+                    yield self.collect_prefetched(*pending.popleft())
+            while len(pending) > 0:
+                yield self.collect_prefetched(*pending.popleft())
+
+    def collect_prefetched(self, input_files, output_file, case, future):
+        d, properties, key = future.result()
+        if key is not None:
+            cached = CaseCache(self.cache_folder).get(key)
+            # the case may already be evicted by another process if the cache is too small
+            d, properties = cached if cached is not None else self.preprocess(input_files, case)
+        return input_files, output_file, case, d, properties
+
+    def predict_preprocessed(self, d):
+        softmax = None
+        for params in self.params:
+            if len(self.params) > 1:
+                self.trainer.load_checkpoint_ram(params, False)
+            fold_softmax = self.trainer.predict_preprocessed_data_return_seg_and_softmax(
+                d, do_mirroring=self.do_tta, mirror_axes=self.trainer.data_aug_params['mirror_axes'], use_sliding_window=True,
+                step_size=self.step_size, use_gaussian=self.use_gaussian, all_in_gpu=self.all_in_gpu,
+                mixed_precision=self.mixed_precision)[1]
+            softmax = fold_softmax if softmax is None else softmax + fold_softmax
+        if len(self.params) > 1:
+            softmax /= len(self.params)
+        return self.transpose_back(softmax)
+
+    def transpose_back(self, softmax):
+        transpose_forward = self.trainer.plans.get('transpose_forward')
+        if transpose_forward is not None:
+            transpose_backward = self.trainer.plans.get('transpose_backward')
+            softmax = softmax.transpose([0] + [i + 1 for i in transpose_backward])
+        return softmax
+
+    def export(self, softmax, properties, output_file):
+        from nnunet.inference.segmentation_export import save_segmentation_nifti_from_softmax
+        from nnunet.postprocessing.connected_components import load_remove_save
+
+        save_segmentation_nifti_from_softmax(softmax, output_file, properties, self.interpolation_order, self.region_class_order,
+                                             None, None, None, None, self.force_separate_z, self.interpolation_order_z)
+        if self.postprocessing is not None:
+            load_remove_save(output_file, output_file, *self.postprocessing)
+
+    def predict_cases(self, cases):
+        # cases are (input_files, output_file, case), yields (case, output_file) in the same order when each case is exported
+        for input_files, output_file, case, d, properties in self.preprocess_cases(cases):
+            with metrics.measure(case, 'inference'):
+                softmax = self.predict_preprocessed(d)
+            with metrics.measure(case, 'export'):
+                self.export(softmax, properties, output_file)
+            yield case, output_file
+
+    def predict_case(self, input_files, output_file, case=None):
+        case = case if case is not None else os.path.basename(output_file).replace('.nii.gz', '')
+        d, properties = self.preprocess(input_files, case)
+        with metrics.measure(case, 'inference'):
+            softmax = self.predict_preprocessed(d)
+        with metrics.measure(case, 'export'):
+            self.export(softmax, properties, output_file)
+        return output_file
+
+
+def pad_to_patch_size(data, patch_size):
+    # pads (c, x, y, z) with zeros to at least the patch size as nnUNet does, the slicer removes the padding again
+    pad = [(0, 0)]
+    slicer = [slice(None)]
+    for n, p in zip(data.shape[1:], patch_size):
+        difference = max(p - n, 0)
+        pad.append((difference // 2, difference // 2 + difference % 2))
+        slicer.append(slice(difference // 2, difference // 2 + n))
+    if any(sum(p) > 0 for p in pad):
+        data = np.pad(data, pad, mode='constant', constant_values=0)
+    return data, tuple(slicer)
+
+
+def get_steps(patch_size, image_size, step_size):
+    # start of the patches along each axis, the same as _compute_steps_for_sliding_window of nnUNet
+    steps = []
+    for n, p in zip(image_size, patch_size):
+        num_steps = int(np.ceil((n - p) / (p * step_size))) + 1
+        actual_step_size = (n - p) / (num_steps - 1) if num_steps > 1 else 0
+        steps.append([int(np.round(actual_step_size * i)) for i in range(num_steps)])
+    return steps
+
+
+def get_gaussian(patch_size, sigma_scale=1. / 8):
+    # importance map of the patch voxels, the same as _get_gaussian of nnUNet
+    from scipy.ndimage import gaussian_filter
+
+    tmp = np.zeros(patch_size)
+    tmp[tuple(p // 2 for p in patch_size)] = 1
+    gaussian = gaussian_filter(tmp, [p * sigma_scale for p in patch_size], 0, mode='constant', cval=0)
+    gaussian = (gaussian / np.max(gaussian)).astype(np.float32)
+    gaussian[gaussian == 0] = np.min(gaussian[gaussian != 0])
+    return gaussian
+
+
+class BatchedSlidingWindow(object):
+    # sliding-window inference that fills each forward pass with patches of several cases.
+    # predict_batch maps (b, c, x, y, z) patches to (b, num_classes, x, y, z) softmax. Only the cases with patches
+    # in the current batch have an accumulator, so the memory is bounded by patches_per_batch and not by the number of cases
+
+    def __init__(self, predict_batch, num_classes, patch_size, patches_per_batch=8, step_size=0.5, use_gaussian=True):
+        self.predict_batch = predict_batch
+        self.num_classes = num_classes
+        self.patch_size = tuple(patch_size)
+        self.patches_per_batch = max(patches_per_batch, 1)
+        self.step_size = step_size
+        self.use_gaussian = use_gaussian
+        self.gaussian = get_gaussian(self.patch_size)
+
+    def open_case(self, key, data):
+        padded, slicer = pad_to_patch_size(data, self.patch_size)
+        steps = get_steps(self.patch_size, padded.shape[1:], self.step_size)
+        num_patches = len(steps[0]) * len(steps[1]) * len(steps[2])
+        return {
+            'key': key,
+            'data': padded,
+            'slicer': slicer,
+            'positions': list(itertools.product(*steps)),
+            'next_patch': 0,
+            'remaining': num_patches,
+            # as in nnUNet, a single patch is not weighted
+            'weight': self.gaussian if self.use_gaussian and num_patches > 1 else np.ones(self.patch_size, dtype=np.float32),
+            'results': np.zeros((self.num_classes,) + padded.shape[1:], dtype=np.float32),
+            'weights': np.zeros(padded.shape[1:], dtype=np.float32),
+        }
+
+    def close_case(self, state):
+        # division by the summed weights of each voxel gives the weighted mean softmax of the overlapping patches
+        softmax = state['results'] / state['weights'][None]
+        return softmax[(slice(None),) + state['slicer'][1:]]
+
+    def predict(self, cases):
+        # cases are (key, data) pairs with data of shape (c, x, y, z), yields (key, softmax) in the order of the cases.
+        # the cases are only read when their patches are needed, so cases can be a generator that preprocesses them
+        cases = iter(cases)
+        open_cases = []
+        exhausted = False
+        while True:
+            # patches are taken from the open cases in order, new cases are opened until the batch is full
+            batch = []
+            for state in open_cases:
+                self.take_patches(state, batch)
+            while len(batch) < self.patches_per_batch and not exhausted:
+                try:
+                    key, data = next(cases)
+                except StopIteration:
+                    exhausted = True
+                    break
+                state = self.open_case(key, data)
+                open_cases.append(state)
+                self.take_patches(state, batch)
+            if len(batch) == 0:
+                return
+
+            patches = np.stack([state['data'][(slice(None),) + self.get_region(position)] for state, position in batch])
+            softmax = self.predict_batch(patches)
+            # the logits of each patch are scattered back into the accumulator of its case
+            for (state, position), patch_softmax in zip(batch, softmax):
+                region = self.get_region(position)
+                state['results'][(slice(None),) + region] += patch_softmax * state['weight']
+                state['weights'][region] += state['weight']
+                state['remaining'] -= 1
+
+            while len(open_cases) > 0 and open_cases[0]['remaining'] == 0:
+                state = open_cases.pop(0)
+                yield state['key'], self.close_case(state)
+
+    def take_patches(self, state, batch):
+        while state['next_patch'] < len(state['positions']) and len(batch) < self.patches_per_batch:
+            batch.append((state, state['positions'][state['next_patch']]))
+            state['next_patch'] += 1
+
+    def get_region(self, position):
+        return tuple(slice(s, s + p) for s, p in zip(position, self.patch_size))
+
+
+def get_artifact_path(model_folder, precision, folds='all', checkpoint_name='model_final_checkpoint'):
+    # the reduced precision network is stored next to the checkpoint of the fold
+    fold = folds[0] if isinstance(folds, (list, tuple)) else folds
+    fold_folder = fold if fold == 'all' else 'fold_{0}'.format(fold)
+    return os.path.join(model_folder, fold_folder, '{0}.{1}.pt'.format(checkpoint_name, precision))
+
+
+class BatchedNnunetPredictor(NnunetPredictor):
+    # the patches of consecutive cases share the forward passes of the network instead of one patch per forward pass
+
+    def __init__(self, model_folder, patches_per_batch=8, precision='fp32', **kwargs):
+        import torch
+
+        if precision == 'int8' and kwargs.get('device', 'cuda') != 'cpu':
+            raise ValueError('int8 inference is only available on cpu.')
+        super(BatchedNnunetPredictor, self).__init__(model_folder, **kwargs)
+        if len(self.params) > 1:
+            raise ValueError('Batched inference needs a single checkpoint (folds all), got {0}.'.format(len(self.params)))
+
+        self.torch = torch
+        self.precision = precision
+        self.network = self.trainer.network
+        self.network.do_ds = False
+        self.network.eval()
+        self.network_device = next(self.network.parameters()).device
+        num_classes = self.network.num_classes
+        if precision != 'fp32':
+            artifact_path = get_artifact_path(model_folder, precision, kwargs.get('folds', 'all'), kwargs.get('checkpoint_name', 'model_final_checkpoint'))
+            if not os.path.isfile(artifact_path):
+                raise RuntimeError('{0} does not exist, it is exported by quantization.py.'.format(artifact_path))
+            if precision == 'bf16':
+                # the bf16 weights are cast back when loaded, the network then runs in bf16 autocast
+                self.network.load_state_dict(torch.load(artifact_path, map_location='cpu'))
+            else:
+                self.network = torch.jit.load(artifact_path, map_location='cpu').eval()
+                self.network_device = torch.device('cpu')
+        mirror_axes = self.trainer.data_aug_params['mirror_axes'] if self.do_tta else ()
+        # all combinations of the mirror axes as in nnUNet, the first one is the patch itself
+        self.flips = [tuple(a + 2 for a in axes) for n in range(len(mirror_axes) + 1) for axes in itertools.combinations(mirror_axes, n)]
+        self.window = BatchedSlidingWindow(self.predict_batch, num_classes, self.trainer.patch_size, patches_per_batch,
+                                           self.step_size, self.use_gaussian)
+
+    def predict_batch(self, patches):
+        torch = self.torch
+        x = torch.from_numpy(patches.astype(np.float32, copy=False)).to(self.network_device)
+        result = None
+        if self.precision == 'bf16':
+            autocast = torch.autocast(self.network_device.type, dtype=torch.bfloat16)
+        else:
+            autocast = torch.cuda.amp.autocast(enabled=self.mixed_precision)
+        with torch.no_grad(), autocast:
+            for dims in self.flips:
+                if len(dims) == 0:
+                    softmax = torch.softmax(self.network(x).float(), 1)
+                else:
+                    softmax = torch.flip(torch.softmax(self.network(torch.flip(x, dims)).float(), 1), dims)
+                result = softmax if result is None else result + softmax
+        return (result / len(self.flips)).cpu().numpy()
+
+    def predict_cases(self, cases):
+        # the next cases are taken from preprocess_cases when the batch needs their patches, the inference is not measured per case
+        properties = {}
+
+        def get_window_cases():
+            for input_files, output_file, case, d, case_properties in self.preprocess_cases(cases):
+                properties[case] = case_properties
+                yield (case, output_file), d
+
+        for (case, output_file), softmax in self.window.predict(get_window_cases()):
+            with metrics.measure(case, 'export'):
+                self.export(self.transpose_back(softmax), properties.pop(case), output_file)
+            yield case, output_file
+
+    def predict_case(self, input_files, output_file, case=None):
+        case = case if case is not None else os.path.basename(output_file).replace('.nii.gz', '')
+        for _ in self.predict_cases([(input_files, output_file, case)]):
+            pass
+        return output_file
+
+
+class TorchPredictor(object):
+    # stand-in for NnunetPredictor with any torch network, e.g. a tiny network for testing the inference code on CPU
+
+    def __init__(self, network, device='cpu'):
+        import torch
+
+        self.torch = torch
+        self.device = torch.device(device)
+        self.network = network.to(self.device).eval()
+
+    def predict_case(self, input_files, output_file, case=None):
+        import nibabel as nib
+
+        images = [nib.load(f) for f in input_files]
+        data = np.stack([np.asanyarray(img.dataobj).astype(np.float32) for img in images])
+        with self.torch.no_grad():
+            logits = self.network(self.torch.from_numpy(data[None]).to(self.device))
+        seg = logits.argmax(1)[0].cpu().numpy().astype(np.uint8)
+        nib.save(nib.Nifti1Image(seg, images[0].affine), output_file)
+        return output_file
+
+
+def get_stand_in_network(num_channels, num_classes=6):
+    import torch
+
+    return torch.nn.Sequential(
+        torch.nn.Conv3d(num_channels, 8, 3, padding=1),
+        torch.nn.ReLU(),
+        torch.nn.Conv3d(8, num_classes, 1))
+
+
+def configure_environment(device='cuda', num_threads=None):
+    # must run before torch is imported: OpenMP and MKL read their thread variables only once, and nnUNet moves the data
+    # to the GPU whenever torch sees one, also for a network on the cpu. spawned workers inherit the variables
+    if 'torch' in sys.modules:
+        logging.warning('torch is already imported, the thread and device settings may not apply')
+    if device == 'cpu':
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    if num_threads is not None:
+        os.environ['OMP_NUM_THREADS'] = str(num_threads)
+        os.environ['MKL_NUM_THREADS'] = str(num_threads)
+
+
+def set_num_threads(num_threads):
+    if 'torch' not in sys.modules:
+        configure_environment(num_threads=num_threads)
+    import torch
+
+    torch.set_num_threads(num_threads)
+
+
+def summarize_latencies(latencies):
+    values = sorted(latencies.values())
+    if len(values) == 0:
+        return {'num_cases': 0}
+    return {
+        'num_cases': len(values),
+        'mean': sum(values) / len(values),
+        'median': values[len(values) // 2],
+        'min': values[0],
+        'max': values[-1],
+    }
+
+
+def predict_folder(predictor, input_folder, output_folder, overwrite=False, latencies=None):
+    # returns {case: prediction path} of all cases that have a prediction, the latency of each predicted case is added to latencies
+    os.makedirs(output_folder, exist_ok=True)
+    predictions = {}
+    pending = []
+    for case, input_files in get_cases(input_folder).items():
+        output_file = os.path.join(output_folder, case + '.nii.gz')
+        if overwrite or not os.path.isfile(output_file):
+            pending.append((input_files, output_file, case))
+        predictions[case] = output_file
+
+    # predictors with predict_cases (nnUNet) preprocess the next cases ahead or batch several cases, they finish the cases in order.
+    # the latency of a case is then the time since the previous case was finished
+    results = predictor.predict_cases(pending) if hasattr(predictor, 'predict_cases') else None
+    for input_files, output_file, case in pending:
+        start = time.time()
+        with metrics.measure(case, 'predict'):
+            if results is not None:
+                next(results)
+            else:
+                predictor.predict_case(input_files, output_file, case)
+        latency = time.time() - start
+        logging.info('Predicted [{0}] in {1:.1f}s: {2}'.format(case, latency, output_file))
+        if latencies is not None:
+            latencies[case] = latency
+    return predictions
@@ -0,0 +1,189 @@
+import os
+import sys
+import json
+import zlib
+import sqlite3
+import logging
+import argparse
+
+import numpy as np
+
+from volumes import get_labels_image
+
+
+def encode_mask(mask):
+    # bit-packed and compressed, a mask of the bounding box of an organ is a few KB
+    return zlib.compress(np.packbits(mask).tobytes())
+
+
+def decode_mask(data, shape):
+    return np.unpackbits(np.frombuffer(zlib.decompress(data), dtype=np.uint8), count=int(np.prod(shape))).reshape(shape).astype(bool)
+
+
+def encode_subject(subject, labels, header, label_names=None, crop=None):
+    # record of a label map for LabelArchive.put with one mask per label, cropped to the bounding box of the label.
+    # the labels of a cropped prediction are placed at the crop box of the whole-body grid, the header is the one of
+    # the whole-body label map that convert2original.py writes
+    from scipy import ndimage
+
+    label_names = label_names or {}
+    if crop is not None:
+        shape, offset, affine = tuple(crop['shape']), [b[0] for b in crop['box']], np.array(crop['affine'])
+    else:
+        shape, offset, affine = labels.shape, (0, 0, 0), None
+    # the header only needs the shape, no label map of the whole-body grid is allocated
+    img = get_labels_image(np.broadcast_to(np.uint8(0), shape), header, affine)
+    masks = []
+    for i, box in enumerate(ndimage.find_objects(labels)):
+        if box is None:
+            continue
+        label = i + 1
+        mask = labels[box] == label
+        masks.append({
+            'organ': label_names.get(label, str(label)),
+            'label': label,
+            'box': [[s.start + o, s.stop + o] for s, o in zip(box, offset)],
+            'voxels': int(np.count_nonzero(mask)),
+            'data': encode_mask(mask),
+        })
+    return {'subject': subject, 'header': img.header.binaryblock, 'shape': [int(n) for n in shape], 'masks': masks}
+
+
+class LabelArchive(object):
+    # label maps of a cohort in one indexed SQLite file: the NIfTI header of every subject and one bbox-cropped,
+    # bit-packed mask per organ. one organ of one or many subjects is read without the rest of the label maps
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.conn = sqlite3.connect(self.path, timeout=60)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS subjects (
+                                 subject TEXT PRIMARY KEY,
+                                 shape TEXT NOT NULL,
+                                 header BLOB NOT NULL)''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS masks (
+                                 subject TEXT NOT NULL,
+                                 organ TEXT NOT NULL,
+                                 label INTEGER NOT NULL,
+                                 box TEXT NOT NULL,
+                                 voxels INTEGER NOT NULL,
+                                 data BLOB NOT NULL,
+                                 PRIMARY KEY (subject, organ))''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_organ ON masks (organ)')
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM subjects').fetchone()[0]
+
+    def __contains__(self, subject):
+        return self.conn.execute('SELECT 1 FROM subjects WHERE subject = ?', (subject,)).fetchone() is not None
+
+    def commit(self):
+        self.conn.commit()
+
+    def put(self, record, commit=True):
+        # replaces the label map of the subject
+        self.conn.execute('INSERT OR REPLACE INTO subjects (subject, shape, header) VALUES (?, ?, ?)',
+                          (record['subject'], json.dumps(record['shape']), sqlite3.Binary(record['header'])))
+        self.conn.execute('DELETE FROM masks WHERE subject = ?', (record['subject'],))
+        self.conn.executemany('INSERT INTO masks (subject, organ, label, box, voxels, data) VALUES (?, ?, ?, ?, ?, ?)',
+                              [(record['subject'], m['organ'], m['label'], json.dumps(m['box']), m['voxels'], sqlite3.Binary(m['data'])) for m in record['masks']])
+        if commit:
+            self.commit()
+
+    def get_subjects(self):
+        return [row[0] for row in self.conn.execute('SELECT subject FROM subjects ORDER BY subject')]
+
+    def get_organs(self, subject):
+        # {organ: voxels}
+        return dict(self.conn.execute('SELECT organ, voxels FROM masks WHERE subject = ? ORDER BY label', (subject,)))
+
+    def get_header(self, subject):
+        import nibabel as nib
+
+        row = self.conn.execute('SELECT header FROM subjects WHERE subject = ?', (subject,)).fetchone()
+        if row is None:
+            raise KeyError(subject)
+        return nib.Nifti1Header(binaryblock=bytes(row[0]))
+
+    def get_mask(self, subject, organ, full=False):
+        # (mask, box) of the organ cropped to its bounding box [[start, stop], ...] in the whole-body grid, or the mask of
+        # the whole-body grid with full. (None, None) if the subject has no voxels of the organ
+        row = self.conn.execute('SELECT box, data FROM masks WHERE subject = ? AND organ = ?', (subject, organ)).fetchone()
+        if row is None:
+            if subject not in self:
+                raise KeyError(subject)
+            return None, None
+        box = json.loads(row[0])
+        mask = decode_mask(bytes(row[1]), [b[1] - b[0] for b in box])
+        if full:
+            shape = self.get_header(subject).get_data_shape()[:3]
+            full_mask = np.zeros(shape, dtype=bool)
+            full_mask[tuple(slice(b[0], b[1]) for b in box)] = mask
+            return full_mask, box
+        return mask, box
+
+    def iter_masks(self, organ, subjects=None, chunk_size=500):
+        # yields (subject, mask, box) of the organ for a batch of subjects (all if None), one mask at a time.
+        # subjects without voxels of the organ are left out
+        if subjects is None:
+            query = self.conn.execute('SELECT subject, box, data FROM masks WHERE organ = ? ORDER BY subject', (organ,))
+            chunks = [query]
+        else:
+            subjects = list(subjects)
+            chunks = (self.conn.execute('SELECT subject, box, data FROM masks WHERE organ = ? AND subject IN ({0}) ORDER BY subject'.format(
+                ','.join('?' * len(subjects[i:i + chunk_size]))), [organ] + subjects[i:i + chunk_size]) for i in range(0, len(subjects), chunk_size))
+        for rows in chunks:
+            for subject, box, data in rows:
+                box = json.loads(box)
+                yield subject, decode_mask(bytes(data), [b[1] - b[0] for b in box]), box
+
+    def get_labels(self, subject):
+        # the uint8 label map of the whole-body grid
+        header = self.get_header(subject)
+        labels = np.zeros(header.get_data_shape()[:3], dtype=np.uint8)
+        for label, box, data in self.conn.execute('SELECT label, box, data FROM masks WHERE subject = ?', (subject,)):
+            box = json.loads(box)
+            region = labels[tuple(slice(b[0], b[1]) for b in box)]
+            region[decode_mask(bytes(data), [b[1] - b[0] for b in box])] = label
+        return labels
+
+    def get_image(self, subject):
+        # the NIfTI image with the header of the label map that was archived, including its affine
+        import nibabel as nib
+
+        header = self.get_header(subject)
+        return nib.Nifti1Image(self.get_labels(subject), header.get_best_affine(), header)
+
+    def export(self, subject, path):
+        self.get_image(subject).to_filename(path)
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--archive_file', required=True, help='Label archive written by the --output_format option of convert2original.py')
+    parser.add_argument('--output_folder', required=False, default=None, help='Exports the label maps as <output_folder>/<subject>/prd.nii.gz with their original header and affine. \
+                                                                                Without it, the subjects and organs of the archive are listed.')
+    parser.add_argument('--subjects', nargs='+', required=False, default=None, help='Subjects to be exported or listed. Default is all subjects.')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s: %(message)s', level=logging.INFO, handlers=[logging.StreamHandler(sys.stdout)])
+
+    archive = LabelArchive(args.archive_file)
+    subjects = args.subjects if args.subjects is not None else archive.get_subjects()
+    for subject in subjects:
+        if args.output_folder is None:
+            logging.info('{0}: {1}'.format(subject, archive.get_organs(subject)))
+            continue
+        os.makedirs(os.path.join(args.output_folder, subject), exist_ok=True)
+        archive.export(subject, os.path.join(args.output_folder, subject, 'prd.nii.gz'))
+        logging.info('Exported subject id [{0}]'.format(subject))
+    logging.info('Number of subjects: {0} of {1}, archive size: {2:.1f} MB'.format(len(subjects), len(archive), os.path.getsize(archive.path) / 1e6))
+    archive.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import logging
+import shutil
+import errno
+import os
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+LINK_MODES = ['copy', 'hardlink', 'symlink', 'reflink']
+
+# ioctl request of Linux for cloning a file (btrfs, xfs, ...), see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+# errors of linking that are solved by falling back to a copy, e.g. source and destination are on different filesystems
+FALLBACK_ERRNOS = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL, errno.ENOTTY, errno.ENOSYS}
+
+
+def reflink(src, dst):
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, 'Reflinks are not supported on this platform')
+    try:
+        with open(src, 'rb') as src_handle, open(dst, 'wb') as dst_handle:
+            fcntl.ioctl(dst_handle.fileno(), FICLONE, src_handle.fileno())
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        raise
+    shutil.copystat(src, dst)
+
+
+def link_file(src, dst, link_mode='copy'):
+    # returns the mode that is actually used, which is 'copy' if linking is not possible
+    if link_mode not in LINK_MODES:
+        raise ValueError('Unknown link mode: {0}'.format(link_mode))
+
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    try:
+        if link_mode == 'hardlink':
+            os.link(src, dst)
+            return link_mode
+        elif link_mode == 'symlink':
+            os.symlink(os.path.abspath(src), dst)
+            return link_mode
+        elif link_mode == 'reflink':
+            reflink(src, dst)
+            return link_mode
+    except OSError as e:
+        if e.errno not in FALLBACK_ERRNOS:
+            raise
+        logging.debug('Falling back to copy for {0} ({1}): {2}'.format(dst, link_mode, e))
+
+    shutil.copy2(src, dst)
+    return 'copy'
@@ -0,0 +1,105 @@
+import sqlite3
+import json
+import time
+import os
+
+
+STAGES = ['extract', 'convert', 'predict', 'convert_back']
+
+
+def get_file_stats(paths):
+    stats = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stats[os.path.abspath(path)] = {'size': st.st_size, 'mtime': st.st_mtime}
+        except FileNotFoundError:
+            pass
+    return stats
+
+
+def get_folder_key(folder):
+    return os.path.abspath(folder) if folder is not None else ''
+
+
+def is_unchanged(outputs):
+    # the recorded outputs still exist with the same size and modification time
+    return get_file_stats(outputs.keys()) == outputs
+
+
+class Manifest(object):
+    # per-subject stage state shared by all scripts, so that resuming is a query instead of a directory crawl.
+    # every row belongs to the output folder of its stage (e.g. the nifti_folder of extract), so the same subject or
+    # case id of another dataset or run is a separate row
+
+    def __init__(self, manifest_path):
+        self.manifest_path = os.path.abspath(manifest_path)
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        self.conn = sqlite3.connect(self.manifest_path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('BEGIN IMMEDIATE')
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(subjects)')]
+        if len(columns) > 0 and 'folder' not in columns:
+            # rows of manifests without folders are kept with an empty folder, they are not used by the folder queries
+            self.conn.execute('ALTER TABLE subjects RENAME TO subjects_v1')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS subjects (
+                                 subject TEXT NOT NULL,
+                                 stage TEXT NOT NULL,
+                                 folder TEXT NOT NULL,
+                                 status TEXT NOT NULL,
+                                 outputs TEXT,
+                                 info TEXT,
+                                 error TEXT,
+                                 updated REAL,
+                                 PRIMARY KEY (subject, stage, folder))''')
+        if len(columns) > 0 and 'folder' not in columns:
+            self.conn.execute("INSERT INTO subjects SELECT subject, stage, '', status, outputs, info, error, updated FROM subjects_v1")
+            self.conn.execute('DROP TABLE subjects_v1')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_folder_stage_status ON subjects (folder, stage, status)')
+        self.conn.commit()
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def update(self, subject, stage, status, outputs=None, info=None, error=None, commit=True, folder=None):
+        if stage not in STAGES:
+            raise ValueError('Unknown stage: {0}'.format(stage))
+        self.conn.execute('INSERT OR REPLACE INTO subjects (subject, stage, folder, status, outputs, info, error, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                          (subject, stage, get_folder_key(folder), status, json.dumps(get_file_stats(outputs or [])), json.dumps(info or {}), error, time.time()))
+        if commit:
+            self.commit()
+
+    def update_many(self, records, stage, folder=None):
+        # records: iterable of (subject, status, outputs, info, error)
+        for subject, status, outputs, info, error in records:
+            self.update(subject, stage, status, outputs=outputs, info=info, error=error, commit=False, folder=folder)
+        self.commit()
+
+    def get(self, subject, stage, folder=None):
+        row = self.conn.execute('SELECT status, outputs, info, error, updated FROM subjects WHERE subject = ? AND stage = ? AND folder = ?',
+                                (subject, stage, get_folder_key(folder))).fetchone()
+        if row is None:
+            return None
+        return {'subject': subject, 'stage': stage, 'status': row[0], 'outputs': json.loads(row[1]), 'info': json.loads(row[2]), 'error': row[3], 'updated': row[4]}
+
+    def get_subjects(self, stage, status='done', folder=None, verify=True):
+        # {subject: {'outputs', 'info'}} of the stage in folder. with verify, subjects whose recorded outputs were changed or
+        # deleted since are left out, this costs one stat per output file but no directory crawl
+        rows = self.conn.execute('SELECT subject, outputs, info FROM subjects WHERE folder = ? AND stage = ? AND status = ? ORDER BY subject',
+                                 (get_folder_key(folder), stage, status))
+        subjects = {subject: {'outputs': json.loads(outputs), 'info': json.loads(info)} for subject, outputs, info in rows}
+        if verify:
+            subjects = {subject: entry for subject, entry in subjects.items() if is_unchanged(entry['outputs'])}
+        return subjects
+
+    def is_done(self, subject, stage, verify=False, folder=None):
+        entry = self.get(subject, stage, folder)
+        if entry is None or entry['status'] != 'done':
+            return False
+        if verify:
+            # optionally check that the recorded outputs are unchanged
+            return is_unchanged(entry['outputs'])
+        return True
@@ -0,0 +1,241 @@
+import os
+import sys
+import json
+import math
+import time
+import socket
+import argparse
+import resource
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from manifest import STAGES
+
+
+# cpu time of the calling thread if available, the stages of pipeline.py run in threads of the same process
+RUSAGE = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+IO_FILES = ['/proc/thread-self/io', '/proc/self/io']
+# the peak resident set size of the process can be read and reset on Linux
+STATUS_FILE = '/proc/self/status'
+CLEAR_REFS_FILE = '/proc/self/clear_refs'
+
+# JSONL file of the events, every process that records events has to call configure
+metrics_file = None
+
+
+def configure(path):
+    global metrics_file
+    metrics_file = os.path.abspath(path) if path is not None else None
+
+
+def get_cpu_time():
+    usage = resource.getrusage(RUSAGE)
+    return usage.ru_utime + usage.ru_stime
+
+
+def reset_peak_rss():
+    # the next peak is then the peak of the next subject instead of the peak since the start of the process.
+    # the peak is shared by all threads, so only processes that handle one subject at a time should reset it
+    try:
+        with open(CLEAR_REFS_FILE, 'w') as handle:
+            handle.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss_mb():
+    # VmHWM is the peak since the last reset_peak_rss, ru_maxrss (kilobytes on Linux and bytes on macOS) the peak since the start
+    try:
+        with open(STATUS_FILE, 'r') as handle:
+            for line in handle:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except (OSError, ValueError, IndexError):
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def get_io_bytes():
+    # bytes read and written through system calls (including the page cache), None if /proc is not available
+    for io_file in IO_FILES:
+        try:
+            with open(io_file, 'r') as handle:
+                counters = dict(line.split(': ') for line in handle.read().splitlines())
+            return int(counters['rchar']), int(counters['wchar'])
+        except (OSError, KeyError, ValueError):
+            continue
+    return None, None
+
+
+def write_event(event):
+    # one write with O_APPEND per event, the lock keeps lines of several processes and nodes from interleaving
+    line = (json.dumps(event) + '\n').encode('utf-8')
+    fd = os.open(metrics_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+class Measurement(object):
+
+    def __init__(self, subject, stage, info):
+        self.subject = subject
+        self.stage = stage
+        self.info = info
+        self.outcome = 'ok'
+        self.error = None
+        self.peak_rss_mb = None
+        # False if the peak could not be reset, peak_rss_mb is then the peak of the process since its start
+        self.is_peak_reset = False
+
+
+@contextmanager
+def measure(subject, stage, reset_peak=False, **info):
+    # records one event for the stage of the subject, the outcome can be changed through the yielded measurement.
+    # with reset_peak, the peak memory of the event and of measurement.peak_rss_mb is the peak of this stage only and is
+    # recorded as peak_rss_mb. otherwise it is the peak of the process so far (e.g. of all threads of pipeline.py) and is
+    # recorded as process_peak_rss_mb
+    measurement = Measurement(subject, stage, info)
+    if reset_peak:
+        measurement.is_peak_reset = reset_peak_rss()
+    if metrics_file is None:
+        yield measurement
+        measurement.peak_rss_mb = get_peak_rss_mb()
+        return
+
+    start_wall = time.time()
+    start = time.perf_counter()
+    start_cpu = get_cpu_time()
+    start_read, start_written = get_io_bytes()
+    try:
+        yield measurement
+    except BaseException as e:
+        measurement.outcome = 'error'
+        measurement.error = repr(e)
+        raise
+    finally:
+        end_read, end_written = get_io_bytes()
+        measurement.peak_rss_mb = get_peak_rss_mb()
+        event = {
+            'time': start_wall,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'subject': measurement.subject,
+            'stage': measurement.stage,
+            'wall_s': time.perf_counter() - start,
+            'cpu_s': get_cpu_time() - start_cpu,
+            'peak_rss_mb' if measurement.is_peak_reset else 'process_peak_rss_mb': measurement.peak_rss_mb,
+            'read_bytes': end_read - start_read if start_read is not None else None,
+            'write_bytes': end_written - start_written if start_written is not None else None,
+            'outcome': measurement.outcome,
+        }
+        if measurement.error is not None:
+            event['error'] = measurement.error
+        if measurement.info:
+            event['info'] = measurement.info
+        write_event(event)
+
+
+def load_events(path):
+    events = []
+    with open(path, 'r', encoding='utf-8') as handle:
+        for line in handle:
+            if line.strip():
+                events.append(json.loads(line))
+    return events
+
+
+def percentile(values, q):
+    # nearest-rank percentile of the sorted values
+    values = sorted(values)
+    if len(values) == 0:
+        return None
+    return values[min(max(int(math.ceil(q / 100.0 * len(values))) - 1, 0), len(values) - 1)]
+
+
+def summarize(events, num_slowest=10):
+    # events of nnUNet case ids (predict.py) are related to the subject through the nnunet_subject of the convert events
+    aliases = {}
+    for event in events:
+        if 'nnunet_subject' in event.get('info', {}):
+            aliases[event['info']['nnunet_subject']] = event['subject']
+
+    # events of the same subject and stage (e.g. stitching of each contrast) are added up
+    totals = {}
+    for event in events:
+        key = (aliases.get(event['subject'], event['subject']), event['stage'])
+        total = totals.setdefault(key, {'wall_s': 0.0, 'cpu_s': 0.0, 'read_bytes': 0, 'write_bytes': 0, 'peak_rss_mb': 0.0, 'process_peak_rss_mb': 0.0, 'errors': 0})
+        total['wall_s'] += event['wall_s']
+        total['cpu_s'] += event['cpu_s']
+        total['read_bytes'] += event.get('read_bytes') or 0
+        total['write_bytes'] += event.get('write_bytes') or 0
+        total['peak_rss_mb'] = max(total['peak_rss_mb'], event.get('peak_rss_mb') or 0.0)
+        total['process_peak_rss_mb'] = max(total['process_peak_rss_mb'], event.get('process_peak_rss_mb') or 0.0)
+        total['errors'] += event['outcome'] not in ('ok', 'converted', 'skipped', 'cached')
+
+    stages = {}
+    for (subject, stage), total in totals.items():
+        stages.setdefault(stage, []).append(total)
+    stage_summary = {}
+    for stage, stage_totals in sorted(stages.items()):
+        wall = [t['wall_s'] for t in stage_totals]
+        stage_summary[stage] = {
+            'num_subjects': len(stage_totals),
+            'errors': sum(t['errors'] for t in stage_totals),
+            'p50_s': percentile(wall, 50),
+            'p95_s': percentile(wall, 95),
+            'total_wall_s': sum(wall),
+            'total_cpu_s': sum(t['cpu_s'] for t in stage_totals),
+            'read_mb': sum(t['read_bytes'] for t in stage_totals) / 1e6,
+            'write_mb': sum(t['write_bytes'] for t in stage_totals) / 1e6,
+            # only the events with a reset peak, the peak of the processes is reported separately
+            'peak_rss_mb': max(t['peak_rss_mb'] for t in stage_totals),
+            'process_peak_rss_mb': max(t['process_peak_rss_mb'] for t in stage_totals),
+        }
+
+    subjects = {}
+    for (subject, stage), total in totals.items():
+        subjects.setdefault(subject, {})[stage] = total['wall_s']
+    # steps like unzip or inference are part of the stages of manifest.py, only the latter are added up per subject
+    def get_subject_wall(stage_walls):
+        return sum(wall for stage, wall in stage_walls.items() if stage in STAGES)
+
+    slowest = sorted(subjects.items(), key=lambda item: get_subject_wall(item[1]), reverse=True)[:num_slowest]
+    return {'stages': stage_summary, 'slowest_subjects': [{'subject': s, 'wall_s': get_subject_wall(w), 'stages': w} for s, w in slowest]}
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--metrics_file', required=True, help='JSONL file written by the --metrics_file option of the other scripts')
+    parser.add_argument('--num_slowest', type=int, required=False, default=10, help='Number of the slowest subjects to be reported.')
+    parser.add_argument('--json', action='store_true', help='Print the summary as JSON.')
+    args = parser.parse_args()
+
+    summary = summarize(load_events(args.metrics_file), args.num_slowest)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+
+    print('{0:<16} {1:>8} {2:>6} {3:>9} {4:>9} {5:>11} {6:>11} {7:>10} {8:>10} {9:>9} {10:>14}'.format(
+        'stage', 'subjects', 'errors', 'p50 [s]', 'p95 [s]', 'wall [s]', 'cpu [s]', 'read [MB]', 'write [MB]', 'rss [MB]', 'proc rss [MB]'))
+    for stage, s in summary['stages'].items():
+        print('{0:<16} {1:>8} {2:>6} {3:>9.2f} {4:>9.2f} {5:>11.1f} {6:>11.1f} {7:>10.1f} {8:>10.1f} {9:>9.0f} {10:>14.0f}'.format(
+            stage, s['num_subjects'], s['errors'], s['p50_s'], s['p95_s'], s['total_wall_s'], s['total_cpu_s'], s['read_mb'], s['write_mb'], s['peak_rss_mb'],
+            s['process_peak_rss_mb']))
+    print('\nSlowest subjects:')
+    for s in summary['slowest_subjects']:
+        print('{0:<24} {1:>9.2f}s  {2}'.format(s['subject'], s['wall_s'], ', '.join('{0}: {1:.2f}s'.format(k, v) for k, v in sorted(s['stages'].items()))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,465 @@
+import sys
+import os
+import glob
+import math
+import time
+import queue
+import shutil
+import tempfile
+import logging
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from manifest import Manifest
+from indexer import DirectoryIndex
+from linking import LINK_MODES
+from conversion_map import open_conversion_map
+from inference import PROFILES, configure_environment, set_num_threads, summarize_latencies
+import metrics
+from common import get_log_file
+from volumes import INTERMEDIATE_FORMATS, find_volumes
+from volumetrics import VolumetricsTable, get_organs
+from label_archive import LabelArchive
+import extract_ukbb
+import extract_gnc
+import convert2nnunet
+import convert2original
+
+
+# marks the end of the subjects in a queue
+DONE = None
+
+
+def get_sources(dataset_name, input_folder, index_folder=None):
+    # returns {subject id: zip file (ukbb) or subject directory (gnc)}
+    index = DirectoryIndex(input_folder, index_folder)
+    if dataset_name == 'ukbb':
+        sources = {extract_ukbb.get_subject_id(f): f for f in index.files('*_20201_*.zip')}
+    else:
+        sources = {os.path.basename(os.path.dirname(d)): d for d in index.dirs()}
+    index.save()
+    return sources
+
+
+def extract_gnc_worker(sub_dir, nifti_folder, link_mode, intermediate_format, gzip_level):
+    sub_id = os.path.basename(os.path.dirname(sub_dir))
+    try:
+        sub_id, is_success = extract_gnc.format_subject(sub_dir, nifti_folder, link_mode, intermediate_format, gzip_level)
+        return sub_id, 'converted' if is_success else 'failed', None if is_success else 'Missing modalities'
+    except Exception as e:
+        logging.exception('Failed subject id [{0}]'.format(sub_id))
+        shutil.rmtree(os.path.join(nifti_folder, sub_id), ignore_errors=True)
+        return sub_id, 'failed', repr(e)
+
+
+class Pipeline(object):
+    # streams the subjects through extract -> convert -> predict -> convert_back, the stages are connected by bounded queues.
+    # at most queue_depth subjects are between extraction and convert_back at any time, and the intermediate files of a subject
+    # are deleted as soon as the next stage is done with them, so the scratch usage does not grow with the cohort size
+
+    def __init__(self, dataset_name, num_channels, work_folder, output_folder, make_predictor, queue_depth=2, extract_workers=1,
+                 in_memory=False, link_mode='hardlink', manifest_path=None, keep_intermediates=False, crop=False, crop_margin=20.0, metrics_file=None,
+                 intermediate_format='nii', gzip_level=None, low_memory=False, volumetrics_file=None, postprocess=False,
+                 output_format='nifti', archive_file=None, stitching_tool=None):
+        self.dataset_name = dataset_name
+        self.json_file = convert2nnunet.get_dataset_json(dataset_name, num_channels)
+        self.img_basenames = convert2nnunet.get_img_basenames(self.json_file)
+        self.nifti_folder = os.path.join(work_folder, 'nifti')
+        self.nnunet_folder = os.path.join(work_folder, 'nnunet')
+        self.prediction_folder = os.path.join(work_folder, 'predictions')
+        self.scratch_folder = os.path.join(work_folder, 'scratch')
+        self.output_folder = output_folder
+        self.make_predictor = make_predictor
+        self.queue_depth = max(queue_depth, 1)
+        self.extract_workers = max(extract_workers, 1)
+        self.in_memory = in_memory
+        self.link_mode = link_mode
+        self.manifest_path = manifest_path
+        self.keep_intermediates = keep_intermediates
+        self.crop = crop
+        self.crop_margin = crop_margin
+        self.metrics_file = metrics_file
+        self.intermediate_format = intermediate_format
+        self.gzip_level = gzip_level
+        self.low_memory = low_memory
+        self.volumetrics_file = volumetrics_file
+        self.postprocess = postprocess
+        self.output_format = output_format
+        self.archive_file = archive_file or convert2original.get_archive_path(output_folder)
+        self.label_names = {int(k): v for k, v in self.json_file['labels'].items() if int(k) > 0}
+        # None stitches the ukbb stations in-process with NumPy
+        self.stitching_tool = stitching_tool
+
+        # a slot is taken before a subject is extracted and given back when the subject leaves the pipeline
+        self.slots = threading.BoundedSemaphore(self.queue_depth)
+        self.extracted = queue.Queue(maxsize=self.queue_depth)
+        self.staged = queue.Queue(maxsize=self.queue_depth)
+        self.predicted = queue.Queue(maxsize=self.queue_depth)
+        self.results = {}
+        self.latencies = {}
+        self.lock = threading.Lock()
+        # queues of which DONE was taken or put, and the first error of a stage that failed as a whole
+        self.drained = set()
+        self.closed = set()
+        self.failure = None
+        # the rows of the manifest belong to the output folder of their stage
+        self.stage_folders = {'extract': self.nifti_folder, 'convert': self.nnunet_folder, 'predict': self.prediction_folder, 'convert_back': self.output_folder}
+
+    def open_manifest(self):
+        # sqlite connections cannot be shared between threads, every stage opens its own
+        return Manifest(self.manifest_path) if self.manifest_path is not None else None
+
+    def finish(self, subject_id, status, stage=None, error=None, manifest=None):
+        if status == 'failed':
+            logging.info('Failed subject id [{0}] at stage {1}: {2}'.format(subject_id, stage, error))
+            if manifest is not None:
+                manifest.update(subject_id, stage, 'failed', error=error, folder=self.stage_folders[stage])
+        with self.lock:
+            self.results[subject_id] = (status, stage, error)
+        self.slots.release()
+
+    def get(self, items):
+        item = items.get()
+        if item is DONE:
+            self.drained.add(items)
+        return item
+
+    def close(self, items):
+        if items not in self.closed:
+            self.closed.add(items)
+            items.put(DONE)
+
+    def run_stage(self, stage, input_queue, output_queue, *args):
+        # a stage that fails outside the handling of its subjects (e.g. the conversion map cannot be opened) stops the run:
+        # its remaining subjects are failed, so the slots are given back and the other stages and the main thread finish
+        try:
+            stage(*args)
+        except Exception as e:
+            logging.exception('Stage {0} failed'.format(threading.current_thread().name))
+            with self.lock:
+                if self.failure is None:
+                    self.failure = (threading.current_thread().name, e)
+            error = 'stage {0} failed: {1}'.format(threading.current_thread().name, repr(e))
+            while input_queue not in self.drained:
+                item = self.get(input_queue)
+                if item is not DONE:
+                    self.finish(item[0] if isinstance(item, tuple) else item['orig_subject'], 'failed', threading.current_thread().name, error)
+            if output_queue is not None:
+                self.close(output_queue)
+
+    def acquire_slot(self):
+        # gives up once a stage failed, since the slots of the stopped subjects may not come back
+        while not self.slots.acquire(timeout=1):
+            if self.failure is not None:
+                return False
+        return self.failure is None
+
+    def remove(self, paths):
+        if self.keep_intermediates:
+            return
+        for path in paths:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.lexists(path):
+                os.remove(path)
+
+    def convert_stage(self, num_subjects):
+        manifest = self.open_manifest()
+        conversion_map = open_conversion_map(self.nnunet_folder)
+        # case ids of subjects that are already in the map are kept, so a resumed run gives the same ids
+        cnt = conversion_map.get_max_subject_no()
+        if len(conversion_map) > 0:
+            num_of_digits = len(next(iter(conversion_map))['nnunet_subject']) - len(self.json_file['name']) - 1
+        else:
+            num_of_digits = int(math.log10(max(num_subjects, 1))) + 1
+
+        while True:
+            item = self.get(self.extracted)
+            if item is DONE:
+                break
+            subject_id, status, error = item
+            sub_path = os.path.join(self.nifti_folder, subject_id, '')
+            if status == 'failed':
+                self.remove([sub_path])
+                self.finish(subject_id, status, 'extract', error, manifest)
+                continue
+            try:
+                if manifest is not None:
+                    volumes = find_volumes(sub_path, ['wat', 'opp', 'fat', 'inp'])
+                    outputs = [volumes[m] for m in ['wat', 'opp', 'fat', 'inp']]
+                    manifest.update(subject_id, 'extract', 'done', outputs=outputs, folder=self.stage_folders['extract'])
+                existing = conversion_map.get_by_orig_subject(subject_id)
+                if len(existing) > 0:
+                    subject_no = existing[-1]['nnunet_subject_no']
+                else:
+                    cnt += 1
+                    subject_no = cnt
+                case_id = convert2nnunet.get_case_id(self.json_file['name'], subject_no, num_of_digits)
+                entry = convert2nnunet.format_subject(sub_path, self.nnunet_folder, self.img_basenames, case_id, subject_no, self.link_mode, self.crop, self.crop_margin, self.gzip_level)
+                conversion_map.append([entry])
+                if manifest is not None:
+                    manifest.update(subject_id, 'convert', 'done', outputs=[p['nnunet'] for p in entry['img_paths']], info={'nnunet_subject': case_id}, folder=self.stage_folders['convert'])
+                # the staged files are hardlinks or copies, the nifti files are not needed anymore
+                self.remove([sub_path])
+                logging.info('Staged subject id [{0}] as [{1}]'.format(subject_id, case_id))
+            except Exception as e:
+                logging.exception('Formatting failed for subject id [{0}]'.format(subject_id))
+                self.remove([sub_path])
+                self.finish(subject_id, 'failed', 'convert', repr(e), manifest)
+                continue
+            self.staged.put(entry)
+
+        self.close(self.staged)
+        conversion_map.close()
+
+    def predict_stage(self):
+        manifest = self.open_manifest()
+        # the predictor is created in the thread that uses it
+        try:
+            predictor, predictor_error = self.make_predictor(), None
+        except Exception as e:
+            logging.exception('Predictor could not be created')
+            predictor, predictor_error = None, repr(e)
+        while True:
+            entry = self.get(self.staged)
+            if entry is DONE:
+                break
+            subject_id = entry['orig_subject']
+            input_files = [p['nnunet'] for p in entry['img_paths']]
+            output_file = os.path.join(self.prediction_folder, entry['nnunet_subject'] + '.nii.gz')
+            if predictor is None:
+                self.finish(subject_id, 'failed', 'predict', predictor_error, manifest)
+                continue
+            try:
+                # the prediction is written to a temporary file, an existing prediction is always complete
+                tmp_file = os.path.join(self.prediction_folder, '.' + entry['nnunet_subject'] + '.nii.gz')
+                start = time.time()
+                with metrics.measure(subject_id, 'predict', nnunet_subject=entry['nnunet_subject']):
+                    predictor.predict_case(input_files, tmp_file, subject_id)
+                os.replace(tmp_file, output_file)
+                latency = time.time() - start
+                self.latencies[entry['nnunet_subject']] = latency
+                logging.info('Predicted subject id [{0}] in {1:.1f}s: {2}'.format(subject_id, latency, output_file))
+                if manifest is not None:
+                    manifest.update(subject_id, 'predict', 'done', outputs=[output_file], info={'nnunet_subject': entry['nnunet_subject']}, folder=self.stage_folders['predict'])
+            except Exception as e:
+                logging.exception('Prediction failed for subject id [{0}]'.format(subject_id))
+                self.finish(subject_id, 'failed', 'predict', repr(e), manifest)
+                continue
+            finally:
+                self.remove(input_files)
+            self.predicted.put(entry)
+
+        self.close(self.predicted)
+
+    def convert_back_stage(self):
+        manifest = self.open_manifest()
+        table = VolumetricsTable(self.volumetrics_file, get_organs(self.label_names)) if self.volumetrics_file is not None else None
+        archive = LabelArchive(self.archive_file) if self.output_format != 'nifti' else None
+        while True:
+            entry = self.get(self.predicted)
+            if entry is DONE:
+                break
+            subject_id = entry['orig_subject']
+            try:
+                new_pred_path, removed, row, record = convert2original.format_back_subject(entry, self.prediction_folder, self.output_folder, self.link_mode,
+                                                                                           postprocess=self.postprocess, label_names=self.label_names,
+                                                                                           volumetrics=table is not None and subject_id not in table,
+                                                                                           output_format=self.output_format)
+                if record is not None:
+                    archive.put(record)
+                if row is not None:
+                    table.append(row)
+                if manifest is not None:
+                    info = {'nnunet_subject': entry['nnunet_subject']}
+                    if removed is not None:
+                        info['removed_voxels'] = removed
+                    if archive is not None:
+                        info['archive'] = archive.path
+                    manifest.update(subject_id, 'convert_back', 'done', outputs=[new_pred_path] if new_pred_path is not None else [], info=info, folder=self.stage_folders['convert_back'])
+                logging.info('Finished subject id [{0}]: {1}'.format(subject_id, new_pred_path or archive.path))
+            except Exception as e:
+                logging.exception('Converting back failed for subject id [{0}]'.format(subject_id))
+                self.finish(subject_id, 'failed', 'convert_back', repr(e), manifest)
+                continue
+            self.remove([os.path.join(self.prediction_folder, entry['nnunet_subject'] + '.nii.gz')])
+            self.finish(subject_id, 'converted')
+
+        if archive is not None:
+            archive.close()
+
+    def run(self, sources):
+        for folder in [self.nifti_folder, self.nnunet_folder, self.prediction_folder, self.output_folder]:
+            os.makedirs(folder, exist_ok=True)
+        # the run only works in its own folder, so concurrent runs with the same work_folder do not remove each other's files
+        os.makedirs(self.scratch_folder, exist_ok=True)
+        run_folder = tempfile.mkdtemp(prefix='run_', dir=self.scratch_folder)
+        log_folder = os.path.join(run_folder, 'logs')
+        os.makedirs(log_folder, exist_ok=True)
+
+        stages = [threading.Thread(target=self.run_stage, args=(self.convert_stage, self.extracted, self.staged, len(sources)), name='convert'),
+                  threading.Thread(target=self.run_stage, args=(self.predict_stage, self.staged, self.predicted), name='predict'),
+                  threading.Thread(target=self.run_stage, args=(self.convert_back_stage, self.predicted, None), name='convert_back')]
+        for stage in stages:
+            stage.start()
+
+        def put_extracted(subject_id, future):
+            try:
+                self.extracted.put(future.result())
+            except Exception as e:
+                self.extracted.put((subject_id, 'failed', repr(e)))
+
+        with ProcessPoolExecutor(max_workers=self.extract_workers, initializer=extract_ukbb.init_worker, initargs=(log_folder, self.metrics_file)) as executor:
+            for subject_id, source in sources.items():
+                # blocks while queue_depth subjects are in the pipeline
+                if not self.acquire_slot():
+                    break
+                if self.dataset_name == 'ukbb':
+                    future = executor.submit(extract_ukbb.stitch_worker, source, self.nifti_folder, self.stitching_tool, run_folder, self.in_memory,
+                                             self.intermediate_format, self.gzip_level, self.low_memory)
+                else:
+                    future = executor.submit(extract_gnc_worker, source, self.nifti_folder, self.link_mode, self.intermediate_format, self.gzip_level)
+                future.add_done_callback(lambda f, subject_id=subject_id: put_extracted(subject_id, f))
+
+        # all extractions are done and queued at this point
+        self.extracted.put(DONE)
+        for stage in stages:
+            stage.join()
+
+        for log_file in sorted(glob.glob(os.path.join(log_folder, 'worker_*_log.txt'))):
+            with open(log_file, 'r', encoding='utf-8') as handle:
+                logging.info('Log of {0}:\n{1}'.format(os.path.basename(log_file), handle.read()))
+        shutil.rmtree(run_folder, ignore_errors=True)
+        if self.failure is not None:
+            raise RuntimeError('Stage {0} of the pipeline failed'.format(self.failure[0])) from self.failure[1]
+        return self.results
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_folder', required=True, help='Folder that contains downloaded zip files (ukbb) or subject folders with nii.gz files (gnc)')
+    parser.add_argument('--work_folder', required=True, help='Folder for the intermediate files (nifti, nnunet and raw predictions), e.g. a node-local disk. \
+                                                             Its size is proportional to queue_depth and not to the number of subjects.')
+    parser.add_argument('--output_folder', required=True, help='Folder that contains the final predictions with the original naming')
+    parser.add_argument('--dataset_name', required=True, choices=['ukbb', 'gnc'], help='Dataset name is either ukbb or gnc')
+    parser.add_argument('--num_channels', type=int, required=True, choices=[1, 4], help='Number of channels to be used. Either 1 or 4.')
+    parser.add_argument('--num_subjects', type=int, required=False, default=-1, help='Subjects are firstly ordered. Then, they are selected from index [start_idx] to index [start_idx + num_subjects]. If zero or less, all subjects from index [start_idx] to the end.')
+    parser.add_argument('--start_idx', type=int, required=False, default=0, help='Subjects are firstly ordered. Then, they are selected from index [start_idx] to index [start_idx + num_subjects].')
+    parser.add_argument('--queue_depth', type=int, required=False, default=4, help='Maximum number of subjects in the pipeline at the same time. Bounds the size of work_folder.')
+    parser.add_argument('--extract_workers', type=int, required=False, default=1, help='Number of worker processes for the extraction, which overlaps with the predictions.')
+    parser.add_argument('--in_memory', action='store_true', help='Read DICOMs directly from the zip files into memory instead of extracting them to disk (ukbb).')
+    parser.add_argument('--stitching', required=False, default='tool', choices=['tool', 'numpy'], help='Stitch the ukbb stations with the external stitching tool (default) or in-process with NumPy, see extract_ukbb.py.')
+    parser.add_argument('--low_memory', action='store_true', help='With --in_memory and --stitching numpy, decode and stitch the series of one contrast at a time, see extract_ukbb.py.')
+    parser.add_argument('--link_mode', required=False, default='hardlink', choices=[m for m in LINK_MODES if m != 'symlink'], help='How files are passed between the stages. \
+                                                                                                                            Symlinks are not possible, since the intermediates are deleted.')
+    parser.add_argument('--device', required=False, default='cuda', choices=['cuda', 'cpu'], help='Device for the predictions. CUDA_VISIBLE_DEVICES is only required for cuda.')
+    parser.add_argument('--num_threads', type=int, required=False, default=None, help='Number of torch threads, e.g. the number of cores of a CPU node.')
+    parser.add_argument('--profile', required=False, default='accurate', choices=sorted(PROFILES.keys()), help='Speed profile of the predictions, see predict.py.')
+    parser.add_argument('--manifest', required=False, default=None, help='SQLite file that records the state of each subject at each stage.')
+    parser.add_argument('--index_folder', required=False, default=None, help='Folder for snapshots of the listing of input_folder, see extract_ukbb.py.')
+    parser.add_argument('--crop', action='store_true', help='Predict only the abdomen, see convert2nnunet.py.')
+    parser.add_argument('--crop_margin', type=float, required=False, default=20.0, help='Safety margin of the crop box in mm.')
+    parser.add_argument('--intermediate_format', required=False, default=None, choices=INTERMEDIATE_FORMATS, help='Format of the extracted volumes in work_folder. \
+                                                                                                                Default is nii for ukbb (not compressed) and nii.gz for gnc (linked input files).')
+    parser.add_argument('--gzip_level', type=int, required=False, default=None, choices=range(10), help='Compression level of the nii.gz files in work_folder, 0 (no compression) to 9. Default is the level of nibabel (1).')
+    parser.add_argument('--postprocess', action='store_true', help='Keep only the largest connected component of each organ, see convert2original.py.')
+    parser.add_argument('--output_format', required=False, default='nifti', choices=convert2original.OUTPUT_FORMATS, help='Format of the final label maps, see convert2original.py.')
+    parser.add_argument('--archive_file', required=False, default=None, help='Label archive of the archive and both output formats. Default is labels.db in output_folder.')
+    parser.add_argument('--volumetrics_file', required=False, default=None, help='CSV file to which the volumetrics of each organ are appended per subject, see convert2original.py.')
+    parser.add_argument('--metrics_file', required=False, default=None, help='JSONL file to which the timing and resources of each subject and step are appended, see metrics.py.')
+    parser.add_argument('--keep_intermediates', action='store_true', help='Do not delete the intermediate files, e.g. for debugging.')
+    parser.add_argument('--stand_in', action='store_true', help='Use a small untrained network on CPU instead of the nnUNet model, e.g. for testing.')
+    args = parser.parse_args()
+
+    input_folder = os.path.abspath(args.input_folder)
+    work_folder = os.path.abspath(args.work_folder)
+    output_folder = os.path.abspath(args.output_folder)
+    dataset_name = args.dataset_name
+    num_channels = args.num_channels
+    num_subjects = args.num_subjects
+    start_idx = max(args.start_idx, 0)
+    metrics.configure(args.metrics_file)
+    # before torch is imported
+    configure_environment('cpu' if args.stand_in else args.device, args.num_threads)
+    intermediate_format = args.intermediate_format
+    if intermediate_format is None:
+        intermediate_format = 'nii' if dataset_name == 'ukbb' else 'nii.gz'
+
+    # the temporary log is unique per process, so that concurrent runs do not write into the same file
+    log_file_path = get_log_file(__file__, basename='{0}_{1}_log.txt'.format(os.path.basename(output_folder), os.getpid()))
+    logging.basicConfig(
+        format='%(asctime)s: %(threadName)s: %(message)s',
+        level=logging.INFO,
+        handlers=[
+            logging.FileHandler(filename=log_file_path, mode='w', encoding='utf-8'),
+            logging.StreamHandler(sys.stdout)
+    ])
+
+    logging.info('Started pipeline...')
+    for key, value in sorted(vars(args).items()):
+        logging.info('{0}: {1}'.format(key, value))
+    logging.info('')
+
+    if not args.stand_in:
+        if args.device == 'cuda' and 'CUDA_VISIBLE_DEVICES' not in os.environ:
+            raise RuntimeError('The environment variable CUDA_VISIBLE_DEVICES must be set. This is the GPU number which nnUNet will use for predictions.')
+        if 'RESULTS_FOLDER' not in os.environ:
+            raise RuntimeError('The environment variable RESULTS_FOLDER must be set. This is the place where nnUNet will look for the models.')
+    if args.num_threads is not None:
+        set_num_threads(args.num_threads)
+
+    sources = get_sources(dataset_name, input_folder, args.index_folder)
+    subject_ids = sorted(sources)
+    if num_subjects > 0 and start_idx + num_subjects <= len(subject_ids):
+        subject_ids = subject_ids[start_idx:start_idx + num_subjects]
+    else:
+        subject_ids = subject_ids[start_idx:]
+
+    # finished subjects are skipped, so an interrupted run can be resumed. with the archive and both formats, they must be in the archive
+    os.makedirs(output_folder, exist_ok=True)
+    archive = LabelArchive(args.archive_file or convert2original.get_archive_path(output_folder)) if args.output_format != 'nifti' else None
+    finished = [s for s in subject_ids if convert2original.is_converted(s, output_folder, args.output_format, archive)]
+    if archive is not None:
+        archive.close()
+    sources = {s: sources[s] for s in subject_ids if s not in set(finished)}
+    logging.info('Number of already finished subjects: {0}'.format(len(finished)))
+    logging.info('Number of subjects will be processed: {0}\n'.format(len(sources)))
+
+    if args.stand_in:
+        from inference import TorchPredictor, get_stand_in_network
+        make_predictor = lambda: TorchPredictor(get_stand_in_network(num_channels), device='cpu')
+    else:
+        from predict import prepare_model
+        from inference import NnunetPredictor, BatchedNnunetPredictor
+        task_name, model_folder = prepare_model(dataset_name, num_channels)
+        if args.device == 'cpu':
+            # the own sliding window never moves the data to the GPU as the one of nnUNet does
+            make_predictor = lambda: BatchedNnunetPredictor(model_folder, patches_per_batch=1, device=args.device, **PROFILES[args.profile])
+        else:
+            make_predictor = lambda: NnunetPredictor(model_folder, device=args.device, **PROFILES[args.profile])
+
+    stitching_tool = None
+    if dataset_name == 'ukbb' and args.stitching == 'tool':
+        stitching_tool = extract_ukbb.get_stitching_tool()
+        logging.info('Stitching tool: {0}\n'.format(stitching_tool))
+
+    pipeline = Pipeline(dataset_name, num_channels, work_folder, output_folder, make_predictor, args.queue_depth, args.extract_workers,
+                        args.in_memory, args.link_mode, args.manifest, args.keep_intermediates, args.crop, args.crop_margin, args.metrics_file,
+                        intermediate_format, args.gzip_level, args.low_memory, args.volumetrics_file, args.postprocess,
+                        args.output_format, args.archive_file, stitching_tool)
+    results = pipeline.run(sources)
+
+    logging.info('Number of converted subjects: {0}'.format(len([r for r in results.values() if r[0] == 'converted'])))
+    logging.info('Number of failed subjects: {0}'.format(len([r for r in results.values() if r[0] == 'failed'])))
+    logging.info('Latency of the predictions: {0}'.format(summarize_latencies(pipeline.latencies)))
+    logging.info('Failed subjects: {0}\n'.format(sorted((s, r[1], r[2]) for s, r in results.items() if r[0] == 'failed')))
+
+    logging.info('Finished pipeline...')
+    shutil.copy2(log_file_path, get_log_file(__file__, dir_path=output_folder, basename=os.path.basename(output_folder) + '_log.txt'))
+    os.remove(log_file_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,23 +3,93 @@ import os
 import shutil
 import logging
 import zipfile
+import socket
+import json
 import argparse
 import urllib.request
 
-import nnunet.inference.predict_simple as ps
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
+from manifest import Manifest
+from conversion_map import load_conversion_map, update_conversion_map
+from inference import NnunetPredictor, BatchedNnunetPredictor, PROFILES, PRECISIONS, get_artifact_path, predict_folder, configure_environment, set_num_threads, summarize_latencies
+from sharding import run_workers
+from common import get_log_file
+import metrics
 
-def get_log_file(dir_path=None, basename=None):
-    file_name, file_extension  = os.path.splitext(__file__)
-    if dir_path is None and basename is None:
-        log_file_path = file_name + '_log.txt'
-    elif dir_path is not None and basename is None:
-        log_file_path = os.path.join(dir_path, os.path.basename(file_name) + '_log.txt')
-    elif dir_path is None and basename is not None:
-        log_file_path = os.path.join(os.path.dirname(file_name), basename)
+
+def record_predictions(manifest, prediction_folder):
+    conversion_map = load_conversion_map(prediction_folder)
+
+    # a single scan of the prediction folder instead of one check per subject
+    pred_names = set(entry.name for entry in os.scandir(prediction_folder) if entry.name.endswith('.nii.gz'))
+    for entry in conversion_map:
+        pred_name = entry['nnunet_subject'] + '.nii.gz'
+        if pred_name in pred_names:
+            manifest.update(entry['orig_subject'], 'predict', 'done', outputs=[os.path.join(prediction_folder, pred_name)], info={'nnunet_subject': entry['nnunet_subject']}, commit=False, folder=prediction_folder)
+        else:
+            manifest.update(entry['orig_subject'], 'predict', 'failed', info={'nnunet_subject': entry['nnunet_subject']}, error='No prediction', commit=False, folder=prediction_folder)
+    manifest.commit()
+
+
+def copy_atomic(src, dst):
+    # several nodes may copy the same file into a shared folder at the same time
+    tmp_dst = '{0}.{1}.{2}.tmp'.format(dst, socket.gethostname(), os.getpid())
+    shutil.copy2(src, tmp_dst)
+    os.replace(tmp_dst, dst)
+
+
+def append_log(log_file_path, dst, title):
+    # the parts of a sharded run append their logs to one log of prediction_folder, the lock keeps the logs of several nodes apart
+    with open(log_file_path, 'r', encoding='utf-8') as handle:
+        content = '{0}\n{1}\n'.format(title, handle.read()).encode('utf-8')
+    fd = os.open(dst, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        os.write(fd, content)
+    finally:
+        os.close(fd)
+
+
+def prepare_model(dataset_name, num_channels, model='3d_fullres', folds='all'):
+    # returns the task and the nnUNet model folder, the model is downloaded into RESULTS_FOLDER if it does not exist
+    if dataset_name == 'ukbb' and num_channels == 4:
+        task_name = '501'
+        retrieval_url = 'https://gitlab.com/turkaykart/ukbb-gnc-abdominal-segmentation/-/raw/main/ukbb_4ch_model.zip?inline=false'
+        retrival_name = 'ukbb_4ch_model.zip'
+    elif dataset_name == 'ukbb' and num_channels == 1:
+        task_name = '502'
+        retrieval_url = 'https://gitlab.com/turkaykart/ukbb-gnc-abdominal-segmentation/-/raw/main/ukbb_1ch_model.zip?inline=false'
+        retrival_name = 'ukbb_1ch_model.zip'
+    elif dataset_name == 'gnc' and num_channels == 4:
+        task_name = '503'
+        retrieval_url = 'https://gitlab.com/turkaykart/ukbb-gnc-abdominal-segmentation/-/raw/main/gnc_4ch_model.zip?inline=false'
+        retrival_name = 'gnc_4ch_model.zip'
+    elif dataset_name == 'gnc' and num_channels == 1:
+        task_name = '504'
+        retrieval_url = 'https://gitlab.com/turkaykart/ukbb-gnc-abdominal-segmentation/-/raw/main/gnc_1ch_model.zip?inline=false'
+        retrival_name = 'gnc_1ch_model.zip'
+    
+    model_folder = os.path.join(os.environ['RESULTS_FOLDER'], 'nnUNet', model, 'Task{0}_{1}_{2}ch'.format(task_name, dataset_name, num_channels), 'nnUNetTrainerV2__nnUNetPlansv2.1')
+    model_location = os.path.join(model_folder, folds, 'model_final_checkpoint.model')
+    logging.info('model_location: {0}\n'.format(model_location))
+    if os.path.isfile(model_location):
+        logging.info('model exists at the location...')
     else:
-        log_file_path = os.path.join(dir_path, basename)
-    return log_file_path
+        logging.info('Downloading: [Dataset: {0}, Number_of_Channels:{1}]...'.format(dataset_name, num_channels))
+        urllib.request.urlretrieve(retrieval_url, retrival_name)
+        os.chmod(retrival_name, 0o755)
+        zip_ref = zipfile.ZipFile(retrival_name, 'r')
+        zip_ref.extractall(os.environ['RESULTS_FOLDER'])
+        zip_ref.close()
+        os.system('chmod -R 755 {0}'.format(os.environ['RESULTS_FOLDER']))
+        logging.info('model is downloaded.')
+
+    return task_name, model_folder
 
 
 def main():
@@ -32,14 +102,62 @@ def main():
     parser.add_argument('--prediction_folder', required=True, help='Folder that contains final predictions')
     parser.add_argument('--dataset_name', required=True, choices=['ukbb', 'gnc'], help='Dataset name is either ukbb or gnc')    
     parser.add_argument('--num_channels', type=int, required=True, choices=[1, 4], help='Number of channels to be used. Either 1 or 4.')
+    parser.add_argument('--manifest', required=False, default=None, help='SQLite file that records the state of each subject. If given, the predicted subjects are recorded in the manifest.')
+    parser.add_argument('--device', required=False, default='cuda', choices=['cuda', 'cpu'], help='Device for the predictions. CUDA_VISIBLE_DEVICES is only required for cuda.')
+    parser.add_argument('--num_threads', type=int, required=False, default=None, help='Number of torch threads, e.g. the number of cores of a CPU node.')
+    parser.add_argument('--profile', required=False, default=None, choices=sorted(PROFILES.keys()), help='Speed profile of the in-process predictions: fast (no mirroring, step size 1, no gaussian weighting), \
+                                                                                                  balanced (no mirroring, step size 0.5) or accurate (nnUNet default). \
+                                                                                                  The latency of each case is reported in latency.json. Default is accurate for cpu.')
+    parser.add_argument('--num_parts', type=int, required=False, default=1, help='Number of parts the cases are split into, e.g. one part per node.')
+    parser.add_argument('--part_id', type=int, required=False, default=0, help='Part of the cases that is predicted by this run, from 0 to num_parts - 1.')
+    parser.add_argument('--num_workers', type=int, required=False, default=1, help='Number of local worker processes. Workers of all parts and nodes claim cases through file locks in prediction_folder, \
+                                                                                   so no case is predicted twice.')
+    parser.add_argument('--lock_timeout', type=float, required=False, default=12, help='Hours after which the lock of a case is reclaimed, e.g. of a worker on a lost node. \
+                                                                                  The lock of a worker that is gone on the same node (e.g. killed) is reclaimed right away. \
+                                                                                  Zero or less only reclaims the locks of such workers.')
+    parser.add_argument('--patches_per_batch', type=int, required=False, default=None, help='Number of sliding-window patches in each forward pass of the in-process predictions. \
+                                                                                               The patches of consecutive cases are batched together, so small (e.g. cropped) cases fill the batches. \
+                                                                                               Default is one patch per forward pass as in nnUNet.')
+    parser.add_argument('--precision', required=False, default='fp32', choices=PRECISIONS, help='Precision of the network of the in-process predictions. bf16 and int8 (cpu only) need the network \
+                                                                                          exported by quantization.py, which also reports the Dice agreement with fp32.')
+    parser.add_argument('--cache_folder', required=False, default=None, help='Folder of the preprocessed cases of the in-process predictions. A case is preprocessed again only if its input files or the \
+                                                                           preprocessing plan of the model change, e.g. not for another profile or fold. Can be shared by several runs and nodes.')
+    parser.add_argument('--cache_size_gb', type=float, required=False, default=None, help='Maximum size of cache_folder in GB. The least recently used cases are removed. Default is no limit.')
+    parser.add_argument('--num_prefetch', type=int, required=False, default=0, help='Number of the next cases that are preprocessed in worker processes while a case is predicted. \
+                                                                              Only without num_workers and num_parts.')
+    parser.add_argument('--metrics_file', required=False, default=None, help='JSONL file to which the timing and resources of each case are appended, see metrics.py. \
+                                                                           Only for the in-process predictions (with a profile).')
     args = parser.parse_args()
     
     nnunet_folder = os.path.abspath(args.nnunet_folder)
     prediction_folder = os.path.abspath(args.prediction_folder)
     dataset_name = args.dataset_name
     num_channels = args.num_channels
+    manifest = Manifest(args.manifest) if args.manifest is not None else None
+    device = args.device
+    num_threads = args.num_threads
+    profile = args.profile
+    num_parts = max(args.num_parts, 1)
+    part_id = args.part_id
+    num_workers = max(args.num_workers, 1)
+    lock_timeout = args.lock_timeout * 3600 if args.lock_timeout > 0 else None
+    patches_per_batch = args.patches_per_batch
+    precision = args.precision
+    cache_folder = os.path.abspath(args.cache_folder) if args.cache_folder is not None else None
+    num_prefetch = max(args.num_prefetch, 0)
+    metrics.configure(args.metrics_file)
+    is_sharded = num_parts > 1 or num_workers > 1
+    # before torch is imported, the workers of a sharded run set their own number of threads
+    configure_environment(device, num_threads if not is_sharded else None)
+    if profile is None and (device == 'cpu' or is_sharded or patches_per_batch is not None or precision != 'fp32' or cache_folder is not None or num_prefetch > 0):
+        profile = 'accurate'
+    if not 0 <= part_id < num_parts:
+        raise ValueError('part_id must be between 0 and num_parts - 1.')
     
-    log_file_path = get_log_file(basename=os.path.basename(prediction_folder) + '_log.txt')
+    # the parts of a sharded run append their logs to the same log at the end, so that several nodes do not overwrite each other's log
+    log_basename = os.path.basename(prediction_folder) + '_log.txt'
+    # the temporary log is unique per process, so that concurrent runs do not write into the same file
+    log_file_path = get_log_file(__file__, basename='{0}_{1}'.format(os.getpid(), log_basename))
     logging.basicConfig(
         format='%(asctime)s: %(message)s',  
         level=logging.NOTSET, 
@@ -49,76 +167,113 @@ def main():
     ])
     
     logging.info('Started predict...')
-    logging.info('CUDA_VISIBLE_DEVICES: {0}'.format(os.environ['CUDA_VISIBLE_DEVICES']))
-    logging.info('RESULTS_FOLDER: {0}'.format(os.environ['RESULTS_FOLDER']))
+    logging.info('CUDA_VISIBLE_DEVICES: {0}'.format(os.environ.get('CUDA_VISIBLE_DEVICES')))
+    logging.info('RESULTS_FOLDER: {0}'.format(os.environ.get('RESULTS_FOLDER')))
     logging.info('nnunet_folder: {0}'.format(nnunet_folder))
     logging.info('prediction_folder: {0}'.format(prediction_folder))
     logging.info('dataset_name: {0}'.format(dataset_name))
-    logging.info('num_channels: {0}\n'.format(num_channels))
+    logging.info('num_channels: {0}'.format(num_channels))
+    logging.info('manifest: {0}'.format(args.manifest))
+    logging.info('device: {0}'.format(device))
+    logging.info('num_threads: {0}'.format(num_threads))
+    logging.info('profile: {0}'.format(profile))
+    logging.info('num_parts: {0}'.format(num_parts))
+    logging.info('part_id: {0}'.format(part_id))
+    logging.info('num_workers: {0}'.format(num_workers))
+    logging.info('lock_timeout: {0}'.format(args.lock_timeout))
+    logging.info('patches_per_batch: {0}'.format(patches_per_batch))
+    logging.info('precision: {0}'.format(precision))
+    logging.info('cache_folder: {0}'.format(cache_folder))
+    logging.info('cache_size_gb: {0}'.format(args.cache_size_gb))
+    logging.info('num_prefetch: {0}'.format(num_prefetch))
+    logging.info('metrics_file: {0}\n'.format(args.metrics_file))
     
     
-    if 'CUDA_VISIBLE_DEVICES' not in os.environ:
-        raise('The environment variable CUDA_VISIBLE_DEVICES must be set. This is the GPU number which nnUNet will use for predictions.')
+    if device == 'cuda' and 'CUDA_VISIBLE_DEVICES' not in os.environ:
+        raise RuntimeError('The environment variable CUDA_VISIBLE_DEVICES must be set. This is the GPU number which nnUNet will use for predictions.')
     
     if 'RESULTS_FOLDER' not in os.environ:
-        raise('The environment variable RESULTS_FOLDER must be set. This is the place where nnUNet will look for the models.')
+        raise RuntimeError('The environment variable RESULTS_FOLDER must be set. This is the place where nnUNet will look for the models.')
+
+    if num_threads is not None and not is_sharded:
+        set_num_threads(num_threads)
     
     os.makedirs(os.environ['RESULTS_FOLDER'], exist_ok=True)
     
     model = '3d_fullres'
     folds = 'all'
     
-    if dataset_name == 'ukbb' and num_channels == 4:
-        task_name = '501'
-        retrieval_url = 'https://gitlab.com/turkaykart/ukbb-gnc-abdominal-segmentation/-/raw/main/ukbb_4ch_model.zip?inline=false'
-        retrival_name = 'ukbb_4ch_model.zip'
-    elif dataset_name == 'ukbb' and num_channels == 1:
-        task_name = '502'
-        retrieval_url = 'https://gitlab.com/turkaykart/ukbb-gnc-abdominal-segmentation/-/raw/main/ukbb_1ch_model.zip?inline=false'
-        retrival_name = 'ukbb_1ch_model.zip'
-    elif dataset_name == 'gnc' and num_channels == 4:
-        task_name = '503'
-        retrieval_url = 'https://gitlab.com/turkaykart/ukbb-gnc-abdominal-segmentation/-/raw/main/gnc_4ch_model.zip?inline=false'
-        retrival_name = 'gnc_4ch_model.zip'
-    elif dataset_name == 'gnc' and num_channels == 1:
-        task_name = '504'
-        retrieval_url = 'https://gitlab.com/turkaykart/ukbb-gnc-abdominal-segmentation/-/raw/main/gnc_1ch_model.zip?inline=false'
-        retrival_name = 'gnc_1ch_model.zip'
-    
-    model_location = os.path.join(os.environ['RESULTS_FOLDER'], 'nnUNet', model, 'Task{0}_{1}_{2}ch'.format(task_name, dataset_name, num_channels), 'nnUNetTrainerV2__nnUNetPlansv2.1', folds, 'model_final_checkpoint.model')
-    logging.info('model_location: {0}\n'.format(model_location))
-    if os.path.isfile(model_location):
-        logging.info('model exists at the location...')
-    else:
-        logging.info('Downloading: [Dataset: {0}, Number_of_Channels:{1}]...'.format(dataset_name, num_channels))
-        urllib.request.urlretrieve(retrieval_url, retrival_name)
-        os.chmod(retrival_name, 0o755)
-        zip_ref = zipfile.ZipFile(retrival_name, 'r')
-        zip_ref.extractall(os.environ['RESULTS_FOLDER'])
-        zip_ref.close()
-        os.system('chmod -R 755 {0}'.format(os.environ['RESULTS_FOLDER']))
-        logging.info('model is downloaded.')
+    task_name, model_folder = prepare_model(dataset_name, num_channels, model, folds)
     
     os.makedirs(prediction_folder, exist_ok=True)
-    shutil.copy2(os.path.join(nnunet_folder, 'conversion.pkl'), os.path.join(prediction_folder, 'conversion.pkl'))
-    shutil.copy2(os.path.join(nnunet_folder, 'dataset.json'), os.path.join(prediction_folder, 'dataset.json'))
+    copy_atomic(os.path.join(nnunet_folder, 'dataset.json'), os.path.join(prediction_folder, 'dataset.json'))
+    # only the new entries of an incremental conversion are added to the conversion map of prediction_folder
+    num_updated = update_conversion_map(nnunet_folder, prediction_folder)
     
     logging.info('dataset.json: {0}'.format(os.path.join(prediction_folder, 'dataset.json')))
-    logging.info('conversion.pkl: {0}\n'.format(os.path.join(prediction_folder, 'conversion.pkl')))
-    
-    sys.argv = [sys.argv[0],
-                '--input_folder', nnunet_folder, 
-                '--output_folder', prediction_folder, 
-                '--task_name', task_name, 
-                '--model', model, 
-                '--folds', folds]
-     
-    logging.info('sys.argv: {0}\n'.format(sys.argv))
+    logging.info('conversion.db: {0} ({1} new or changed entries)\n'.format(os.path.join(prediction_folder, 'conversion.db'), num_updated))
     
-    ps.main()
+    # nnUNet skips cases that already have a prediction, so only new cases (e.g. appended with convert2nnunet.py --incremental) are predicted
+    conversion_map = load_conversion_map(nnunet_folder)
+    pred_names = set(entry.name for entry in os.scandir(prediction_folder) if entry.name.endswith('.nii.gz'))
+    new_cases = [entry['nnunet_subject'] for entry in conversion_map if entry['nnunet_subject'] + '.nii.gz' not in pred_names]
+    logging.info('Number of cases with existing predictions: {0}'.format(len(conversion_map) - len(new_cases)))
+    logging.info('Number of cases to be predicted: {0}\n'.format(len(new_cases)))
+
+    if profile is None:
+        sys.argv = [sys.argv[0],
+                    '--input_folder', nnunet_folder, 
+                    '--output_folder', prediction_folder, 
+                    '--task_name', task_name, 
+                    '--model', model, 
+                    '--folds', folds]
+         
+        logging.info('sys.argv: {0}\n'.format(sys.argv))
+        
+        if len(new_cases) > 0:
+            # nnUNet imports torch and the CUDA libraries, which takes several seconds
+            import nnunet.inference.predict_simple as ps
+            ps.main()
+    elif len(new_cases) > 0:
+        logging.info('Profile [{0}]: {1}\n'.format(profile, PROFILES[profile]))
+        predictor_kwargs = dict(model_folder=model_folder, folds=folds, device=device, cache_folder=cache_folder, cache_size_gb=args.cache_size_gb,
+                                num_prefetch=0 if is_sharded else num_prefetch, **PROFILES[profile])
+        make_predictor = NnunetPredictor
+        # the cpu path uses the own sliding window, which never moves the data to the GPU as the one of nnUNet does
+        if device == 'cpu' or patches_per_batch is not None or precision != 'fp32':
+            # the workers of a sharded run claim one case at a time, so only the patches of the same case are batched
+            make_predictor = BatchedNnunetPredictor
+            predictor_kwargs['patches_per_batch'] = patches_per_batch if patches_per_batch is not None else 1
+            predictor_kwargs['precision'] = precision
+        if precision != 'fp32':
+            report_path = get_artifact_path(model_folder, precision, folds) + '.json'
+            if os.path.isfile(report_path):
+                with open(report_path, 'r') as handle:
+                    logging.info('Dice of the {0} network against fp32: {1}\n'.format(precision, json.load(handle)['summary']))
+            else:
+                logging.info('No Dice check of the {0} network found at {1}\n'.format(precision, report_path))
+        if is_sharded:
+            latencies = run_workers(num_workers, make_predictor, predictor_kwargs, nnunet_folder, prediction_folder, num_parts, part_id, num_threads, args.metrics_file,
+                                    lock_timeout)
+        else:
+            latencies = {}
+            predict_folder(make_predictor(**predictor_kwargs), nnunet_folder, prediction_folder, latencies=latencies)
+
+        summary = summarize_latencies(latencies)
+        logging.info('Latency per case [profile: {0}, device: {1}, num_threads: {2}]: {3}\n'.format(profile, device, num_threads, summary))
+        latency_name = 'latency_part{0}.json'.format(part_id) if num_parts > 1 else 'latency.json'
+        with open(os.path.join(prediction_folder, latency_name), 'w') as handle:
+            json.dump({'profile': profile, 'device': device, 'num_threads': num_threads, 'summary': summary, 'latencies': latencies}, handle, indent=2)
+
+    if manifest is not None:
+        record_predictions(manifest, prediction_folder)
 
     logging.info('Finished predict...')
-    shutil.copy2(log_file_path, get_log_file(dir_path=prediction_folder, basename=os.path.basename(prediction_folder) + '_log.txt'))
+    if num_parts > 1:
+        append_log(log_file_path, get_log_file(__file__, dir_path=prediction_folder, basename=log_basename),
+                   '===== Log of part {0} of {1} ({2}, pid {3}) ====='.format(part_id, num_parts, socket.gethostname(), os.getpid()))
+    else:
+        shutil.copy2(log_file_path, get_log_file(__file__, dir_path=prediction_folder, basename=log_basename))
     os.remove(log_file_path)
 
 
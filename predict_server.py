@@ -0,0 +1,150 @@
+import sys
+import os
+import json
+import socket
+import logging
+import argparse
+import socketserver
+
+from inference import predict_folder, configure_environment, set_num_threads, PROFILES
+
+
+def handle_request(predictor, request):
+    # a request is either a case {'case', 'input_files', 'output_file'} or a folder {'input_folder', 'output_folder'}
+    if 'input_folder' in request:
+        predictions = predict_folder(predictor, request['input_folder'], request['output_folder'], request.get('overwrite', False))
+    else:
+        case = request.get('case', os.path.basename(request['output_file']).replace('.nii.gz', ''))
+        predictions = {case: predictor.predict_case(request['input_files'], request['output_file'], case)}
+    return {'status': 'ok', 'predictions': predictions}
+
+
+class PredictionHandler(socketserver.StreamRequestHandler):
+    # one JSON request per line, each is answered with one JSON line
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if request.get('command') == 'shutdown':
+                    self.server.running = False
+                    response = {'status': 'ok'}
+                else:
+                    logging.info('Request: {0}'.format(request))
+                    response = handle_request(self.server.predictor, request)
+            except Exception as e:
+                logging.exception('Request failed')
+                response = {'status': 'error', 'error': repr(e)}
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class PredictionServer(socketserver.UnixStreamServer):
+    # requests are handled one after another by the same predictor, so the model is loaded only once
+
+    def __init__(self, socket_path, predictor):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, PredictionHandler)
+        self.socket_path = socket_path
+        self.predictor = predictor
+        self.running = True
+
+    def serve(self):
+        try:
+            while self.running:
+                self.handle_request()
+        finally:
+            self.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+
+def submit(socket_path, request):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        with sock.makefile('r', encoding='utf-8') as handle:
+            return json.loads(handle.readline())
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', required=True, help='Path of the Unix socket of the server')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help='Load the model once and predict the requested cases until shutdown')
+    serve_parser.add_argument('--dataset_name', required=True, choices=['ukbb', 'gnc'], help='Dataset name is either ukbb or gnc')
+    serve_parser.add_argument('--num_channels', type=int, required=True, choices=[1, 4], help='Number of channels to be used. Either 1 or 4.')
+    serve_parser.add_argument('--device', required=False, default='cuda', choices=['cuda', 'cpu'], help='Device for the predictions.')
+    serve_parser.add_argument('--num_threads', type=int, required=False, default=None, help='Number of torch threads, e.g. the number of cores of a CPU node.')
+    serve_parser.add_argument('--profile', required=False, default='accurate', choices=sorted(PROFILES.keys()), help='Speed profile of the predictions, see predict.py.')
+    serve_parser.add_argument('--stand_in', action='store_true', help='Use a small untrained network on CPU instead of the nnUNet model, e.g. for testing.')
+
+    submit_parser = subparsers.add_parser('submit', help='Send a folder, a case or a shutdown request to a running server')
+    submit_parser.add_argument('--input_folder', required=False, default=None, help='Folder formatted by convert2nnunet.py')
+    submit_parser.add_argument('--output_folder', required=False, default=None, help='Folder for the predictions of input_folder')
+    submit_parser.add_argument('--input_files', nargs='+', required=False, default=None, help='Files (channels) of a single case')
+    submit_parser.add_argument('--output_file', required=False, default=None, help='Prediction of the single case')
+    submit_parser.add_argument('--shutdown', action='store_true', help='Stop the server')
+    args = parser.parse_args()
+
+    socket_path = os.path.abspath(args.socket)
+
+    if args.command == 'submit':
+        if args.shutdown:
+            request = {'command': 'shutdown'}
+        elif args.input_folder is not None:
+            request = {'input_folder': os.path.abspath(args.input_folder), 'output_folder': os.path.abspath(args.output_folder)}
+        else:
+            request = {'input_files': [os.path.abspath(f) for f in args.input_files], 'output_file': os.path.abspath(args.output_file)}
+        print(json.dumps(submit(socket_path, request), indent=2))
+        return
+
+    # before torch is imported
+    configure_environment('cpu' if args.stand_in else args.device, args.num_threads)
+    logging.basicConfig(
+        format='%(asctime)s: %(message)s',
+        level=logging.NOTSET,
+        handlers=[logging.StreamHandler(sys.stdout)])
+
+    logging.info('Started predict_server...')
+    logging.info('socket: {0}'.format(socket_path))
+    logging.info('dataset_name: {0}'.format(args.dataset_name))
+    logging.info('num_channels: {0}'.format(args.num_channels))
+    logging.info('device: {0}'.format(args.device))
+    logging.info('num_threads: {0}'.format(args.num_threads))
+    logging.info('profile: {0}'.format(args.profile))
+    logging.info('stand_in: {0}\n'.format(args.stand_in))
+
+    if args.num_threads is not None:
+        set_num_threads(args.num_threads)
+
+    if args.stand_in:
+        from inference import TorchPredictor, get_stand_in_network
+        predictor = TorchPredictor(get_stand_in_network(args.num_channels), device='cpu')
+        logging.info('Stand-in network is loaded, waiting for requests...\n')
+    else:
+        if 'RESULTS_FOLDER' not in os.environ:
+            raise RuntimeError('The environment variable RESULTS_FOLDER must be set. This is the place where nnUNet will look for the models.')
+
+        from predict import prepare_model
+        from inference import NnunetPredictor, BatchedNnunetPredictor
+
+        task_name, model_folder = prepare_model(args.dataset_name, args.num_channels)
+        if args.device == 'cpu':
+            # the own sliding window never moves the data to the GPU as the one of nnUNet does
+            predictor = BatchedNnunetPredictor(model_folder, patches_per_batch=1, device=args.device, **PROFILES[args.profile])
+        else:
+            predictor = NnunetPredictor(model_folder, device=args.device, **PROFILES[args.profile])
+        logging.info('Model of task {0} is loaded, waiting for requests...\n'.format(task_name))
+
+    PredictionServer(socket_path, predictor).serve()
+    logging.info('Finished predict_server...')
+
+
+if __name__ == '__main__':
+    main()
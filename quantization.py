@@ -0,0 +1,181 @@
+import sys
+import os
+import copy
+import json
+import shutil
+import logging
+import argparse
+import itertools
+
+import numpy as np
+import nibabel as nib
+
+from inference import BatchedNnunetPredictor, PROFILES, get_cases, get_steps, get_artifact_path, pad_to_patch_size, predict_folder, set_num_threads
+
+
+def get_calibration_batches(predictor, cases, patches_per_case=4, patches_per_batch=2):
+    # patches of a few preprocessed cases, evenly spread over the sliding-window positions of each case
+    import torch
+
+    patch_size = predictor.window.patch_size
+    patches = []
+    for case, input_files in cases.items():
+        d, _ = predictor.preprocess(input_files, case)
+        padded, _ = pad_to_patch_size(np.asarray(d), patch_size)
+        positions = list(itertools.product(*get_steps(patch_size, padded.shape[1:], predictor.step_size)))
+        for i in np.linspace(0, len(positions) - 1, min(patches_per_case, len(positions))).astype(int):
+            patches.append(padded[(slice(None),) + predictor.window.get_region(positions[i])])
+    return [torch.from_numpy(np.stack(patches[i:i + patches_per_batch]).astype(np.float32)) for i in range(0, len(patches), patches_per_batch)]
+
+
+def save_atomic(obj, artifact_path, save):
+    tmp_path = '{0}.{1}.tmp'.format(artifact_path, os.getpid())
+    save(obj, tmp_path)
+    os.replace(tmp_path, artifact_path)
+
+
+def export_bf16(network, artifact_path):
+    # bf16 weights, half the size of the checkpoint
+    import torch
+
+    state_dict = {k: v.to(torch.bfloat16) if v.is_floating_point() else v for k, v in network.state_dict().items()}
+    save_atomic(state_dict, artifact_path, torch.save)
+
+
+def export_int8(network, batches, artifact_path):
+    # static quantization of the weights and activations (fbgemm), the activation ranges are calibrated on the batches.
+    # dynamic quantization only covers linear and recurrent layers, which the nnUNet network does not have
+    import torch
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    network = network.cpu().eval()
+    network.do_ds = False
+    prepared = prepare_fx(network, get_default_qconfig_mapping('fbgemm'), (batches[0],))
+    with torch.no_grad():
+        for batch in batches:
+            prepared(batch)
+    quantized = convert_fx(prepared)
+    with torch.no_grad():
+        traced = torch.jit.trace(quantized, batches[0])
+    save_atomic(traced, artifact_path, torch.jit.save)
+
+
+def get_dice(reference, prediction, labels):
+    # {label name: dice}, a label that is in neither of the label maps agrees completely
+    dice = {}
+    for label, name in labels.items():
+        a = reference == label
+        b = prediction == label
+        total = np.count_nonzero(a) + np.count_nonzero(b)
+        dice[name] = 2.0 * np.count_nonzero(a & b) / total if total > 0 else 1.0
+    return dice
+
+
+def check_precision(reference_folder, prediction_folder, labels):
+    # per-organ Dice of the reduced precision predictions against the fp32 predictions
+    cases = {}
+    for name in sorted(os.listdir(reference_folder)):
+        if not name.endswith('.nii.gz') or not os.path.isfile(os.path.join(prediction_folder, name)):
+            continue
+        reference = np.asanyarray(nib.load(os.path.join(reference_folder, name)).dataobj)
+        prediction = np.asanyarray(nib.load(os.path.join(prediction_folder, name)).dataobj)
+        cases[name.replace('.nii.gz', '')] = get_dice(reference, prediction, labels)
+
+    summary = {}
+    for name in labels.values():
+        values = [dice[name] for dice in cases.values()]
+        summary[name] = {'mean': float(np.mean(values)), 'min': float(np.min(values))} if len(values) > 0 else None
+    return {'cases': cases, 'summary': summary}
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset_name', required=True, choices=['ukbb', 'gnc'], help='Dataset name is either ukbb or gnc')
+    parser.add_argument('--num_channels', type=int, required=True, choices=[1, 4], help='Number of channels to be used. Either 1 or 4.')
+    parser.add_argument('--precision', required=True, choices=['bf16', 'int8'], help='Precision of the exported network. bf16 halves the weights and runs the network in bf16 autocast, \
+                                                                                int8 quantizes the weights and activations (cpu only).')
+    parser.add_argument('--nnunet_folder', required=True, help='Folder formatted by convert2nnunet.py. The first cases are used for the calibration and the Dice check.')
+    parser.add_argument('--check_folder', required=True, help='Folder for the fp32 and reduced precision predictions of the check and the report precision_check.json')
+    parser.add_argument('--num_cases', type=int, required=False, default=3, help='Number of cases for the calibration and the Dice check.')
+    parser.add_argument('--patches_per_case', type=int, required=False, default=4, help='Number of sliding-window patches of each case for the int8 calibration.')
+    parser.add_argument('--device', required=False, default='cpu', choices=['cuda', 'cpu'], help='Device for the predictions of the check. int8 is only available on cpu.')
+    parser.add_argument('--num_threads', type=int, required=False, default=None, help='Number of torch threads.')
+    parser.add_argument('--profile', required=False, default='accurate', choices=sorted(PROFILES.keys()), help='Speed profile of the predictions of the check, see predict.py.')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s: %(message)s',
+        level=logging.NOTSET,
+        handlers=[logging.StreamHandler(sys.stdout)])
+
+    nnunet_folder = os.path.abspath(args.nnunet_folder)
+    check_folder = os.path.abspath(args.check_folder)
+
+    logging.info('Started quantization...')
+    logging.info('dataset_name: {0}'.format(args.dataset_name))
+    logging.info('num_channels: {0}'.format(args.num_channels))
+    logging.info('precision: {0}'.format(args.precision))
+    logging.info('nnunet_folder: {0}'.format(nnunet_folder))
+    logging.info('check_folder: {0}'.format(check_folder))
+    logging.info('num_cases: {0}'.format(args.num_cases))
+    logging.info('device: {0}'.format(args.device))
+    logging.info('profile: {0}\n'.format(args.profile))
+
+    if 'RESULTS_FOLDER' not in os.environ:
+        raise RuntimeError('The environment variable RESULTS_FOLDER must be set. This is the place where nnUNet will look for the models.')
+    if args.num_threads is not None:
+        set_num_threads(args.num_threads)
+
+    from predict import prepare_model
+    task_name, model_folder = prepare_model(args.dataset_name, args.num_channels)
+    artifact_path = get_artifact_path(model_folder, args.precision)
+
+    predictor_kwargs = dict(folds='all', device=args.device, **PROFILES[args.profile])
+    reference_predictor = BatchedNnunetPredictor(model_folder, patches_per_batch=2, **predictor_kwargs)
+    cases = dict(itertools.islice(get_cases(nnunet_folder).items(), args.num_cases))
+    if len(cases) == 0:
+        raise RuntimeError('No cases in {0}.'.format(nnunet_folder))
+
+    if args.precision == 'bf16':
+        export_bf16(reference_predictor.network, artifact_path)
+    else:
+        batches = get_calibration_batches(reference_predictor, cases, args.patches_per_case)
+        logging.info('Calibrating on {0} batches of {1} cases...'.format(len(batches), len(cases)))
+        # the network is copied, the calibration must not change the reference network
+        export_int8(copy.deepcopy(reference_predictor.network), batches, artifact_path)
+    logging.info('Exported [task: {0}, precision: {1}]: {2}\n'.format(task_name, args.precision, artifact_path))
+
+    # the cases of the check are linked into their own folder, so that only they are predicted
+    input_folder = os.path.join(check_folder, 'input')
+    if os.path.exists(input_folder):
+        shutil.rmtree(input_folder)
+    os.makedirs(input_folder)
+    for input_files in cases.values():
+        for input_file in input_files:
+            os.symlink(input_file, os.path.join(input_folder, os.path.basename(input_file)))
+
+    reference_folder = os.path.join(check_folder, 'fp32')
+    prediction_folder = os.path.join(check_folder, args.precision)
+    predict_folder(reference_predictor, input_folder, reference_folder, overwrite=True)
+    del reference_predictor
+    predict_folder(BatchedNnunetPredictor(model_folder, patches_per_batch=2, precision=args.precision, **predictor_kwargs), input_folder, prediction_folder, overwrite=True)
+
+    with open(os.path.join(nnunet_folder, 'dataset.json'), 'r') as handle:
+        labels = {int(k): v for k, v in json.load(handle)['labels'].items() if int(k) > 0}
+    report = check_precision(reference_folder, prediction_folder, labels)
+    report.update({'task': task_name, 'precision': args.precision, 'profile': args.profile, 'artifact': artifact_path})
+    for name, summary in report['summary'].items():
+        if summary is not None:
+            logging.info('Dice [{0}] against fp32: mean {1:.4f}, min {2:.4f}'.format(name, summary['mean'], summary['min']))
+
+    # the report is also stored next to the artifact, so that predict.py can show it
+    for report_path in [os.path.join(check_folder, 'precision_check.json'), artifact_path + '.json']:
+        with open(report_path, 'w') as handle:
+            json.dump(report, handle, indent=2)
+    logging.info('Finished quantization...')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+import multiprocessing
+import logging
+import socket
+import json
+import time
+import glob
+import os
+
+from inference import get_cases
+import metrics
+
+
+# a lock that is older than this is reclaimed, e.g. of a worker on a node that was lost
+LOCK_TIMEOUT = 12 * 3600
+
+
+def get_part(cases, num_parts, part_id):
+    # static split of the sorted cases, e.g. one part per node
+    return {case: cases[case] for case in sorted(cases)[part_id::num_parts]}
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def is_stale_lock(lock_path, lock_timeout=LOCK_TIMEOUT):
+    # the lock records host, pid and time of the claim. it is stale if its process is gone on this host (e.g. killed or
+    # out of memory) or if it is older than lock_timeout (e.g. the node was lost)
+    try:
+        with open(lock_path, 'r') as handle:
+            fields = handle.read().split()
+        claimed_at = os.path.getmtime(lock_path)
+    except FileNotFoundError:
+        return False
+    if len(fields) == 3:
+        host, pid, claimed_at = fields[0], int(fields[1]), float(fields[2])
+        if host == socket.gethostname() and not is_process_alive(pid):
+            return True
+    # a lock without its fields is still being written, only its age counts
+    return lock_timeout is not None and time.time() - claimed_at > lock_timeout
+
+
+def reclaim_stale_lock(lock_path, lock_timeout=LOCK_TIMEOUT):
+    if not is_stale_lock(lock_path, lock_timeout):
+        return False
+    # the rename is atomic, so only one worker removes the stale lock
+    stale_path = '{0}.{1}_{2}.stale'.format(lock_path, socket.gethostname(), os.getpid())
+    try:
+        os.rename(lock_path, stale_path)
+    except FileNotFoundError:
+        return False
+    if not is_stale_lock(stale_path, lock_timeout):
+        # another worker reclaimed and claimed the case in the meantime, its lock is put back
+        try:
+            os.link(stale_path, lock_path)
+        except FileExistsError:
+            pass
+        os.remove(stale_path)
+        return False
+    os.remove(stale_path)
+    logging.warning('Reclaimed stale lock: {0}'.format(lock_path))
+    return True
+
+
+def claim_case(lock_folder, case, lock_timeout=LOCK_TIMEOUT):
+    # O_EXCL creation is atomic, also on shared filesystems, so a case is claimed by exactly one worker
+    lock_path = os.path.join(lock_folder, case + '.lock')
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        if not reclaim_stale_lock(lock_path, lock_timeout):
+            return False
+        return claim_case(lock_folder, case, lock_timeout)
+    with os.fdopen(fd, 'w') as handle:
+        handle.write('{0} {1} {2}\n'.format(socket.gethostname(), os.getpid(), time.time()))
+    return True
+
+
+def release_case(lock_folder, case):
+    # only the own lock is removed, the case may have been reclaimed by another worker in the meantime
+    lock_path = os.path.join(lock_folder, case + '.lock')
+    try:
+        with open(lock_path, 'r') as handle:
+            fields = handle.read().split()
+    except FileNotFoundError:
+        return
+    if fields[:2] == [socket.gethostname(), str(os.getpid())]:
+        os.remove(lock_path)
+
+
+def predict_claimed_cases(predictor, cases, output_folder, lock_folder, latencies=None, lock_timeout=LOCK_TIMEOUT):
+    # predicts every case that has no prediction and is not claimed by another worker
+    predicted = []
+    for case, input_files in cases.items():
+        output_file = os.path.join(output_folder, case + '.nii.gz')
+        if os.path.isfile(output_file) or not claim_case(lock_folder, case, lock_timeout):
+            continue
+        # the prediction is written next to the lock and moved, so an existing prediction is always complete.
+        # the name is unique per worker, since a reclaimed case may still be predicted by a worker that was thought lost
+        tmp_file = os.path.join(lock_folder, '{0}.{1}_{2}.nii.gz'.format(case, socket.gethostname(), os.getpid()))
+        try:
+            # checked again, another worker may have finished the case before it was claimed
+            if os.path.isfile(output_file):
+                continue
+            start = time.time()
+            # a worker predicts one case at a time, so the peak memory is the one of the case
+            with metrics.measure(case, 'predict', reset_peak=True):
+                predictor.predict_case(input_files, tmp_file, case)
+            os.replace(tmp_file, output_file)
+            latency = time.time() - start
+            logging.info('Predicted [{0}] in {1:.1f}s: {2}'.format(case, latency, output_file))
+            if latencies is not None:
+                latencies[case] = latency
+            predicted.append(case)
+        except Exception:
+            logging.exception('Prediction failed for case [{0}]'.format(case))
+        finally:
+            # a failed prediction may have left a partial file
+            if os.path.lexists(tmp_file):
+                os.remove(tmp_file)
+            release_case(lock_folder, case)
+    return predicted
+
+
+def get_worker_prefix(shard_folder, part_id, worker_id='*'):
+    return os.path.join(shard_folder, '{0}_part_{1}_worker_{2}'.format(socket.gethostname(), part_id, worker_id))
+
+
+def run_worker(worker_id, make_predictor, predictor_kwargs, input_folder, output_folder, shard_folder, num_parts, part_id, num_threads, metrics_file=None,
+               lock_timeout=LOCK_TIMEOUT):
+    metrics.configure(metrics_file)
+    logging.basicConfig(
+        format='%(asctime)s: %(message)s',
+        level=logging.NOTSET,
+        handlers=[logging.FileHandler(filename=get_worker_prefix(shard_folder, part_id, worker_id) + '_log.txt', mode='w', encoding='utf-8')],
+        force=True)
+    if num_threads is not None:
+        from inference import set_num_threads
+        set_num_threads(num_threads)
+
+    predictor = make_predictor(**predictor_kwargs)
+    cases = get_part(get_cases(input_folder), num_parts, part_id)
+    latencies = {}
+    predict_claimed_cases(predictor, cases, output_folder, os.path.join(shard_folder, 'locks'), latencies, lock_timeout)
+    with open(get_worker_prefix(shard_folder, part_id, worker_id) + '_latency.json', 'w') as handle:
+        json.dump(latencies, handle)
+
+
+def run_workers(num_workers, make_predictor, predictor_kwargs, input_folder, output_folder, num_parts=1, part_id=0, num_threads=None, metrics_file=None,
+                lock_timeout=LOCK_TIMEOUT):
+    # launches local worker processes that share the cases of one part through file locks,
+    # several nodes can run this on the same folders with different part ids (or the same one)
+    shard_folder = os.path.join(output_folder, '.shards')
+    os.makedirs(os.path.join(shard_folder, 'locks'), exist_ok=True)
+    worker_threads = max(num_threads // num_workers, 1) if num_threads is not None else None
+
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=run_worker, args=(i, make_predictor, predictor_kwargs, input_folder, output_folder, shard_folder, num_parts, part_id, worker_threads, metrics_file,
+                                                             lock_timeout))
+               for i in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        if worker.exitcode != 0:
+            logging.warning('Worker {0} exited with code {1}'.format(worker.name, worker.exitcode))
+
+    # the logs and latencies of the workers of this part are merged
+    latencies = {}
+    for log_file in sorted(glob.glob(get_worker_prefix(shard_folder, part_id) + '_log.txt')):
+        with open(log_file, 'r', encoding='utf-8') as handle:
+            logging.info('Log of {0}:\n{1}'.format(os.path.basename(log_file), handle.read()))
+        os.remove(log_file)
+    for latency_file in sorted(glob.glob(get_worker_prefix(shard_folder, part_id) + '_latency.json')):
+        with open(latency_file, 'r') as handle:
+            latencies.update(json.load(handle))
+        os.remove(latency_file)
+    return latencies
@@ -0,0 +1,199 @@
+import numpy as np
+import nibabel as nib
+
+
+def get_station_axis_params(n_target, target_to_station, n_station):
+    # target_to_station = (scale, offset) maps a target voxel index to a (fractional) station voxel index along one axis
+    scale, offset = target_to_station
+    coords = np.arange(n_target, dtype=np.float64) * scale + offset
+    valid = (coords > -0.5) & (coords < n_station - 0.5)
+    coords = np.clip(coords, 0, n_station - 1)
+    i0 = np.floor(coords).astype(np.intp)
+    i1 = np.minimum(i0 + 1, n_station - 1)
+    frac = (coords - i0).astype(np.float32)
+    return {'i0': i0, 'i1': i1, 'frac': frac, 'valid': valid, 'coords': coords}
+
+
+def compute_geometry(affines, shapes, margin=3):
+    affines = [np.asarray(a, dtype=np.float64) for a in affines]
+    shapes = [tuple(int(n) for n in s[:3]) for s in shapes]
+
+    # the whole-body grid uses the orientation of the first station and the finest spacing of all stations
+    spacings = [np.sqrt((a[:3, :3] ** 2).sum(axis=0)) for a in affines]
+    directions = affines[0][:3, :3] / spacings[0]
+    for a, spacing in zip(affines[1:], spacings[1:]):
+        if not np.allclose(a[:3, :3] / spacing, directions, atol=1e-3):
+            raise ValueError('Stations with different orientations cannot be stitched.')
+    target_spacing = np.min(spacings, axis=0)
+
+    # bounding box of all stations in the target axes
+    corners = []
+    for a, shape in zip(affines, shapes):
+        for cx in (0, shape[0] - 1):
+            for cy in (0, shape[1] - 1):
+                for cz in (0, shape[2] - 1):
+                    corners.append(a[:3, :3] @ np.array([cx, cy, cz]) + a[:3, 3])
+    corners = np.array(corners)
+    origin = affines[0][:3, 3]
+    corners = np.linalg.solve(directions, (corners - origin).T).T / target_spacing
+    lower = np.floor(corners.min(axis=0) + 1e-3)
+    upper = np.ceil(corners.max(axis=0) - 1e-3)
+
+    target_affine = np.eye(4)
+    target_affine[:3, :3] = directions * target_spacing
+    target_affine[:3, 3] = origin + directions @ (lower * target_spacing)
+    target_shape = tuple(int(n) for n in (upper - lower + 1))
+
+    # stations are stacked along the axis in which their centres differ most
+    centres = np.array([a[:3, :3] @ ((np.array(shape) - 1) / 2.0) + a[:3, 3] for a, shape in zip(affines, shapes)])
+    centres = np.linalg.solve(directions, (centres - origin).T).T
+    stack_axis = int(np.argmax(centres.max(axis=0) - centres.min(axis=0)))
+
+    stations = []
+    for a, shape in zip(affines, shapes):
+        # the orientations are equal, therefore the mapping from the target grid to the station grid is separable
+        mapping = np.linalg.solve(a, target_affine)
+        axes = [get_station_axis_params(target_shape[d], (mapping[d, d], mapping[d, 3]), shape[d]) for d in range(3)]
+
+        # the slab of the target grid along the stacking axis that is covered by the station
+        covered = np.nonzero(axes[stack_axis]['valid'])[0]
+        if len(covered) == 0:
+            raise ValueError('Station does not overlap with the whole-body grid.')
+        start, stop = int(covered[0]), int(covered[-1]) + 1
+        for d in range(3):
+            if d == stack_axis:
+                axes[d] = {k: v[start:stop] for k, v in axes[d].items()}
+
+        # margin slices at both ends of a station are only used if no other station covers them,
+        # inside the station the weight increases linearly with the distance to the margin for a smooth blending
+        coords = axes[stack_axis]['coords']
+        low, high = margin, shape[stack_axis] - 1 - margin
+        if high < low:
+            low, high = 0, shape[stack_axis] - 1
+        weight = np.minimum(coords - low, high - coords) + 1.0
+        weight = np.where((coords >= low) & (coords <= high), weight, 1e-3).astype(np.float32)
+
+        stations.append({
+            'shape': shape,
+            'start': start,
+            'stop': stop,
+            'axes': axes,
+            'weight': weight,
+        })
+
+    order = sorted(range(len(stations)), key=lambda i: centres[i, stack_axis])
+
+    return {
+        'affine': target_affine,
+        'shape': target_shape,
+        'stack_axis': stack_axis,
+        'margin': margin,
+        'order': order,
+        'stations': stations,
+    }
+
+
+def resample_station(volume, station, stack_axis):
+    # separable linear interpolation, one axis at a time
+    block = np.asarray(volume, dtype=np.float32)
+    for d in range(3):
+        axis = station['axes'][d]
+        shape = [1, 1, 1]
+        shape[d] = -1
+        frac = axis['frac'].reshape(shape)
+        block = np.take(block, axis['i0'], axis=d) * (1 - frac) + np.take(block, axis['i1'], axis=d) * frac
+
+    mask = np.ones(block.shape, dtype=np.float32)
+    for d in range(3):
+        shape = [1, 1, 1]
+        shape[d] = -1
+        weight = station['weight'] if d == stack_axis else station['axes'][d]['valid'].astype(np.float32)
+        mask = mask * weight.reshape(shape)
+    return block, mask
+
+
+def get_axis_slice(axis, start, stop):
+    slab = [slice(None)] * 3
+    slab[axis] = slice(start, stop)
+    return tuple(slab)
+
+
+def extend_window(window, axis, n):
+    # appends n empty slices along the axis
+    shape = list(window.shape)
+    shape[axis] = n
+    return np.concatenate([window, np.zeros(shape, dtype=window.dtype)], axis=axis)
+
+
+def finalize_slab(accumulator, weights, dtype):
+    np.divide(accumulator, weights, out=accumulator, where=weights > 0)
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        accumulator = np.clip(np.rint(accumulator), info.min, info.max)
+    return accumulator.astype(dtype)
+
+
+def stitch_volumes(volumes, geometry, adjust_intensity=True):
+    if len(volumes) != len(geometry['stations']):
+        raise ValueError('Number of volumes does not match the number of stations.')
+
+    # volumes can also be array proxies of nibabel, then every station is only read when it is resampled
+    dtype = np.asanyarray(volumes[0][:1, :1, :1]).dtype
+    stack_axis = geometry['stack_axis']
+    stitched = np.zeros(geometry['shape'], dtype=dtype)
+
+    # the float32 accumulators only cover a window of slices along the stacking axis, slices before the first slice
+    # of the remaining stations are final and are stored in the dtype of the volumes
+    window_shape = list(geometry['shape'])
+    window_shape[stack_axis] = 0
+    accumulator = np.zeros(window_shape, dtype=np.float32)
+    weights = np.zeros(window_shape, dtype=np.float32)
+    window_start, window_stop = 0, 0
+
+    # stations are blended in their order along the stacking axis so that the intensity of every station
+    # can be matched to its already stitched neighbour in the overlap
+    order = geometry['order']
+    for n, i in enumerate(order):
+        station = geometry['stations'][i]
+        if tuple(np.shape(volumes[i])[:3]) != station['shape']:
+            raise ValueError('Volume shape does not match the station geometry.')
+        if station['stop'] > window_stop:
+            accumulator = extend_window(accumulator, stack_axis, station['stop'] - window_stop)
+            weights = extend_window(weights, stack_axis, station['stop'] - window_stop)
+            window_stop = station['stop']
+        block, mask = resample_station(volumes[i], station, stack_axis)
+        slab = get_axis_slice(stack_axis, station['start'] - window_start, station['stop'] - window_start)
+
+        if adjust_intensity:
+            overlap = (weights[slab] > 0) & (mask > 0) & (block > 0)
+            if overlap.any():
+                stitched_mean = (accumulator[slab][overlap] / weights[slab][overlap]).mean()
+                station_mean = block[overlap].mean()
+                if station_mean > 0:
+                    block *= stitched_mean / station_mean
+
+        accumulator[slab] += block * mask
+        weights[slab] += mask
+        del block, mask
+
+        final_stop = min([geometry['stations'][j]['start'] for j in order[n + 1:]] + [window_stop])
+        if final_stop > window_start:
+            final = get_axis_slice(stack_axis, 0, final_stop - window_start)
+            stitched[get_axis_slice(stack_axis, window_start, final_stop)] = finalize_slab(accumulator[final], weights[final], dtype)
+            # the remaining slices are copied, so that the memory of the final slices is released
+            rest = get_axis_slice(stack_axis, final_stop - window_start, None)
+            accumulator = accumulator[rest].copy()
+            weights = weights[rest].copy()
+            window_start = final_stop
+
+    return stitched
+
+
+def stitch_images(nii_images, geometry=None, margin=3, adjust_intensity=True):
+    if geometry is None:
+        geometry = compute_geometry([img.affine for img in nii_images], [img.shape for img in nii_images], margin)
+    # the stations are read one at a time from the array proxies of the images
+    data = stitch_volumes([img.dataobj for img in nii_images], geometry, adjust_intensity)
+    stitched = nib.Nifti1Image(data, geometry['affine'])
+    stitched.header.set_xyzt_units(2)
+    return stitched, geometry
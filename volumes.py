@@ -0,0 +1,124 @@
+import os
+import json
+
+import numpy as np
+
+
+# formats of the intermediate volumes, nii and npy are read with memory mapping instead of being decompressed
+INTERMEDIATE_FORMATS = ['nii.gz', 'nii', 'npy']
+
+
+def get_volume_path(folder, name, intermediate_format='nii.gz'):
+    return os.path.join(folder, name + '.' + intermediate_format)
+
+
+def get_volume_name(path):
+    base = os.path.basename(path)
+    for intermediate_format in INTERMEDIATE_FORMATS:
+        if base.endswith('.' + intermediate_format):
+            return base[:-len(intermediate_format) - 1]
+    return base
+
+
+def get_sidecar_path(path):
+    # the affine of a npy volume is stored next to it
+    return path[:-len('.npy')] + '.json'
+
+
+def find_volume(folder, name):
+    # returns the path of the volume in any of the formats, or None
+    for intermediate_format in INTERMEDIATE_FORMATS:
+        path = get_volume_path(folder, name, intermediate_format)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def find_volumes(folder, names):
+    # {name: path or None} of the volumes in any of the formats with a single directory scan instead of one check per file
+    try:
+        files = set(entry.name for entry in os.scandir(folder) if entry.is_file())
+    except FileNotFoundError:
+        files = set()
+    volumes = {}
+    for name in names:
+        volumes[name] = None
+        for intermediate_format in INTERMEDIATE_FORMATS:
+            if name + '.' + intermediate_format in files:
+                volumes[name] = get_volume_path(folder, name, intermediate_format)
+                break
+    return volumes
+
+
+def save_volume(img, path, gzip_level=None):
+    # gzip_level is only used for nii.gz, None is the default level of nibabel
+    import nibabel as nib
+
+    if path.endswith('.npy'):
+        np.save(path, np.asanyarray(img.dataobj))
+        with open(get_sidecar_path(path), 'w') as handle:
+            json.dump({'affine': np.asarray(img.affine).tolist()}, handle)
+    elif path.endswith('.nii.gz') and gzip_level is not None:
+        # the image is streamed into the compressor instead of being copied into one bytes object first
+        with nib.openers.Opener(path, 'wb', compresslevel=gzip_level) as handle:
+            img.to_file_map({'image': nib.FileHolder(fileobj=handle)})
+    else:
+        nib.save(img, path)
+
+
+def load_volume(path):
+    # nii and npy are memory mapped, so only the voxels that are used are read
+    import nibabel as nib
+
+    if path.endswith('.npy'):
+        with open(get_sidecar_path(path), 'r') as handle:
+            affine = np.array(json.load(handle)['affine'])
+        return nib.Nifti1Image(np.load(path, mmap_mode='r'), affine)
+    return nib.load(path)
+
+
+def is_uint8_labels(img):
+    # only the header is read
+    return img.get_data_dtype() == np.uint8 and img.dataobj.slope == 1 and img.dataobj.inter == 0
+
+
+def load_labels(img):
+    # the label map as uint8, e.g. of predictions that are stored as int16 or float
+    labels = np.asanyarray(img.dataobj)
+    if labels.dtype == np.uint8:
+        return labels
+    if labels.size > 0 and (labels.min() < 0 or labels.max() > 255):
+        raise ValueError('Labels out of the uint8 range: {0} to {1}'.format(labels.min(), labels.max()))
+    return np.rint(labels).astype(np.uint8) if np.issubdtype(labels.dtype, np.floating) else labels.astype(np.uint8)
+
+
+def get_labels_image(labels, header, affine=None):
+    # label maps are always stored as uint8 without scaling, the affine of the header is kept if no affine is given
+    import nibabel as nib
+
+    header = header.copy()
+    header.set_data_dtype(np.uint8)
+    header.set_slope_inter(1, 0)
+    img = nib.Nifti1Image(labels, affine, header)
+    if affine is not None:
+        img.set_qform(affine, code=int(header['qform_code']) or 1)
+        img.set_sform(affine, code=int(header['sform_code']) or 1)
+    return img
+
+
+def save_labels(labels, header, path, affine=None):
+    # path may be a hardlink or symlink to the raw prediction (e.g. of an earlier run without postprocessing), so the label
+    # map is written to a new file that replaces the link instead of being written through it
+    tmp_path = os.path.join(os.path.dirname(path), '.{0}.{1}'.format(os.getpid(), os.path.basename(path)))
+    try:
+        get_labels_image(np.asarray(labels, dtype=np.uint8), header, affine).to_filename(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+
+
+def remove_volume(path):
+    os.remove(path)
+    if path.endswith('.npy') and os.path.isfile(get_sidecar_path(path)):
+        os.remove(get_sidecar_path(path))
@@ -0,0 +1,218 @@
+import os
+import csv
+import json
+import argparse
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from volumes import load_labels
+
+
+# columns of the organs in this order for both datasets, the label values of the kidneys differ between ukbb and gnc
+ORGANS = ['liv', 'spl', 'lkd', 'rkd', 'pnc']
+AXES = ['x', 'y', 'z']
+# columns that were added to the table later, with their value in the rows of tables written before
+COLUMN_DEFAULTS = {'_removed': -1}
+
+
+def get_label_names(folder):
+    # {label value: organ} of the dataset.json that predict.py copies into the prediction folder
+    with open(os.path.join(folder, 'dataset.json'), 'r') as handle:
+        labels = json.load(handle)['labels']
+    return {int(k): v for k, v in labels.items() if int(k) > 0}
+
+
+def get_organs(label_names):
+    return [organ for organ in ORGANS if organ in label_names.values()] + sorted(set(label_names.values()) - set(ORGANS))
+
+
+def get_columns(organs):
+    columns = ['subject', 'nnunet_subject']
+    for organ in organs:
+        columns += ['{0}_voxels'.format(organ), '{0}_ml'.format(organ)]
+        columns += ['{0}_centroid_{1}'.format(organ, a) for a in AXES]
+        columns += ['{0}_bbox_{1}{2}'.format(organ, a, i) for a in AXES for i in (0, 1)]
+        columns += ['{0}_removed'.format(organ)]
+    return columns
+
+
+def get_column_default(column):
+    for suffix, value in COLUMN_DEFAULTS.items():
+        if column.endswith(suffix):
+            return value
+    return None
+
+
+def compute_volumetrics(labels, affine, voxel_volume, label_names, offset=(0, 0, 0)):
+    # voxel count, volume in ml, centroid in mm (world coordinates) and bounding box [start, stop) in voxels of every organ.
+    # the foreground voxels are found in one pass over the label map, the organs are then only a fraction of the volume.
+    # offset is the position of the label map in the whole-body grid of affine, e.g. the crop box
+    flat = labels.reshape(-1)
+    idx = np.flatnonzero(flat)
+    values = flat[idx]
+    offset = np.asarray(offset, dtype=np.int64)
+
+    volumetrics = {}
+    for label, organ in label_names.items():
+        voxels = np.stack(np.unravel_index(idx[values == label], labels.shape))
+        num_voxels = voxels.shape[1]
+        row = {'{0}_voxels'.format(organ): num_voxels, '{0}_ml'.format(organ): num_voxels * voxel_volume / 1000.0}
+        if num_voxels > 0:
+            centroid = np.asarray(affine)[:3, :3] @ (voxels.mean(axis=1) + offset) + np.asarray(affine)[:3, 3]
+            lower = voxels.min(axis=1) + offset
+            upper = voxels.max(axis=1) + offset + 1
+        else:
+            centroid = [np.nan] * 3
+            lower = upper = [-1] * 3
+        for d, a in enumerate(AXES):
+            row['{0}_centroid_{1}'.format(organ, a)] = float(centroid[d])
+            row['{0}_bbox_{1}0'.format(organ, a)] = int(lower[d])
+            row['{0}_bbox_{1}1'.format(organ, a)] = int(upper[d])
+        volumetrics.update(row)
+    return volumetrics
+
+
+def get_subject_volumetrics(entry, prediction_folder, label_names, labels=None, removed=None):
+    # the volumetrics are computed on the prediction of nnUNet (or on its postprocessed labels), for cropped subjects this
+    # is only the crop box of the whole-body grid. the voxels removed by the postprocessing are -1 without postprocessing
+    import nibabel as nib
+
+    pred = nib.load(os.path.join(prediction_folder, entry['nnunet_subject'] + '.nii.gz'))
+    voxel_volume = float(np.prod(pred.header.get_zooms()[:3]))
+    if entry.get('crop') is not None:
+        affine, offset = np.array(entry['crop']['affine']), [b[0] for b in entry['crop']['box']]
+    else:
+        affine, offset = pred.affine, (0, 0, 0)
+    row = {'subject': entry['orig_subject'], 'nnunet_subject': entry['nnunet_subject']}
+    row.update(compute_volumetrics(load_labels(pred) if labels is None else labels, affine, voxel_volume, label_names, offset))
+    for organ in label_names.values():
+        row['{0}_removed'.format(organ)] = removed.get(organ, 0) if removed is not None else -1
+    return row
+
+
+class VolumetricsTable(object):
+    # one CSV row per subject, appended as soon as the subject is done, so an interrupted run keeps its rows and
+    # subjects that are already in the table are not computed again. several processes can append to the same file
+
+    def __init__(self, path, organs=ORGANS):
+        self.path = os.path.abspath(path)
+        self.columns = get_columns(organs)
+        self.subjects = self.load_subjects()
+
+    def load_subjects(self):
+        if not os.path.isfile(self.path) or os.path.getsize(self.path) == 0:
+            return set()
+        with open(self.path, 'r', newline='') as handle:
+            reader = csv.reader(handle)
+            header = next(reader)
+            if header == self.columns:
+                return set(row[0] for row in reader if len(row) > 0)
+        self.check_columns(header)
+        return self.upgrade()
+
+    def check_columns(self, header):
+        # a table of an earlier version may only lack the columns that were added later
+        missing = [c for c in self.columns if c not in header]
+        if not set(header) <= set(self.columns) or any(get_column_default(c) is None for c in missing):
+            raise ValueError('Columns of {0} do not match the labels of the dataset.'.format(self.path))
+
+    def upgrade(self):
+        # the rows of an earlier version are rewritten with the current columns, the added columns get their default.
+        # the new file replaces the old one under the lock of the old one, see append
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            with open(self.path, 'r', newline='') as handle:
+                reader = csv.reader(handle)
+                header = next(reader)
+                rows = [row for row in reader if len(row) == len(header)]
+            if header != self.columns:
+                self.check_columns(header)
+                tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+                with open(tmp_path, 'w', newline='') as handle:
+                    handle.write(','.join(self.columns) + '\n')
+                    for row in rows:
+                        values = dict(zip(header, row))
+                        handle.write(','.join(values[c] if c in values else str(get_column_default(c)) for c in self.columns) + '\n')
+                os.replace(tmp_path, self.path)
+        finally:
+            os.close(fd)
+        return set(row[0] for row in rows)
+
+    def __contains__(self, subject):
+        return subject in self.subjects
+
+    def append(self, row):
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                # the file may have been replaced by upgrade while the lock was awaited
+                while os.fstat(fd).st_ino != os.stat(self.path).st_ino:
+                    os.close(fd)
+                    fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+            lines = []
+            if os.fstat(fd).st_size == 0:
+                lines.append(','.join(self.columns))
+            lines.append(','.join(str(row[c]) for c in self.columns))
+            os.write(fd, ('\n'.join(lines) + '\n').encode('utf-8'))
+        finally:
+            os.close(fd)
+        self.subjects.add(row['subject'])
+
+
+def load_table(path):
+    # {column: array} of the CSV table, the last row of a subject is used if it was appended more than once
+    with open(path, 'r', newline='') as handle:
+        reader = csv.reader(handle)
+        columns = next(reader)
+        rows = {}
+        for row in reader:
+            if len(row) == len(columns):
+                rows[row[0]] = row
+    rows = list(rows.values())
+    table = {}
+    for i, column in enumerate(columns):
+        values = [row[i] for row in rows]
+        if column in ('subject', 'nnunet_subject'):
+            table[column] = np.array(values, dtype=str)
+        elif column.endswith('_voxels') or column.endswith('_removed') or '_bbox_' in column:
+            table[column] = np.array(values, dtype=np.int64)
+        else:
+            table[column] = np.array(values, dtype=np.float64)
+    return table
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--volumetrics_file', required=True, help='CSV file written by the --volumetrics_file option of convert2original.py')
+    parser.add_argument('--npz', required=False, default=None, help='Exports the table as one array per column into this npz file, which loads much faster than the CSV file.')
+    args = parser.parse_args()
+
+    table = load_table(args.volumetrics_file)
+    if args.npz is not None:
+        np.savez(args.npz, **table)
+
+    print('subjects: {0}'.format(len(table['subject'])))
+    print('{0:<8} {1:>8} {2:>10} {3:>10} {4:>10}'.format('organ', 'missing', 'mean [ml]', 'p5 [ml]', 'p95 [ml]'))
+    for column in table:
+        if column.endswith('_ml'):
+            ml = table[column]
+            present = ml[table[column[:-len('_ml')] + '_voxels'] > 0]
+            if len(present) == 0:
+                print('{0:<8} {1:>8}'.format(column[:-len('_ml')], len(ml)))
+                continue
+            print('{0:<8} {1:>8} {2:>10.1f} {3:>10.1f} {4:>10.1f}'.format(column[:-len('_ml')], len(ml) - len(present), present.mean(),
+                                                                       np.percentile(present, 5), np.percentile(present, 95)))
+
+
+if __name__ == '__main__':
+    main()